@@ -0,0 +1,177 @@
+#
+# End-to-end throughput benchmark for the census loader.
+#
+# Generates (or reuses) a synthetic census tree and loads it into a local
+# PostgreSQL database, reporting rows/sec and peak RSS for each stage.
+#
+# e.g.
+#   python bench.py --scale 0.05 --census-dir /tmp/synthetic_census
+#
+# Single-state query latency for the sa1, sa2 and ssc tables is reported
+# too; compare a run with --partition-by-state against one without.
+#
+
+import os
+import json
+import time
+import argparse
+import resource
+import statistics
+import multiprocessing
+import sqlalchemy
+from census2011 import load_shapes
+from census2011 import load_attrs
+from census2011.attrs import PACKAGES, package_schema_name
+from census2011.dump import make_engine
+from census2011.partition import PARTITIONED_DIVISIONS, STATE_COLUMN, STATE_EXPRESSION
+from census2011.synthetic import generate_census, SUMMARY_FILENAME
+from census2011.instrument import report
+from ealgis_common.db import DataLoaderFactory
+from ealgis_common.util import make_logger
+
+
+logger = make_logger(__name__)
+
+
+def peak_rss_kb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def process_alive_or_queued(process, queue):
+    while process.is_alive() or not queue.empty():
+        if not queue.empty():
+            return True
+        process.join(timeout=0.5)
+    return not queue.empty()
+
+
+def run_stage(name, fn, rows, *args, profile_memory=False):
+    """
+    Run a stage in a child process so that its peak RSS is measured
+    in isolation from the stages that ran before it.
+    """
+    def target(queue):
+        if profile_memory:
+            report.profile_memory()
+        start = time.perf_counter()
+        fn(*args)
+        queue.put({
+            "seconds": time.perf_counter() - start,
+            "peak_rss_kb": peak_rss_kb(),
+            "report": report.to_dict(),
+        })
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(queue,), name=name)
+    process.start()
+    # Drain the queue before joining, the child can't exit until its report is flushed
+    result = queue.get() if process_alive_or_queued(process, queue) else None
+    process.join()
+    if process.exitcode != 0 or result is None:
+        raise Exception("benchmark stage '%s' failed with exit code %s" % (name, process.exitcode))
+    result["stage"] = name
+    result["rows"] = rows
+    result["rows_per_sec"] = rows / result["seconds"] if result["seconds"] > 0 else None
+    logger.info("%s: %d rows in %.1fs (%.0f rows/sec), peak RSS %.1f MB" % (
+        name, rows, result["seconds"], result["rows_per_sec"] or 0, result["peak_rss_kb"] / 1024))
+    return result
+
+
+def stage_generate(census_dir, scale):
+    generate_census(census_dir, scale=scale)
+
+
+def stage_shapes(db_name, census_dir, tmpdir):
+    factory = DataLoaderFactory(db_name=db_name, clean=True)
+    load_shapes(factory, census_dir, tmpdir)
+
+
+def stage_attrs(db_name, census_dir, tmpdir, partition_by_state=False):
+    factory = DataLoaderFactory(db_name=db_name, clean=False)
+    load_attrs(factory, census_dir, tmpdir, partition_by_state=partition_by_state)
+
+
+def state_query_latency(db_name, repeats=5):
+    """
+    Time fetching every row of one state from each sa1, sa2 and ssc table,
+    for every state: through the partition key if the table is partitioned
+    by state, otherwise from the region codes.
+
+    Returns the median and 95th percentile latency (ms) per division.
+    """
+    engine = make_engine(db_name)
+    schemas = [package_schema_name(abbrev) for _, abbrev, _, _ in PACKAGES]
+    timings = {}
+    partitioned = False
+    with engine.connect() as conn:
+        tables = conn.execute(sqlalchemy.text("""
+            SELECT table_schema, table_name FROM information_schema.tables
+            WHERE table_schema = ANY(:schemas) AND table_name ~ :pattern"""),
+            schemas=schemas, pattern="_({})$".format("|".join(PARTITIONED_DIVISIONS))).fetchall()
+        for schema, table_name in tables:
+            has_state = conn.execute(sqlalchemy.text("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = :schema AND table_name = :table AND column_name = :column"""),
+                schema=schema, table=table_name, column=STATE_COLUMN).scalar() is not None
+            partitioned = partitioned or has_state
+            where = '"{}" = :state'.format(STATE_COLUMN) if has_state else "{} = :state".format(STATE_EXPRESSION)
+            sql = sqlalchemy.text('SELECT * FROM "{}"."{}" WHERE {}'.format(schema, table_name, where))
+            for state in range(1, 10):
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    conn.execute(sql, state=state).fetchall()
+                    timings.setdefault(table_name.rsplit("_", 1)[1], []).append((time.perf_counter() - start) * 1000)
+
+    result = {"partitioned": partitioned}
+    for division, ms in sorted(timings.items()):
+        ms.sort()
+        result[division] = {
+            "tables": sum(1 for _, t in tables if t.endswith("_" + division)),
+            "median_ms": statistics.median(ms),
+            "p95_ms": ms[int(0.95 * (len(ms) - 1))],
+        }
+        logger.info("%s: single-state query median %.2fms, p95 %.2fms%s" % (
+            division, result[division]["median_ms"], result[division]["p95_ms"], " (partitioned)" if partitioned else ""))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the census loader against a synthetic census")
+    parser.add_argument("--census-dir", default="/tmp/synthetic_census_2011")
+    parser.add_argument("--tmpdir", default="/tmp")
+    parser.add_argument("--db-name", default="bench_census_2011")
+    parser.add_argument("--scale", type=float, default=0.01)
+    parser.add_argument("--skip-generate", action="store_true", help="Reuse an existing synthetic census in --census-dir")
+    parser.add_argument("--report", help="Write the results as JSON to this path")
+    parser.add_argument("--partition-by-state", action="store_true", help="Load the sa1, sa2 and ssc tables partitioned by state")
+    parser.add_argument("--profile-memory", action="store_true", help="Record tracemalloc peaks and top allocators per stage and table")
+    args = parser.parse_args()
+
+    results = []
+    summary_path = os.path.join(args.census_dir, SUMMARY_FILENAME)
+    if not args.skip_generate:
+        os.makedirs(args.census_dir, exist_ok=True)
+        results.append(run_stage("generate", stage_generate, 0, args.census_dir, args.scale))
+    with open(summary_path, "r") as f:
+        summary = json.load(f)
+
+    region_rows = sum(summary["regions"].values())
+    attr_rows = sum(p["rows"] for p in summary["packages"].values())
+    if results:
+        results[0]["rows"] = attr_rows
+        results[0]["rows_per_sec"] = attr_rows / results[0]["seconds"]
+
+    results.append(run_stage("shapes", stage_shapes, region_rows, args.db_name, args.census_dir, args.tmpdir, profile_memory=args.profile_memory))
+    results.append(run_stage("attrs", stage_attrs, attr_rows, args.db_name, args.census_dir, args.tmpdir, args.partition_by_state, profile_memory=args.profile_memory))
+
+    report = {"scale": summary["scale"], "stages": results, "state_queries": state_query_latency(args.db_name)}
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,19 @@
-from .shapes import load_shapes  # noqa
-from .attrs import load_attrs  # noqa
\ No newline at end of file
+# load_shapes and load_attrs are imported on first use (PEP 562), so that
+# importing the package (or a light module of it, e.g. census2011.shapes for
+# SHAPE_LINKAGE) doesn't import openpyxl, sqlalchemy and the loaders.
+
+_LAZY = {
+    "load_shapes": "shapes",
+    "load_attrs": "attrs",
+}
+
+__all__ = list(_LAZY)
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    from importlib import import_module
+    value = getattr(import_module("." + _LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,243 @@
+#
+# EAlGIS loader: Australian Census 2011; command line
+#
+#   python -m census2011 shapes [--divisions sa1,sa2]
+#   python -m census2011 attrs [--packages BCP] [--tables b01,b04] [--validate]
+#   python -m census2011 validate [--packages BCP]
+#   python -m census2011 export /app/parquet/
+#   python -m census2011 bench [bench.py options]
+#   python -m census2011 microbench run --save baseline.json
+#   python -m census2011 importtime
+#
+# Each subcommand imports what it needs when it runs, so that the command
+# line (like the package itself, see __init__.py) starts quickly. The
+# importtime subcommand checks that it stays that way: each of
+# LIGHT_MODULES must import within IMPORT_BUDGET_MS without pulling in any
+# of HEAVY_MODULES.
+#
+# recipe.py remains the way to run a whole load (and dump it).
+#
+
+import os
+import sys
+import json
+import argparse
+
+CENSUS_DIR = '/data/2011 Datapacks BCP_IP_TSP_PEP_ECP_WPP_ERP_Release 3'
+DB_NAME = "scratch_census_2011"
+
+# The modules tooling (and worker processes) import for the constants and
+# mappings, and the import time they must stay within
+LIGHT_MODULES = ("census2011", "census2011.__main__", "census2011.shapes", "census2011.selection", "census2011.mappings")
+HEAVY_MODULES = ("sqlalchemy", "openpyxl", "numpy", "ealgis_common.loaders")
+IMPORT_BUDGET_MS = 100
+
+
+def _selection(args):
+    from .selection import LoadSelection
+    return LoadSelection(packages=args.packages, tables=getattr(args, "tables", None), divisions=args.divisions)
+
+
+def _write_report(args):
+    from .instrument import report
+    if args.report:
+        report.write(args.report)
+
+
+def run_shapes(args):
+    from ealgis_common.db import DataLoaderFactory
+    from .shapes import load_shapes
+    factory = DataLoaderFactory(db_name=args.db_name, clean=False)
+    load_shapes(factory, args.census_dir, args.tmpdir, selection=_selection(args))
+    _write_report(args)
+
+
+def run_attrs(args):
+    from ealgis_common.db import DataLoaderFactory
+    from .analysis_views import ANALYSIS_VIEWS
+    from .attrs import load_attrs
+    from .sparse import DENSITY_THRESHOLD
+    # --sparse without a density is None; not given at all, False
+    if args.sparse is None:
+        sparse_threshold = DENSITY_THRESHOLD
+    elif args.sparse is False:
+        sparse_threshold = None
+    else:
+        sparse_threshold = args.sparse
+    factory = DataLoaderFactory(db_name=args.db_name, clean=False)
+    load_attrs(
+        factory, args.census_dir, args.tmpdir,
+        analysis_views=ANALYSIS_VIEWS if args.analysis_views else None, rollup=args.rollup, validate=args.validate,
+        backend=args.ingest_backend, selection=_selection(args), partition_by_state=args.partition_by_state, sparse_threshold=sparse_threshold)
+    _write_report(args)
+
+
+def run_validate(args):
+    from .attrs import PACKAGES, package_schema_name
+    from .dump import make_engine
+    from .validate import validate_schema
+    selection = _selection(args)
+    engine = make_engine(args.db_name)
+    result = {abbrev: validate_schema(engine, package_schema_name(abbrev), selection) for _, abbrev, _, _ in PACKAGES if selection.package(abbrev)}
+    _write_report(args)
+    print(json.dumps(result, indent=2))
+
+
+def run_export(args):
+    from .dump import make_engine
+    from .export import export_parquet
+    written = export_parquet(make_engine(args.db_name), args.export_dir, selection=_selection(args))
+    _write_report(args)
+    print("wrote {} files to {}".format(len(written), args.export_dir))
+
+
+def _run_script(name, script_args):
+    import runpy
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name)
+    sys.argv = [script] + script_args
+    runpy.run_path(script, run_name="__main__")
+
+
+def run_bench(args):
+    _run_script("bench.py", args.bench_args)
+
+
+def run_microbench(args):
+    _run_script("microbench.py", args.microbench_args)
+
+
+def _top_level_imports(code):
+    """
+    Run code in a fresh interpreter with -X importtime.
+
+    Returns ({module: cumulative microseconds} of the imports not nested in another, stdout)
+    """
+    import subprocess
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imports = {}
+    # "import time: self [us] | cumulative | imported package", nested imports indented
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if not name[1:].startswith(" ") and cumulative.strip().isdigit():
+                imports[name.strip()] = int(cumulative)
+    return imports, result.stdout
+
+
+def measure_import(module):
+    """
+    Import module in a fresh interpreter.
+
+    Returns (milliseconds, [HEAVY_MODULES it imported])
+    """
+    startup, _ = _top_level_imports("pass")
+    imports, stdout = _top_level_imports("import sys, {}; print(','.join(m for m in {!r} if m in sys.modules))".format(module, HEAVY_MODULES))
+    microseconds = sum(us for name, us in imports.items() if name not in startup)
+    return microseconds / 1000.0, [m for m in stdout.strip().split(",") if m]
+
+
+def run_importtime(args):
+    failed = False
+    for module in LIGHT_MODULES:
+        milliseconds, heavy = measure_import(module)
+        ok = milliseconds <= args.budget_ms and not heavy
+        failed = failed or not ok
+        print("{:<24} {:8.1f} ms  {}{}".format(module, milliseconds, "ok" if ok else "OVER BUDGET", "" if not heavy else " (imports {})".format(", ".join(heavy))))
+    if failed:
+        raise SystemExit(1)
+
+
+def parse_args(argv=None):
+    from .selection import parse_list
+    parser = argparse.ArgumentParser(prog="python -m census2011", description="Load and check the 2011 Australian Census in EAlGIS")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    def add_common(subparser, tables=True):
+        subparser.add_argument(
+            "--db-name", default=DB_NAME,
+            help="The database to load into or read from")
+        subparser.add_argument(
+            "--packages", type=parse_list, metavar="ABBREV,...",
+            help="Only these packages (e.g. BCP,XCP)")
+        if tables:
+            subparser.add_argument(
+                "--tables", type=parse_list, metavar="TABLE,...",
+                help="Only these table numbers (e.g. b01,b04)")
+        subparser.add_argument(
+            "--divisions", type=parse_list, metavar="DIVISION,...",
+            help="Only these census divisions (e.g. sa2,lga)")
+        subparser.add_argument(
+            "--report",
+            help="Write the run report (JSON) here")
+
+    def add_census(subparser):
+        subparser.add_argument(
+            "--census-dir", default=CENSUS_DIR,
+            help="The extracted census")
+        subparser.add_argument(
+            "--tmpdir", default="/tmp",
+            help="Where to extract and rewrite files")
+
+    shapes = subparsers.add_parser("shapes", help="Load the digital boundaries")
+    add_common(shapes, tables=False)
+    add_census(shapes)
+    shapes.set_defaults(run=run_shapes)
+
+    attrs = subparsers.add_parser("attrs", help="Load the DataPack attribute tables (the shapes must already be loaded)")
+    add_common(attrs)
+    add_census(attrs)
+    attrs.add_argument(
+        "--ingest-backend", choices=["sync", "async"], default="sync",
+        help="How DataPack CSV files are loaded (see recipe.py)")
+    attrs.add_argument(
+        "--partition-by-state", action="store_true",
+        help="Store the sa1, sa2 and ssc attribute tables as partitions by state")
+    attrs.add_argument(
+        "--sparse", nargs="?", type=float, default=False, const=None, metavar="DENSITY",
+        help="Pack the tables with a smaller share of non-zero cells than this (by default sparse.DENSITY_THRESHOLD) behind views")
+    attrs.add_argument(
+        "--analysis-views", action="store_true",
+        help="Build materialised analysis views for the most commonly queried tables")
+    attrs.add_argument(
+        "--rollup", action="store_true",
+        help="Roll count tables up the ASGS main structure")
+    attrs.add_argument(
+        "--validate", action="store_true",
+        help="Check every table's additive identities as it's loaded")
+    attrs.set_defaults(run=run_attrs)
+
+    validate = subparsers.add_parser("validate", help="Check the additive identities of the tables already loaded")
+    add_common(validate)
+    validate.set_defaults(run=run_validate)
+
+    export = subparsers.add_parser("export", help="Export the loaded census as Parquet (requires pyarrow)")
+    export.add_argument(
+        "export_dir",
+        help="Where to write the Parquet files")
+    add_common(export, tables=False)
+    export.set_defaults(run=run_export)
+
+    bench = subparsers.add_parser("bench", help="Run bench.py (its options follow)")
+    bench.add_argument("bench_args", nargs=argparse.REMAINDER)
+    bench.set_defaults(run=run_bench)
+
+    microbench = subparsers.add_parser("microbench", help="Run microbench.py (its subcommand and options follow)")
+    microbench.add_argument("microbench_args", nargs=argparse.REMAINDER)
+    microbench.set_defaults(run=run_microbench)
+
+    importtime = subparsers.add_parser("importtime", help="Check the light modules import within budget")
+    importtime.add_argument(
+        "--budget-ms", type=float, default=IMPORT_BUDGET_MS,
+        help="The import time budget of each module")
+    importtime.set_defaults(run=run_importtime)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#
+# EAlGIS loader: Australian Census 2011; materialised analysis views
+#
+# Denormalised, indexed views joining frequently queried attribute tables
+# to their (simplified) census division geometry, so that dashboard
+# queries become a single index scan instead of an attribute-to-shape join.
+#
+
+import re
+import sqlalchemy
+
+from ealgis_common.util import make_logger
+from .shapes import SHAPE_SCHEMA, SHAPE_GEOMETRY_COLUMN
+from .instrument import stage
+
+logger = make_logger(__name__)
+
+# The most commonly queried (table_number, census_division) pairs in EAlGIS
+ANALYSIS_VIEWS = [
+    (table_number, census_division)
+    for table_number in ("b01", "b02", "b04", "b13")
+    for census_division in ("sa1", "sa2", "lga")
+]
+
+# In the units of the shapes' SRID (degrees for GDA94), roughly 50m
+SIMPLIFY_TOLERANCE = 0.0005
+
+ANALYSIS_VIEW_SUFFIX = "_analysis"
+
+
+def parse_analysis_view(spec):
+    """ Parse a "b01:sa1" style (table_number, census_division) pair. """
+    table_number, census_division = spec.lower().split(":")
+    return table_number, census_division
+
+
+def match_analysis_tables(data_tables, views):
+    """
+    Find the attribute tables for each (table_number, census_division)
+    pair, including every series of tables that were split by series.
+
+    e.g. ("b04", "sa1") -> b04s1_aust_sa1, b04s2_aust_sa1, b04s3_aust_sa1
+    """
+    wanted = set(views)
+    matches = []
+    for table_name in data_tables:
+        m = re.match('^([a-z]+[0-9]+)(s[0-9]{1,2})?_[a-z]+_([a-z0-9]+)$', table_name)
+        if m is None:
+            continue
+        table_number, _, census_division = m.groups()
+        if (table_number, census_division) in wanted:
+            matches.append((table_name, census_division))
+    return matches
+
+
+def analysis_view_name(table_name):
+    return table_name + ANALYSIS_VIEW_SUFFIX
+
+
+def _create_analysis_view(conn, schema, table_name, view_name, census_division, tolerance):
+    params = {"schema": schema, "table": table_name, "view": view_name, "shape_schema": SHAPE_SCHEMA, "division": census_division, "geom": SHAPE_GEOMETRY_COLUMN}
+    conn.execute('DROP MATERIALIZED VIEW IF EXISTS "{schema}"."{view}"'.format(**params))
+    conn.execute(sqlalchemy.text("""
+        CREATE MATERIALIZED VIEW "{schema}"."{view}" AS
+        SELECT a.*, ST_SimplifyPreserveTopology(s."{geom}", :tolerance) AS geom_simplified
+        FROM "{schema}"."{table}" a
+        JOIN "{shape_schema}"."{division}" s ON s.gid = a.gid""".format(**params)), tolerance=tolerance)
+    conn.execute('CREATE UNIQUE INDEX "{view}_gid_idx" ON "{schema}"."{view}" (gid)'.format(**params))
+    conn.execute('CREATE INDEX "{view}_geom_idx" ON "{schema}"."{view}" USING GIST (geom_simplified)'.format(**params))
+    conn.execute('ANALYZE "{schema}"."{view}"'.format(**params))
+    return conn.execute('SELECT count(*) FROM "{schema}"."{view}"'.format(**params)).scalar()
+
+
+def build_analysis_views(loader, data_tables, views=ANALYSIS_VIEWS, tolerance=SIMPLIFY_TOLERANCE):
+    """
+    Create a materialised view for each attribute table matching views,
+    holding every attribute column plus the simplified geometry of its
+    region, with a unique index on gid and a spatial index on the geometry.
+    """
+    schema = loader.dbschema()
+    created = []
+    for table_name, census_division in match_analysis_tables(data_tables, views):
+        view_name = analysis_view_name(table_name)
+        logger.info("creating analysis view %s" % (view_name))
+        with stage("analysis view", table=table_name) as timer, loader.engine.connect() as conn:
+            conn = conn.execution_options(autocommit=True)
+            timer.add(rows=_create_analysis_view(conn, schema, table_name, view_name, census_division, tolerance))
+        created.append(view_name)
+    return created
+
+
+def replace_analysis_view(engine, schema, table_name, census_division, tolerance=SIMPLIFY_TOLERANCE):
+    """
+    Rebuild the analysis view of a table whose data has been replaced (see
+    reload.py). The new view is built alongside the existing one, which
+    keeps serving queries until the two are swapped by renaming them in a
+    single short transaction.
+    """
+    view_name = analysis_view_name(table_name)
+    new_name = view_name + "__new"
+    logger.info("replacing analysis view %s" % (view_name))
+    with stage("analysis view", table=table_name) as timer:
+        with engine.connect() as conn:
+            timer.add(rows=_create_analysis_view(conn.execution_options(autocommit=True), schema, table_name, new_name, census_division, tolerance))
+        with engine.begin() as conn:
+            params = {"schema": schema, "view": view_name, "new": new_name}
+            conn.execute('DROP MATERIALIZED VIEW IF EXISTS "{schema}"."{view}"'.format(**params))
+            conn.execute('ALTER MATERIALIZED VIEW "{schema}"."{new}" RENAME TO "{view}"'.format(**params))
+            for suffix in ("_gid_idx", "_geom_idx"):
+                conn.execute('ALTER INDEX "{schema}"."{new}{suffix}" RENAME TO "{view}{suffix}"'.format(suffix=suffix, **params))
+    return view_name
+
+
+def refresh_analysis_views(engine, schema, view_names):
+    """
+    Refresh analysis views without blocking readers (their unique gid
+    index is what allows REFRESH ... CONCURRENTLY).
+    """
+    with engine.connect() as conn:
+        conn = conn.execution_options(autocommit=True)
+        for view_name in view_names:
+            logger.info("refreshing analysis view %s" % (view_name))
+            conn.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY "{}"."{}"'.format(schema, view_name))
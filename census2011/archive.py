@@ -0,0 +1,304 @@
+#
+# EAlGIS loader: Australian Census 2011; census sources
+#
+# The loaders find their input files through a source:
+#
+#   DirectorySource: the census, already extracted to a directory
+#   ArchiveSource: the census release .7z, from which only the members a
+#     run needs are extracted, in the background, as the run goes. The
+#     loaders wait for each member as they reach it (so loading starts as
+#     soon as the first members are out) and release members once loaded.
+#     Members are extracted to a staging directory, not to the census
+#     directory, so that a partial extraction is never mistaken for an
+#     extracted census.
+#
+# Both work in terms of the paths the census would have if extracted, e.g.
+#   source.glob("/data/<release>/Digital Boundaries/*.zip")
+#   path = source.wait("/data/<release>/Digital Boundaries/2011_SA1_shape.zip")
+#
+# and wait() returns the path to read the file from once it's available.
+#
+# Extracting from an archive is bounded: the members every load needs
+# before it starts (the metadata workbooks and boundary zips, start()'s
+# first) are extracted by a 7z run of their own, then the rest (the
+# DataPack CSV files) in a second run, which is paused (7z is stopped,
+# SIGSTOP) while MAX_OUTSTANDING of its members are out and haven't been
+# released, and resumed as they are. 7z can only extract in archive
+# order, so the loaders take their packages and tables in the order
+# ordered() gives (archive order), each released as soon as it's loaded.
+# A loader waiting for a member further on resumes extraction regardless
+# (extracting everything in between), so a loader holding on to members
+# can never deadlock the run; taking members in order, that's only ever
+# the few CSV files of the table being merged.
+#
+
+import os
+import glob
+import fnmatch
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+
+from ealgis_common.util import make_logger
+
+logger = make_logger(__name__)
+
+SEVEN_ZIP = "7zr"
+
+# Extracted members not yet released after which extraction is paused
+MAX_OUTSTANDING = 16
+
+
+class DirectorySource:
+    """ A census that has already been extracted to a directory. """
+
+    def __init__(self, census_dir):
+        self.census_dir = census_dir
+
+    def listdir(self, path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path))
+
+    def glob(self, pattern):
+        return sorted(glob.glob(pattern))
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def ordered(self, items, key=lambda item: item):
+        """ items, each with a path key(item); an extracted census can be loaded in any order. """
+        return list(items)
+
+    def wait(self, path):
+        return path
+
+    def release(self, path):
+        pass
+
+    def close(self):
+        pass
+
+
+def _split(path):
+    return [part for part in path.split("/") if part]
+
+
+def _glob_match(pattern, path):
+    """ glob.glob semantics: * and ? match within a single path component. """
+    pattern_parts, path_parts = _split(pattern), _split(path)
+    return len(pattern_parts) == len(path_parts) and all(
+        fnmatch.fnmatchcase(part, pattern_part) for part, pattern_part in zip(path_parts, pattern_parts))
+
+
+def list_archive(archive_path, seven_zip=SEVEN_ZIP):
+    """ The (relative) paths of the files in a 7z archive. """
+    output = subprocess.check_output([seven_zip, "l", "-slt", archive_path], universal_newlines=True)
+    members = []
+    # Technical listing: a "Path = " line starts each entry's block, the
+    # first block describing the archive itself
+    for block in output.split("\n\n"):
+        fields = dict(line.split(" = ", 1) for line in block.splitlines() if " = " in line)
+        if "Path" not in fields or "Size" not in fields:
+            continue
+        if fields.get("Folder") == "+" or "D" in fields.get("Attributes", "").split(" ")[0]:
+            continue
+        members.append(fields["Path"].replace("\\", "/"))
+    return members
+
+
+class ArchiveSource:
+    """
+    A census release archive, extracted member by member to a staging
+    directory (extract_dir) as it is loaded. Members are addressed by the
+    paths they'd have if the archive were extracted next to census_dir;
+    wait() returns where they actually are.
+    """
+
+    def __init__(self, archive_path, census_dir, extract_dir, seven_zip=SEVEN_ZIP, max_outstanding=MAX_OUTSTANDING):
+        self.archive_path = archive_path
+        self.census_dir = census_dir
+        self.extract_dir = extract_dir
+        self.seven_zip = seven_zip
+        self.max_outstanding = max_outstanding
+        self._root = os.path.dirname(os.path.normpath(census_dir))
+        self.members = [self._virtual(member) for member in list_archive(archive_path, seven_zip)]
+        self._positions = {path: i for i, path in enumerate(self.members)}
+        self._passes = []
+        self._wanted = set()
+        self._throttled = set()
+        self._extracted = set()
+        self._outstanding = set()
+        self._paused = False
+        self._closing = False
+        self._finished = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._process = None
+
+    def _virtual(self, member):
+        return os.path.normpath(os.path.join(self._root, member))
+
+    def _actual(self, path):
+        return os.path.join(self.extract_dir, os.path.relpath(path, self._root))
+
+    def _pause(self):
+        # Called with self._cond held
+        if not self._paused and not self._finished:
+            os.kill(self._process.pid, signal.SIGSTOP)
+            self._paused = True
+
+    def _resume(self):
+        # Called with self._cond held
+        if self._paused:
+            self._paused = False
+            if not self._finished:
+                os.kill(self._process.pid, signal.SIGCONT)
+
+    def start(self, wanted, first=None):
+        """
+        Begin extracting the members for which wanted(path) is true, in
+        the order they're stored in the archive: those for which
+        first(path) is true before the rest, which are throttled.
+        """
+        paths = [path for path in self.members if wanted(path)]
+        first = first or (lambda path: False)
+        self._passes = [ps for ps in ([path for path in paths if first(path)], [path for path in paths if not first(path)]) if ps]
+        self._wanted = set(paths)
+        self._throttled = set(self._passes[-1]) if len(self._passes) > 1 else set()
+        self._positions = {path: i for i, path in enumerate(p for ps in self._passes for p in ps)}
+        logger.info("extracting %d of %d members of %s to %s" % (len(paths), len(self.members), self.archive_path, self.extract_dir))
+        self._thread = threading.Thread(target=self._follow, daemon=True)
+        self._thread.start()
+        return self
+
+    def _extract(self, number, paths):
+        list_path = os.path.join(self.extract_dir, ".members-{}.lst".format(number))
+        with open(list_path, "w") as f:
+            for path in paths:
+                f.write(os.path.relpath(path, self._root) + "\n")
+        return subprocess.Popen(
+            [self.seven_zip, "x", "-y", "-bb1", "-o" + self.extract_dir, self.archive_path, "@" + list_path],
+            stdout=subprocess.PIPE, universal_newlines=True)
+
+    def _extracted_member(self, path):
+        # Called with self._cond held
+        self._extracted.add(path)
+        if path in self._throttled:
+            self._outstanding.add(path)
+            if len(self._outstanding) >= self.max_outstanding:
+                self._pause()
+
+    def _follow(self):
+        for number, paths in enumerate(self._passes):
+            with self._cond:
+                if self._closing:
+                    break
+                self._process = self._extract(number, paths)
+            # With -bb1, 7z names each file as it starts extracting it, so a
+            # file is complete once the next one is named (or 7z exits)
+            current = None
+            for line in self._process.stdout:
+                if not line.startswith("- "):
+                    continue
+                path = self._virtual(line[2:].rstrip("\n").replace("\\", "/"))
+                with self._cond:
+                    if current is not None:
+                        self._extracted_member(current)
+                    current = path
+                    self._cond.notify_all()
+            returncode = self._process.wait()
+            with self._cond:
+                if returncode != 0:
+                    self._error = "{} exited with status {}".format(self.seven_zip, returncode)
+                    break
+                for path in paths:
+                    if path not in self._extracted:
+                        self._extracted_member(path)
+                self._cond.notify_all()
+        with self._cond:
+            self._finished = True
+            self._paused = False
+            self._cond.notify_all()
+
+    def listdir(self, path):
+        prefix = os.path.normpath(path) + "/"
+        children = set()
+        for member in self.members:
+            if member.startswith(prefix):
+                children.add(prefix + member[len(prefix):].split("/", 1)[0])
+        return sorted(children)
+
+    def glob(self, pattern):
+        return sorted(member for member in self.members if _glob_match(os.path.normpath(pattern), member))
+
+    def exists(self, path):
+        path = os.path.normpath(path)
+        prefix = path + "/"
+        return any(member == path or member.startswith(prefix) for member in self.members)
+
+    def ordered(self, items, key=lambda item: item):
+        """
+        items in the order they'll be extracted, each by the position of
+        its path key(item): a member, or a directory of members (by the
+        first of them).
+        """
+        def position(item):
+            path = os.path.normpath(key(item))
+            if path in self._positions:
+                return self._positions[path]
+            prefix = path + "/"
+            return min((i for member, i in self._positions.items() if member.startswith(prefix)), default=len(self._positions))
+        return sorted(items, key=position)
+
+    def wait(self, path):
+        """ Block until the member at path has been extracted, returning where it was extracted to. """
+        path = os.path.normpath(path)
+        if path not in self._wanted:
+            raise Exception("{} is not being extracted from {}".format(path, self.archive_path))
+        with self._cond:
+            while path not in self._extracted:
+                if self._finished:
+                    raise Exception("failed to extract {}: {}".format(path, self._error))
+                # The members out are still held: needing this one, carry on past the limit
+                self._resume()
+                self._cond.wait()
+        return self._actual(path)
+
+    def release(self, path):
+        """ Delete an extracted member (given the path wait() returned) once it has been loaded. """
+        path = os.path.normpath(path)
+        if not path.startswith(self.extract_dir + "/"):
+            return
+        if os.path.exists(path):
+            os.remove(path)
+        with self._cond:
+            self._outstanding.discard(self._virtual(os.path.relpath(path, self.extract_dir)))
+            if len(self._outstanding) < self.max_outstanding:
+                self._resume()
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            if self._process is not None and self._process.poll() is None:
+                self._resume()
+                self._process.terminate()
+        if self._thread is not None:
+            self._thread.join()
+        shutil.rmtree(self.extract_dir, ignore_errors=True)
+
+
+def open_census(census_dir, archive_path=None, wanted=None, tmpdir=None, first=None):
+    """
+    The source for census_dir: the directory itself if it exists, otherwise
+    archive_path (holding census_dir's basename at its top level), from
+    which the members for which wanted(path) is true are extracted to a
+    staging directory under tmpdir, removed again on close(). Members for
+    which first(path) is true are extracted before the rest (see start()).
+    """
+    if os.path.isdir(census_dir) or archive_path is None:
+        return DirectorySource(census_dir)
+    extract_dir = tempfile.mkdtemp(prefix="census2011-", dir=tmpdir)
+    source = ArchiveSource(archive_path, census_dir, extract_dir)
+    return source.start(wanted or (lambda path: True), first)
@@ -0,0 +1,175 @@
+#
+# EAlGIS loader: Australian Census 2011; asyncio ingestion backend
+#
+# An alternative to RewrittenCSV + CSVLoader for load_datapacks (selected
+# with backend="async") which overlaps CSV parsing with loading: parsing
+# and rewriting runs on a thread pool, while a pool of asyncpg connections
+# creates each table and COPYs its rewritten CSV file in. The two sides are
+# joined by a bounded queue of rewritten files, so parsing never runs more
+# than a few tables ahead of the database, and rows are streamed through
+# (never held in memory a table at a time) on both sides. The jobs can be
+# a generator doing work of its own (load_datapacks merges and scans each
+# table's CSV files as it's reached): it's advanced on the thread pool, a
+# job at a time, and each job's CSV file is released once it's rewritten.
+#
+# Tables are created with the column types inferred by the CSV scanner:
+#   gid integer PRIMARY KEY, region_id text, then a bigint column for every
+#   column holding only whole numbers and a double precision column for
+#   the rest (see csvscan.py). The first column is the primary key.
+#
+# asyncpg is only required to use this backend.
+#
+
+import os
+import csv
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ealgis_common.util import make_logger
+from .instrument import report, stage, file_size
+
+logger = make_logger(__name__)
+
+# asyncpg connections streaming COPY data
+COPY_CONNECTIONS = 4
+# Threads parsing and rewriting CSV files
+PARSE_WORKERS = 2
+# Rewritten tables waiting to be copied (the back-pressure bound)
+QUEUE_SIZE = 4
+
+
+def rewrite_table(csv_path, matcher, out_path):
+    """
+    Write the rows of a DataPack CSV file through a RewrittenCSV style
+    matcher (matcher(line, row) -> row) to out_path, without its header,
+    a row at a time. None (not applicable) is written as an empty field.
+
+    Returns (header, rows written).
+    """
+    header = None
+    rows = 0
+    with open(csv_path, "r", newline="") as f, open(out_path, "w", newline="") as out:
+        writer = csv.writer(out)
+        for line, row in enumerate(csv.reader(f)):
+            if matcher is not None:
+                row = matcher(line, row)
+            if line == 0:
+                header = [c.lower() for c in row]
+            else:
+                writer.writerow(row)
+                rows += 1
+    return header, rows
+
+
+def create_table_sql(schema, table_name, header, types):
+    columns = ", ".join('"{}" {}'.format(name, column_type) for name, column_type in zip(header, types))
+    return 'DROP TABLE IF EXISTS "{schema}"."{table}"; CREATE TABLE "{schema}"."{table}" ({columns}, PRIMARY KEY ("{pkey}"))'.format(
+        schema=schema, table=table_name, columns=columns, pkey=header[0])
+
+
+def _connect_kwargs(engine):
+    url = engine.url
+    return {
+        "user": url.username,
+        "password": url.password,
+        "host": url.host,
+        "port": url.port or 5432,
+        "database": url.database,
+    }
+
+
+async def _ingest(engine, schema, jobs, tmpdir, release, parent, connections, parse_workers, queue_size):
+    import asyncpg
+
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    pending = iter(jobs)
+    pending_lock = threading.Lock()
+    loaded = []
+    totals = {"rows": 0}
+
+    def parse(job):
+        table_name, csv_path, matcher, types = job
+        out_path = os.path.join(tmpdir, "{}.copy.csv".format(table_name))
+        with report.attach(parent), stage("rewrite", table=table_name, bytes=file_size(csv_path)) as timer:
+            header, rows = rewrite_table(csv_path, matcher, out_path)
+            timer.add(rows=rows)
+        if release is not None:
+            release(csv_path)
+        # Without types (from the CSV scanner), every column is loaded as text
+        return table_name, header, types or ["text"] * len(header), out_path, rows
+
+    def next_job():
+        with pending_lock, report.attach(parent):
+            return next(pending, None)
+
+    async def produce(executor):
+        while True:
+            job = await loop.run_in_executor(executor, next_job)
+            if job is None:
+                return
+            await queue.put(await loop.run_in_executor(executor, parse, job))
+
+    async def consume(pool):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            table_name, header, types, out_path, rows = item
+            started = time.perf_counter()
+            try:
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        await conn.execute(create_table_sql(schema, table_name, header, types))
+                        result = await conn.copy_to_table(table_name, source=out_path, columns=header, schema_name=schema, format="csv", null="")
+            finally:
+                os.remove(out_path)
+            logger.info("%s: %s (%d rows in %.2fs)" % (table_name, result, rows, time.perf_counter() - started))
+            totals["rows"] += rows
+            loaded.append(table_name)
+
+    with ThreadPoolExecutor(max_workers=parse_workers) as executor:
+        async with asyncpg.create_pool(min_size=connections, max_size=connections, **_connect_kwargs(engine)) as pool:
+            async def produce_all():
+                await asyncio.gather(*[produce(executor) for _ in range(parse_workers)])
+                for _ in range(connections):
+                    await queue.put(None)
+
+            tasks = [asyncio.ensure_future(produce_all())] + [asyncio.ensure_future(consume(pool)) for _ in range(connections)]
+            try:
+                await asyncio.gather(*tasks)
+            except Exception:
+                # Don't leave producers blocked on a queue nobody is reading
+                for task in tasks:
+                    task.cancel()
+                raise
+    return loaded, totals["rows"]
+
+
+def ingest_datapacks(loader, jobs, tmpdir, release=None, connections=COPY_CONNECTIONS, parse_workers=PARSE_WORKERS, queue_size=QUEUE_SIZE):
+    """
+    Load each (table_name, csv_path, matcher, column types) job into the
+    loader's schema, writing the rewritten CSV files to tmpdir, and
+    register the tables with the loader (as CSVLoader does).
+
+    jobs: any iterable, taken a job at a time as the backend is ready
+    release: optional release(csv_path), called once a job's CSV file has
+        been rewritten and isn't needed any more
+
+    Returns -
+    table_infos[table_name] = the loader's table_info of each table loaded
+    """
+    # Parsing is reported alongside (not within) the copy stage, as with the sync backend
+    parent = report.current()
+    with stage("copy") as timer:
+        loop = asyncio.new_event_loop()
+        try:
+            loaded, rows = loop.run_until_complete(
+                _ingest(loader.engine, loader.dbschema(), jobs, tmpdir, release, parent, connections, parse_workers, queue_size))
+        finally:
+            loop.close()
+        timer.add(rows=rows)
+    # On this thread, as the loader's session isn't shared with the workers
+    return {table_name: loader.register_table(table_name) for table_name in loaded}
@@ -6,19 +6,32 @@
 
 import re
 import os
-import glob
 import os.path
 import openpyxl
 import sqlalchemy
-import csv
-import json
 from datetime import datetime
 from collections import OrderedDict
+from contextlib import ExitStack
 
 from ealgis_common.loaders import RewrittenCSV, CSVLoader
-from ealgis_common.util import alistdir, make_logger
+from ealgis_common.util import make_logger
 from .shapes import SHAPE_LINKAGE, SHAPE_SCHEMA
 from .attrs_repair import repair_census_metadata, repair_column_series_census_metadata
+from .instrument import stage, file_size, report
+from .analysis_views import build_analysis_views
+from .linkage import add_geolinkages, index_gid_columns
+from .rollup import rollup_tables
+from .partition import PARTITIONED_DIVISIONS, partition_tables_by_state
+from .sparse import store_tables
+from .validate import validate_tables
+from .search import build_column_search_index
+from .concordance import build_concordance
+from .mappings import get_metadata_mapping, get_topic_to_table_mapping
+from .async_ingest import ingest_datapacks
+from .csvscan import scan_csv, write_merged_csv
+from .stats import summarise_columns
+from .archive import DirectorySource
+from .selection import ALL
 
 logger = make_logger(__name__)
 
@@ -108,7 +121,7 @@ def parseColumnMetadata(table_number, column_name, metadata):
     return metadata
 
 
-def load_metadata_table_serises(loader, census_dir, xlsx_name):
+def load_metadata_table_serises(loader, census_dir, xlsx_name, source=None):
     """
     Parse Census metadata to extract the serises in each table.
 
@@ -128,66 +141,78 @@ def load_metadata_table_serises(loader, census_dir, xlsx_name):
     col_meta = {}
     col_mapping = {}
 
-    fname = os.path.join(census_dir + '/Metadata/', xlsx_name)
+    fname = (source or DirectorySource(census_dir)).wait(os.path.join(census_dir + '/Metadata/', xlsx_name))
     logger.info("parsing metadata: %s" % (fname))
-    wb = openpyxl.load_workbook(fname, read_only=True)
-
-    def sheet_data(sheet):
-        return (
-            [t.value for t in r]
-            for r in sheet.iter_rows()
-            if len(r) > 0 and r[0].value is not None)
+    with stage("metadata parse", table=xlsx_name, bytes=file_size(fname)) as timer:
+        wb = openpyxl.load_workbook(fname, read_only=True)
+
+        def sheet_data(sheet):
+            return (
+                [t.value for t in r]
+                for r in sheet.iter_rows()
+                if len(r) > 0 and r[0].value is not None)
+
+        def skip_to_descriptors(it):
+            for row in sheet_iter:
+                if row[0] != "Sequential":
+                    next(it)
+                else:
+                    break
 
-    def skip_to_descriptors(it):
+        sheet_iter = sheet_data(wb.worksheets[1])
+        skip_to_descriptors(sheet_iter)
         for row in sheet_iter:
-            if row[0] != "Sequential":
-                next(it)
-            else:
-                break
-
-    sheet_iter = sheet_data(wb.worksheets[1])
-    skip_to_descriptors(sheet_iter)
-    for row in sheet_iter:
-        name = row[0]
-        if not name:
-            continue
-        name = name.lower()
-        column_name, short_name, long_name, datapack_file, profile_table, column_heading = row[0:6]
+            name = row[0]
+            if not name:
+                continue
+            timer.add(rows=1)
+            name = name.lower()
+            column_name, short_name, long_name, datapack_file, profile_table, column_heading = row[0:6]
 
-        m = re.match('^([A-Za-z]+[0-9]+)([a-z]+)?$', datapack_file.lower())
-        table_number = m.groups()[0]  # b46a -> b46
+            m = re.match('^([A-Za-z]+[0-9]+)([a-z]+)?$', datapack_file.lower())
+            table_number = m.groups()[0]  # b46a -> b46
 
-        column_heading = repair_column_series_census_metadata(table_number, column_name.lower(), str(column_heading).strip())
-        seriseName = getSeriesName(column_heading)
+            column_heading = repair_column_series_census_metadata(table_number, column_name.lower(), str(column_heading).strip())
+            seriseName = getSeriesName(column_heading)
 
-        col_mapping[(table_number.lower(), column_name.lower())] = column_name
+            col_mapping[(table_number.lower(), column_name.lower())] = column_name
 
-        if seriseName is not None:
-            if table_number not in col_meta:
-                col_meta[table_number] = {}
+            if seriseName is not None:
+                if table_number not in col_meta:
+                    col_meta[table_number] = {}
 
-            if seriseName not in col_meta[table_number]:
-                col_meta[table_number][seriseName] = {
-                    "columns": [],
-                    "datapackNames": [],
-                }
+                if seriseName not in col_meta[table_number]:
+                    col_meta[table_number][seriseName] = {
+                        "columns": [],
+                        "datapackNames": [],
+                    }
 
-            col_meta[table_number][seriseName]["columns"].append(column_name)
+                col_meta[table_number][seriseName]["columns"].append(column_name)
 
-            if datapack_file.lower() not in col_meta[table_number][seriseName]["datapackNames"]:
-                col_meta[table_number][seriseName]["datapackNames"].append(datapack_file.lower())
-    del wb
+                if datapack_file.lower() not in col_meta[table_number][seriseName]["datapackNames"]:
+                    col_meta[table_number][seriseName]["datapackNames"].append(datapack_file.lower())
+        del wb
 
     return col_meta, col_mapping
 
 
-def load_metadata(loader, census_dir, xlsx_name, data_tables, columns_by_series, not_applicable_columns):
+def load_metadata(loader, census_dir, xlsx_name, data_tables, columns_by_series, not_applicable_columns, source=None, column_stats=None):
+    """
+    Parse the DataPack metadata and register the table and column
+    metadata for each of data_tables.
+
+    column_stats: optional column_stats[table_name][column_name] summary
+        statistics (see stats.py), registered as each column's "stats"
+
+    Returns -
+    registered[table_name] = (table metadata, [(column_name, column metadata)])
+    """
     table_meta = {}
     col_meta = {}
+    registered = OrderedDict()
 
-    fname = os.path.join(census_dir + '/Metadata/', xlsx_name)
+    fname = (source or DirectorySource(census_dir)).wait(os.path.join(census_dir + '/Metadata/', xlsx_name))
     logger.info("parsing metadata: %s" % (fname))
-    wb = openpyxl.load_workbook(fname, read_only=True)
 
     def sheet_data(sheet):
         return (
@@ -206,65 +231,49 @@ def load_metadata(loader, census_dir, xlsx_name, data_tables, columns_by_series,
             else:
                 break
 
-    def get_metadata_mapping():
-        files = {}
-        for json_file in glob.glob(os.path.join("./", "census2011", "*_metadata_mapping.json")):
-            with open(json_file, "r") as f:
-                files = {**files, **json.load(f)["tables"]}
-        return files
+    with stage("metadata parse", table=xlsx_name, bytes=file_size(fname)) as timer:
+        wb = openpyxl.load_workbook(fname, read_only=True)
+        sheet_iter = sheet_data(wb.worksheets[0])
+        skip(sheet_iter, 2)
+        for row in sheet_iter:
+            name = row[0]
+            if not name:
+                continue
+            name = name.lower()
+            table_meta[name] = {'type': row[1].strip(), 'kind': row[2].strip() if row[2] is not None else ""}
 
-    def get_topic_to_table_mapping():
-        mapping = {}
-        for json_file in glob.glob(os.path.join("./", "census2011", "*_topic_mapping.json")):
-            with open(json_file, "r") as f:
-                for topic_name, tables in json.load(f).items():
-                    for table_number in tables:
-                        table_number = table_number.upper()
-                        if table_number not in mapping:
-                            mapping[table_number] = []
-                        mapping[table_number].append(topic_name)
-        return mapping
-
-    sheet_iter = sheet_data(wb.worksheets[0])
-    skip(sheet_iter, 2)
-    for row in sheet_iter:
-        name = row[0]
-        if not name:
-            continue
-        name = name.lower()
-        table_meta[name] = {'type': row[1].strip(), 'kind': row[2].strip() if row[2] is not None else ""}
-
-    sheet_iter = sheet_data(wb.worksheets[1])
-    skip_to_descriptors(sheet_iter)
-    for row in sheet_iter:
-        name = row[0]
-        if not name:
-            continue
-        name = name.lower()
-        short_name, long_name, datapack_file, profile_table, column_heading = row[1:6]
-        datapack_file = datapack_file.lower()
-        m = re.match('^([A-Za-z]+[0-9]+)([a-z]+)?$', datapack_file)
-        table_number = m.groups()[0]  # b46a -> b46
-        if table_number not in col_meta:
-            col_meta[table_number] = []
-
-        try:
-            meta = parseColumnMetadata(
-                table_number,
-                name,
-                {'type': str(row[2]).strip(), 'kind': str(row[5]).strip()}
-            )
-
-            if name.lower() in not_applicable_columns:
-                meta["na"] = True
-
-            col_meta[table_number].append((name, meta))
-        except Exception as e:
-            if "object has no attribute" in str(e):
-                print(name)
-                raise e
-            logger.error(e)
-    del wb
+        sheet_iter = sheet_data(wb.worksheets[1])
+        skip_to_descriptors(sheet_iter)
+        for row in sheet_iter:
+            name = row[0]
+            if not name:
+                continue
+            name = name.lower()
+            short_name, long_name, datapack_file, profile_table, column_heading = row[1:6]
+            datapack_file = datapack_file.lower()
+            m = re.match('^([A-Za-z]+[0-9]+)([a-z]+)?$', datapack_file)
+            table_number = m.groups()[0]  # b46a -> b46
+            if table_number not in col_meta:
+                col_meta[table_number] = []
+
+            try:
+                meta = parseColumnMetadata(
+                    table_number,
+                    name,
+                    {'type': str(row[2]).strip(), 'kind': str(row[5]).strip()}
+                )
+
+                if name.lower() in not_applicable_columns:
+                    meta["na"] = True
+
+                col_meta[table_number].append((name, meta))
+                timer.add(rows=1)
+            except Exception as e:
+                if "object has no attribute" in str(e):
+                    print(name)
+                    raise e
+                logger.error(e)
+        del wb
 
     metadata_mapping = get_metadata_mapping()
     topic_to_table_mapping = get_topic_to_table_mapping()
@@ -347,30 +356,140 @@ def load_metadata(loader, census_dir, xlsx_name, data_tables, columns_by_series,
 
         # print("#### columns for series '{}'".format(meta["series"]), len(columns))
 
-        loader.set_table_metadata(table_name, meta)
-        loader.register_columns(table_name, columns)
+        table_stats = (column_stats or {}).get(table_name)
+        if table_stats:
+            columns = [(col_name, dict(col, stats=table_stats[col_name]) if col_name in table_stats else col) for col_name, col in columns]
+
+        with stage("metadata register", table=table_name, rows=len(columns)):
+            loader.set_table_metadata(table_name, meta)
+            loader.register_columns(table_name, columns)
+        registered[table_name] = (meta, columns)
+
+    return registered
+
+
+NotApplicableString = ".."
+
+
+def handleNotApplicableCells(value):
+    """
+    Set cells that are 'Not Applicable' in the source data to None
+    (NULL in PostgreSQL).
+
+    e.g. G23 has a row that refers to people who migrated to
+    Australia before 2000, and a column that describes people who 
+    are 14 years or younger. i.e. An impossibility.
+
+    In the Census these are represented by the string ".."
+
+    Columns in which every cell is not applicable are detected when
+    each CSV file is scanned (see scan_datapack_csv).
+
+    value (string): The value of a cell in a CSV file.
+
+    Returns:
+        value (string or None)
+    """
+    return None if value == NotApplicableString else value
+
+
+def make_gid_matcher(col_mapping, table_number, census_division, lookup):
+    """
+    The RewrittenCSV row function of a DataPack CSV file: the header is
+    rewritten to the database column names, and each row gains the gid of
+    its region.
+
+    col_mapping: Map from ("G11", "Tot_P_M") (in the CSV header) to "G100" (in the database)
+    lookup: lookup[region_id] = gid, for census_division (see build_geo_gid_mapping)
+    """
+    def _matcher(line, row):
+        if line == 0:
+            # Rewrite the header
+            return ["gid", "region_id"] + [col_mapping[(table_number, v.lower())] for v in row[1:]]
+        else:
+            # Data rows
+            if row[0] in lookup:
+                return [str(lookup[row[0]])] + [row[0]] + [handleNotApplicableCells(v) for v in row[1:]]
+            else:
+                # Fail dramatically if any missing gids have made it this far
+                raise Exception("failed gid lookup for '%s' for '%s'" % (row[0], census_division))
+    return _matcher
+
+
+def split_datapack_csv_by_series(columns_by_series, table_name, csv_path, abbrev):
+    """
+    Split a DataPack CSV file (or several merged, see write_merged_csv)
+    into a CSV file per series of its table, by gathering each series'
+    columns from the scanned file.
+
+    Returns the paths of the series CSV files, in series order.
+    """
+    csv_files = []
+
+    with scan_csv(csv_path) as scan:
+        column_index = {name: i for i, name in enumerate(scan.header)}
+        for key, series_name in enumerate(columns_by_series[table_name]):
+            with stage("split", table="{}_{}".format(table_name, os.path.basename(csv_path).split('_')[3].lower()), bytes=file_size(csv_path)) as timer:
+                series_csv_path = csv_path.replace(table_name.upper(), "{}S{}".format(table_name.upper(), key + 1))
+                if not series_csv_path.endswith(".tmp.csv"):
+                    series_csv_path = series_csv_path.replace(".csv", ".tmp.csv")
+
+                # Columns missing from the CSV file are written out empty
+                fieldnames = ["region_id"] + columns_by_series[table_name][series_name]["columns"]
+                with open(series_csv_path, "wb") as f:
+                    scan.write_columns(f, [column_index.get(name) for name in fieldnames], header=fieldnames)
+                timer.add(rows=scan.rows)
+
+                logger.info("%s-%s: Created CSV file for series '%s' - %s" % (abbrev, table_name.upper(), series_name, os.path.basename(series_csv_path)))
+                csv_files.append(series_csv_path)
 
+    return csv_files
 
-def load_datapacks(loader, census_dir, tmpdir, packname, abbrev, geo_gid_mapping, columns_by_series, col_mapping):
+
+def load_datapacks(loader, census_dir, tmpdir, packname, abbrev, geo_gid_mapping, columns_by_series, col_mapping, backend="sync", source=None, selection=ALL, partition_by_state=False, sparse_threshold=None):
+    """
+    Load every DataPack CSV file of a package into its own attribute table.
+
+    backend: "sync" rewrites each CSV file and loads it with CSVLoader, one
+        table at a time; "async" overlaps parsing with COPYs over a pool of
+        connections (see async_ingest.py)
+    source: where to find the CSV files (see archive.py), by default
+        census_dir itself
+    selection: the table numbers and census divisions to load (see
+        selection.py)
+    partition_by_state: store the sa1, sa2 and ssc tables as partitions by
+        state (see partition.py)
+    sparse_threshold: pack the tables with a smaller share of non-zero
+        cells than this, and drop the columns without any values from the
+        others, behind views (see sparse.py)
+
+    Returns -
+    (data_tables, not_applicable_columns, column_stats) where
+    column_stats[table_name][column_name] summarises each column (see
+    stats.py)
+    """
     def get_csv_files():
         files = []
-        for geography in alistdir(d):
-            # if "/SA3" in geography or "/SA1" in geography or "/LGA" in geography:
+        for geography in source.listdir(d):
+            if not selection.division(os.path.basename(geography)):
+                continue
             logger.info("%s: Geograpy - %s" % (abbrev, geography))
 
             g = os.path.join(geography, "*.csv")
-            csv_files = glob.glob(g)
+            csv_files = source.glob(g)
             if len(csv_files) == 0:
                 g = os.path.join(geography, "AUST", "*.csv")
-                csv_files = glob.glob(g)
+                csv_files = source.glob(g)
             if len(csv_files) == 0:
                 raise Exception("can't find CSV files for `%s'" % geography)
             files += csv_files
         return files
 
     def get_csv_files_by_geography_and_table():
-        csv_files = get_csv_files()
-        by_table = {}
+        # In the order the source extracts them (see archive.py), as each
+        # table is loaded (and released) before the next is merged
+        csv_files = source.ordered(get_csv_files())
+        by_table = OrderedDict()
 
         for i, csv_path in enumerate(csv_files):
             if csv_path.endswith(".tmp.csv"):
@@ -381,296 +500,201 @@ def load_datapacks(loader, census_dir, tmpdir, packname, abbrev, geo_gid_mapping
             m = re.match('^([A-Za-z]+[0-9]+)([a-z]+)?_.+$', datapack_file)
             table_number = m.groups()[0]
             geography_name = filename.split('_')[3].lower()
+            if not selection.table(table_number) or not selection.division(geography_name):
+                continue
 
             if geography_name not in by_table:
-                by_table[geography_name] = {}
+                by_table[geography_name] = OrderedDict()
             if table_number not in by_table[geography_name]:
                 by_table[geography_name][table_number] = []
             by_table[geography_name][table_number].append(csv_path)
         return by_table
 
-    def split_datapack_csv_by_series(columns_by_series, table_name, csv_path):
-        csv_files = []
-
-        for key, series_name in enumerate(columns_by_series[table_name]):
-            with open(csv_path, "r") as merged_csv_file:
-                # Open a new reader for each series as a means of resetting the pointer to the start of the file
-                reader = csv.DictReader(merged_csv_file)
-
-                series_csv_path = csv_path.replace(table_name.upper(), "{}S{}".format(table_name.upper(), key + 1))
-                if not series_csv_path.endswith(".tmp.csv"):
-                    series_csv_path = series_csv_path.replace(".csv", ".tmp.csv")
-
-                # https://stackoverflow.com/a/39923823/7368493
-                fieldnames = ["region_id"] + columns_by_series[table_name][series_name]["columns"]
-                fieldnames_set = set(fieldnames)
-                # logger.info("Fieldnames ({}): {}".format(len(fieldnames), fieldnames))
-
-                with open(series_csv_path, "w") as f:
-                    writer = csv.DictWriter(f, fieldnames)
-                    writer.writeheader()
-
-                    for row in reader:
-                        # Use a dictionary comprehension to iterate over the key, value pairs
-                        # discarding those pairs whose key is not in the set
-                        filtered_row = dict(
-                            (k, v) for k, v in row.items() if k in fieldnames_set
-                        )
-                        writer.writerow(filtered_row)
-
-                logger.info("%s-%s: Created CSV file for series '%s' - %s" % (abbrev, table_name.upper(), series_name, os.path.basename(series_csv_path)))
-                csv_files.append(series_csv_path)
-        del reader
-
-        return csv_files
-
-    def split_datapack_csvs_by_series(columns_by_series, table_name, csv_paths):
-        csv_files = []
-
-        # logger.info("Start opening: {}".format(csv_path))
-        # with open(csv_path, "r") as f:
-        #     reader = list(csv.DictReader(f))
-        # logger.info("Opened!")
-
-        logger.info("Table Name: {}".format(table_name))
-        logger.info("CSV Paths: {}".format([os.path.basename(path) for path in csv_paths]))
-        # logger.info("CSV Paths 2: {}".format([os.path.basename(path).split("_")[1].lower() for path in csv_paths]))
-
-        for key, series_name in enumerate(columns_by_series[table_name]):
-            logger.info("")
-            logger.info("Series Name: {}".format(series_name))
-
-            # logger.info("0: {}".format(os.path.basename(csv_paths[0])))
-            profiletable_name = os.path.basename(csv_paths[0]).split('_')[1]
-            # logger.info("Profile Table Path Name: {}".format(profiletable_name))
-            base_csv_path = csv_paths[0].replace("_{}_".format(profiletable_name), "_{}_".format(table_name.upper())).replace(".csv", ".tmp.csv")
-            # logger.info("Merged Path: {}".format(os.path.basename(merged_csv_path)))
-            series_csv_path = base_csv_path.replace(table_name.upper(), "{}S{}".format(table_name.upper(), key + 1))
-            if not series_csv_path.endswith(".tmp.csv"):
-                series_csv_path = series_csv_path.replace(".csv", ".tmp.csv")
-            logger.info("Series CSV Path: {}".format(os.path.basename(series_csv_path)))
-
-            # https://stackoverflow.com/a/39923823/7368493
-            fieldnames = ["region_id"] + columns_by_series[table_name][series_name]["columns"]
-            fieldnames_set = set(fieldnames)
-            logger.info("Fieldnames ({}): {}".format(len(fieldnames), fieldnames))
-            logger.info("Profile Tables: {}".format(columns_by_series[table_name][series_name]["datapackNames"]))
-
-            with open(series_csv_path, "w") as f:
-                writer = csv.DictWriter(f, fieldnames)
-                writer.writeheader()
-
-                # logger.info("Profile Table CSVs Test: {}".format([os.path.basename(path) for path in csv_paths if os.path.basename(path).split("_")[1].lower() in columns_by_series[table_name][series_name]["datapackNames"]]))
-                profileTablesCSVPaths = [path for path in csv_paths if os.path.basename(path).split("_")[1].lower() in columns_by_series[table_name][series_name]["datapackNames"]]
-                logger.info("Profile Table CSVs: {}".format([os.path.basename(path) for path in profileTablesCSVPaths]))
-
-                for i, csv_path in enumerate(profileTablesCSVPaths):
-                    logger.info("CSV File: {}".format(os.path.basename(csv_path)))
-
-                    with open(csv_path, "r") as f:
-                        reader = list(csv.DictReader(f))
-
-                    for row in reader:
-                        # Use a dictionary comprehension to iterate over the key, value pairs
-                        # discarding those pairs whose key is not in the set
-                        filtered_row = dict(
-                            (k, v) for k, v in row.items() if k in fieldnames_set
-                        )
-                        # logger.info("Found: {}".format(len(filtered_row)))
-                        writer.writerow(filtered_row)
-
-            logger.info("%s-%s: Created CSV file for series '%s' - %s" % (abbrev, table_name.upper(), series_name, os.path.basename(series_csv_path)))
-            csv_files.append(series_csv_path)
-
-        return csv_files
-
     def merge_and_get_csv_files_by_table_and_series():
+        """
+        Merge and split the CSV files of each table as it's reached,
+        yielding the CSV files ready to load.
+        """
         csv_files_by_geog_and_table = get_csv_files_by_geography_and_table()
-        csv_files = []
 
         for geography_name, tables in csv_files_by_geog_and_table.items():
-            # if geography_name != "lga":
-            #     continue
-
             for table_name, csv_paths in csv_files_by_geog_and_table[geography_name].items():
                 # Merge the separate profile table/datapack CSVs into a single new  CSV file based on region_id (first column)
-                # if table_name != "i10":
-                #     continue
-
+                csv_paths = [source.wait(csv_path) for csv_path in csv_paths]
                 if len(csv_paths) > 1:
-                    dicts = []
-
-                    for i, csv_path in enumerate(csv_paths):
-                        with open(csv_path, "r") as f:
-                            r = csv.reader(f)
-                            if i == 0:
-                                dicts.append(OrderedDict((row[0], row[1:]) for row in r))
-                            else:
-                                dicts.append({row[0]: row[1:] for row in r})
-
-                    result = OrderedDict()
-                    for d in tuple(dicts):
-                        for key, value in d.items():
-                            result.setdefault(key, []).extend(value)
-
-                    profiletable_name = os.path.basename(csv_paths[0]).split('_')[1]
-                    merged_csv_path = csv_paths[0].replace("_{}_".format(profiletable_name), "_{}_".format(table_name.upper())).replace(".csv", ".tmp.csv")
-                    with open(merged_csv_path, "w") as f:
-                        w = csv.writer(f)
-                        for key, value in result.items():
-                            w.writerow([key] + value)
+                    with stage("merge", table="{}_{}".format(table_name, geography_name), bytes=sum(file_size(p) for p in csv_paths)) as timer:
+                        profiletable_name = os.path.basename(csv_paths[0]).split('_')[1]
+                        merged_csv_path = csv_paths[0].replace("_{}_".format(profiletable_name), "_{}_".format(table_name.upper())).replace(".csv", ".tmp.csv")
+                        scans = [scan_csv(csv_path) for csv_path in csv_paths]
+                        try:
+                            timer.add(rows=write_merged_csv(scans, merged_csv_path) - 1)
+                        finally:
+                            for scan in scans:
+                                scan.close()
+                        for csv_path in csv_paths:
+                            source.release(csv_path)
 
                     # Some tables are large (and have multiple datapacks), but no serises (e.g. X03)
                     # For these tables we just merge into one combined CSV file...
                     if table_name not in columns_by_series:
                         logger.info("%s: Merged datapack CSV files - %s" % (abbrev, ", ".join([os.path.basename(i) for i in csv_paths])))
-                        csv_files.append(merged_csv_path)
+                        yield merged_csv_path
                     else:
                         # ...but others are large and DO have serises (e.g. X01)
                         # These we will also merge into one combined CSV file,
                         # then split our merged file into separate CSVs for each
                         # series in the datapack
-                        split_csv_files = split_datapack_csv_by_series(columns_by_series, table_name, merged_csv_path)
+                        split_csv_files = split_datapack_csv_by_series(columns_by_series, table_name, merged_csv_path, abbrev)
                         logger.info("%s: Split multiple datapack CSV files - %s" % (abbrev, ", ".join([os.path.basename(i) for i in split_csv_files])))
-                        csv_files += split_csv_files
 
                         # Remove temporary merged CSV path - we have individual CSV files for each series now
                         os.remove(merged_csv_path)
+                        yield from split_csv_files
 
                 else:
                     # Some tables are small enough to fit multiple serises in a single datapack CSV file (e.g. P05)
                     # So we need to split these into separate CSVs for each series too
                     if table_name in columns_by_series:
-                        split_csv_files = split_datapack_csv_by_series(columns_by_series, table_name, csv_paths[0])
+                        split_csv_files = split_datapack_csv_by_series(columns_by_series, table_name, csv_paths[0], abbrev)
                         logger.info("%s: Split single datapack CSV file - %s" % (abbrev, ", ".join([os.path.basename(i) for i in split_csv_files])))
-                        csv_files += split_csv_files
+                        source.release(csv_paths[0])
+                        yield from split_csv_files
                     else:
-                        csv_files.append(csv_paths[0])
-        return csv_files
+                        yield csv_paths[0]
 
-    def handleNotApplicableCells(value, column_name):
-        """
-        Detect cells that are 'Not Applicable' in the source data and
-        set them to None (NULL in PostgreSQL).
+    def counted(match_fn, timer):
+        """ Count the data rows passing through a RewrittenCSV matcher. """
+        if match_fn is None:
+            return None
+
+        def _counter(line, row):
+            if line > 0:
+                timer.add(rows=1)
+            return match_fn(line, row)
+        return _counter
 
-        e.g. G23 has a row that refers to people who migrated to
-        Australia before 2000, and a column that describes people who 
-        are 14 years or younger. i.e. An impossibility.
+    def scan_datapack_csv(csv_path, table_number, table_name):
+        """
+        Scan a CSV file ready to load, recording its columns that are
+        entirely not applicable (so they can be disabled in the Ealgis GUI)
+        and their summary statistics, and logging any cells that are neither
+        numbers nor "..".
 
-        Cells that are not applicable have no value and need to be
-        disabled in the Ealgis GUI so users can't select them.
+        Returns the PostgreSQL types of its data columns.
+        """
+        with stage("scan", table=table_number, bytes=file_size(csv_path)) as timer, scan_csv(csv_path) as scan:
+            timer.add(rows=scan.rows)
+            for region_id, column_name, value in scan.invalid_cells():
+                logger.error("A cell contains an unknown value of \"{}\" (region {}, column {})".format(value, region_id, column_name))
+            for column_name in scan.not_applicable_columns():
+                db_column_name = col_mapping[(table_number, column_name.lower())].lower()
+                if db_column_name not in not_applicable_columns:
+                    not_applicable_columns.append(db_column_name)
+            column_stats[table_name] = OrderedDict(
+                (col_mapping[(table_number, column_name.lower())].lower(), summary)
+                for column_name, summary in zip(scan.header[1:], summarise_columns(scan.values)))
+            return scan.column_types()
+
+    def datapack_jobs():
+        """
+        Scan each CSV file as it's ready to load, yielding
+        (table_name, csv_path, gid_match, column_types, census_division).
+        """
+        for i, csv_path in enumerate(merge_and_get_csv_files_by_table_and_series()):
+            logger.info("%s: [%d] %s" % (abbrev, i + 1, os.path.basename(csv_path)))
+            table_name = table_re.match(os.path.split(csv_path)[-1]).groups()[0].lower()
 
-        In the Census these are represented by the string ".."
+            m = re.match('^([a-z]+[0-9]+[a-z]{0,})(s[0-9]{1,2})?_.+', table_name.lower())
+            table_number = m.groups()[0]  # g14_aus_ssc -> g14; g23s1_aus_ssc -> g23
 
-        value (string): The value of a cell in a CSV file.
-        column_name (string): The name of the column this cell is in e.g. g7068
+            data_tables.append(table_name)
+            decoded = table_name.split('_')
 
-        Returns:
-            value (string or None)
-        """
-        # https://stackoverflow.com/a/23639915
-        def is_number(s):
-            """ Returns True is string is a number (int or float). """
-            return s.replace('.', '', 1).isdigit()
+            if len(decoded) == 3:
+                census_division = decoded[2]
+            else:
+                census_division = None
 
-        NotApplicableString = ".."
+            gid_match = None
 
-        if is_number(value) is False and value != NotApplicableString:
-            logger.error("A cell contains an unknown value of \"{}\"".format(value))
+            if census_division is not None:
+                gid_match = make_gid_matcher(col_mapping, table_number, census_division, geo_gid_mapping[census_division])
+                column_types = ["integer", "text"] + scan_datapack_csv(csv_path, table_number, table_name)
+            else:
+                column_types = None
 
-        if column_name.lower() in not_applicable_columns and is_number(value) is True:
-            # Remove column_name from stack if it looks like data
-            not_applicable_columns.remove(column_name.lower())
-        if column_name.lower() not in not_applicable_columns and value == NotApplicableString:
-            # Add column_name to stack if it's Not Applicable
-            not_applicable_columns.append(column_name.lower())
+            yield table_name, csv_path, gid_match, column_types, census_division
 
-        return None if value == NotApplicableString else value
+    def tidy(csv_path):
+        """ Tidy up after ourselves, once a CSV file has been loaded. """
+        if csv_path.endswith(".tmp.csv"):
+            os.remove(csv_path)
+        else:
+            source.release(csv_path)
 
+    source = source or DirectorySource(census_dir)
     d = os.path.join(census_dir, packname, "Sequential Number Descriptor")
-    csv_files = merge_and_get_csv_files_by_table_and_series()
 
     table_re = re.compile(r'^2011Census_(.*)_sequential(.tmp)?.csv$')
     linkage_pending = []
     data_tables = []
     not_applicable_columns = []
+    column_stats = {}
 
-    for i, csv_path in enumerate(csv_files):
-        logger.info("%s: [%d/%d] %s" % (abbrev, i + 1, len(csv_files), os.path.basename(csv_path)))
-        table_name = table_re.match(os.path.split(csv_path)[-1]).groups()[0].lower()
+    if backend == "async":
+        # The jobs are merged, split and scanned as the backend reaches them,
+        # and their CSV files tidied as soon as they're rewritten
+        divisions = OrderedDict()
 
-        m = re.match('^([a-z]+[0-9]+[a-z]{0,})(s[0-9]{1,2})?_.+', table_name.lower())
-        table_number = m.groups()[0]  # g14_aus_ssc -> g14; g23s1_aus_ssc -> g23
+        def async_jobs():
+            for table_name, csv_path, gid_match, column_types, census_division in datapack_jobs():
+                divisions[table_name] = census_division
+                yield table_name, csv_path, gid_match, column_types
 
-        data_tables.append(table_name)
-        decoded = table_name.split('_')
+        table_infos = ingest_datapacks(loader, async_jobs(), tmpdir, release=tidy)
+        linkage_pending += [(table_name, table_infos.get(table_name), census_division) for table_name, census_division in divisions.items() if census_division is not None]
+    else:
+        for table_name, csv_path, gid_match, column_types, census_division in datapack_jobs():
+            # normalise the CSV file by reading it in and writing it out again,
+            # Postgres is quite pedantic. we also want to add an additional column to it
+            with ExitStack() as stack:
+                with stage("rewrite", table=table_name, bytes=file_size(csv_path)) as timer:
+                    norm = stack.enter_context(RewrittenCSV(tmpdir, csv_path, counted(gid_match, timer)))
+                with stage("copy", table=table_name, rows=timer.rows, bytes=file_size(norm.get())):
+                    instance = CSVLoader(loader.dbschema(), table_name, norm.get(), pkey_column=0)
+                    table_info = instance.load(loader)
+                if table_info is not None and census_division is not None:
+                    linkage_pending.append((table_name, table_info, census_division))
 
-        if len(decoded) == 3:
-            census_division = decoded[2]
-        else:
-            census_division = None
-
-        gid_match = None
-
-        if census_division is not None:
-            def make_match_fn():
-                lookup = geo_gid_mapping[census_division]
-                header = None
-
-                def _getColumnNameFromHeader(cell_index_in_row):
-                    # We add 2 to the index because the first two columns are ["gid", "region_id"] and
-                    # we're starting from position 1 in the row.
-                    return header[cell_index_in_row + 2:cell_index_in_row + 3][0]
-
-                def _matcher(line, row):
-                    nonlocal header
-                    if line == 0:
-                        # Rewrite the header
-                        # col_mapping: Map from ("G11", "Tot_P_M") (in the CSV header) to "G100" (in the database)
-                        header = ["gid", "region_id"] + [col_mapping[(table_number, v.lower())] for v in row[1:]]
-                        return header
-                    else:
-                        # Data rows
-                        if row[0] in lookup:
-                            return [str(lookup[row[0]])] + [row[0]] + [handleNotApplicableCells(v, _getColumnNameFromHeader(k)) for k, v in enumerate(row[1:])]
-                        else:
-                            # Fail dramatically if any missing gids have made it this far
-                            raise Exception("failed gid lookup for '%s' for '%s'" % (row[0], census_division))
-                return _matcher
-            gid_match = make_match_fn()
-
-        # normalise the CSV file by reading it in and writing it out again,
-        # Postgres is quite pedantic. we also want to add an additional column to it
-        with RewrittenCSV(tmpdir, csv_path, gid_match) as norm:
-            instance = CSVLoader(loader.dbschema(), table_name, norm.get(), pkey_column=0)
-            table_info = instance.load(loader)
-            if table_info is not None and census_division is not None:
-                linkage_pending.append((table_name, table_info, census_division))
-
-        # Tidy up after ourselves
-        if csv_path.endswith(".tmp.csv"):
-            os.remove(csv_path)
+            tidy(csv_path)
+
+    # The tables replaced by views, and the tables now holding their data
+    storage = {}
+    if sparse_threshold is not None:
+        storage = store_tables(loader.engine, loader.dbschema(), [attr_table for attr_table, _, _ in linkage_pending], column_stats, sparse_threshold)
 
-    with loader.access_schema(SHAPE_SCHEMA) as geo_access:
-        for attr_table, table_info, census_division in linkage_pending:
-            geo_column, _, _ = SHAPE_LINKAGE[census_division]
-            loader.add_geolinkage(
-                geo_access,
-                census_division, "gid",
-                attr_table, "gid")
+    if partition_by_state:
+        partition_tables_by_state(loader.engine, loader.dbschema(), [attr_table for attr_table, _, census_division in linkage_pending if census_division in PARTITIONED_DIVISIONS and attr_table not in storage])
 
-    return data_tables, not_applicable_columns
+    with stage("geolinkage", rows=len(linkage_pending)):
+        add_geolinkages(loader, [(attr_table, census_division) for attr_table, _, census_division in linkage_pending])
+    with stage("index", rows=len(linkage_pending)):
+        index_gid_columns(loader, [storage.get(attr_table, attr_table) for attr_table, _, _ in linkage_pending])
 
+    return data_tables, not_applicable_columns, column_stats
 
-def build_geo_gid_mapping(factory):
+
+def build_geo_gid_mapping(factory, selection=ALL):
     with factory.make_schema_access(SHAPE_SCHEMA) as shape_access:
         geo_gid_mapping = {}
         for census_division in SHAPE_LINKAGE:
+            if not selection.division(census_division):
+                continue
             geo_column, geo_cast_required, _ = SHAPE_LINKAGE[census_division]
             geo_cls = shape_access.get_table_class(census_division, refresh=True)
             geo_attr = getattr(geo_cls, geo_column)
             if geo_cast_required is not None:
-                inner_col = sqlalchemy.cast(geo_attr, geo_cast_required)
+                inner_col = sqlalchemy.cast(geo_attr, getattr(sqlalchemy.types, geo_cast_required))
             else:
                 inner_col = geo_attr
             lookup = {}
@@ -680,33 +704,105 @@ def build_geo_gid_mapping(factory):
         return geo_gid_mapping
 
 
-def load_attrs(factory, census_dir, tmpdir):
-    release = '3'
+RELEASE = '3'
+PACKAGES = [
+    ("Aboriginal and Torres Strait Islander Peoples Profile", "IP", "Metadata_2011_IP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/papersbyReleaseDate/70B0E87BFC57CFE3CA257AA600136D3A?OpenDocument"),
+    ("Basic Community Profile", "BCP", "Metadata_2011_BCP_DataPack.xlsx", "http://www.abs.gov.au/websitedbs/censushome.nsf/home/communityprofiles"),
+    ("Place of Enumeration Profile", "PEP", "Metadata_2011_PEP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/products/8862E7818AD89474CA2570D90018BFAF?OpenDocument"),
+    ("Expanded Community Profile", "XCP", "Metadata_2011_XCP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/mf/2069.0.30.005?OpenDocument"),
+    ("Time Series Profile", "TSP", "Metadata_2011_TSP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/ProductsbyReleaseDate/87541FA89DA17C6FCA257AA600136D72?OpenDocument"),
+    ("Working Population Profile", "WPP", "Metadata_2011_WPP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/productsbytitle/E6A94B5402FD62DCCA2570D90018BFAC?OpenDocument"),
+]
+
+
+def package_dirname(package_name):
+    return '2011 ' + package_name + ' Release %s' % RELEASE
+
+
+def package_schema_name(abbrev):
+    return 'aus_census_2011_' + abbrev.lower()
 
-    packages = [
-        ("Aboriginal and Torres Strait Islander Peoples Profile", "IP", "Metadata_2011_IP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/papersbyReleaseDate/70B0E87BFC57CFE3CA257AA600136D3A?OpenDocument"),
-        ("Basic Community Profile", "BCP", "Metadata_2011_BCP_DataPack.xlsx", "http://www.abs.gov.au/websitedbs/censushome.nsf/home/communityprofiles"),
-        ("Place of Enumeration Profile", "PEP", "Metadata_2011_PEP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/products/8862E7818AD89474CA2570D90018BFAF?OpenDocument"),
-        ("Expanded Community Profile", "XCP", "Metadata_2011_XCP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/mf/2069.0.30.005?OpenDocument"),
-        ("Time Series Profile", "TSP", "Metadata_2011_TSP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/ProductsbyReleaseDate/87541FA89DA17C6FCA257AA600136D72?OpenDocument"),
-        ("Working Population Profile", "WPP", "Metadata_2011_WPP_DataPack.xlsx", "http://www.abs.gov.au/ausstats/abs@.nsf/productsbytitle/E6A94B5402FD62DCCA2570D90018BFAC?OpenDocument"),
-    ]
 
+def load_package(loader, census_dir, tmpdir, package, geo_gid_mapping, backend="sync", source=None, selection=ALL, partition_by_state=False, sparse_threshold=None):
+    """
+    Load one package's attribute tables and register their metadata in the
+    loader's schema (normally the package's own schema, see
+    package_schema_name).
+
+    package: a (package_name, abbrev, metadata_filename, description) entry of PACKAGES
+
+    Returns -
+    (data_tables, registered) as returned by load_datapacks and load_metadata
+    """
+    package_name, abbrev, metadata_filename, package_description = package
+    loader.add_dependency(SHAPE_SCHEMA)
+    loader.set_metadata(
+        name=package_name,
+        family="ABS Census 2011",
+        description=package_description,
+        date_published=datetime(2012, 6, 21, 3, 0, 0)  # Set in UTC
+    )
+    columns_by_series, col_mapping = load_metadata_table_serises(loader, census_dir, metadata_filename, source=source)
+    data_tables, not_applicable_columns, column_stats = load_datapacks(loader, census_dir, tmpdir, package_dirname(package_name), abbrev, geo_gid_mapping, columns_by_series, col_mapping, backend=backend, source=source, selection=selection, partition_by_state=partition_by_state, sparse_threshold=sparse_threshold)
+    registered = load_metadata(loader, census_dir, metadata_filename, data_tables, columns_by_series, not_applicable_columns, source=source, column_stats=column_stats)
+    return data_tables, registered
+
+
+def find_package(abbrev):
+    """ The PACKAGES entry for a package abbreviation (e.g. "bcp"). """
+    for package in PACKAGES:
+        if package[1].lower() == abbrev.lower():
+            return package
+    raise Exception("Unknown census package '{}'".format(abbrev))
+
+
+def load_attrs(factory, census_dir, tmpdir, analysis_views=None, rollup=False, validate=False, backend="sync", source=None, selection=ALL, partition_by_state=False, concordance=None, sparse_threshold=None):
+    """
+    Load the attribute tables of every DataPack.
+
+    analysis_views: optional [(table_number, census_division)] pairs to
+        build materialised analysis views for (see analysis_views.py)
+    rollup: roll count tables up the ASGS main structure, checking them
+        against the published tables and filling in unpublished divisions
+        (see rollup.py). The checks are added to the run report.
+    validate: check the additive identities (e.g. Males + Females =
+        Persons) of every table loaded (see validate.py). The violations
+        are added to the run report.
+    backend: how DataPack CSV files are loaded, "sync" or "async" (see
+        load_datapacks)
+    source: where to find the census files (see archive.py), by default
+        census_dir itself
+    selection: the packages, table numbers and census divisions to load
+        (see selection.py). Only the tables loaded are registered.
+    partition_by_state: store the sa1, sa2 and ssc tables as partitions by
+        state (see partition.py)
+    concordance: the schema of the 2016 census (in the same database) to
+        match each package's columns with (see concordance.py)
+    sparse_threshold: store the tables with a smaller share of non-zero
+        cells than this sparsely (see sparse.py)
+    """
     attr_results = []
-    geo_gid_mapping = build_geo_gid_mapping(factory)
-    for package_name, abbrev, metadata_filename, package_description in packages:
-        dirname = '2011 ' + package_name + ' Release %s' % release
-        schema_name = 'aus_census_2011_' + abbrev.lower()
-        with factory.make_loader(schema_name) as loader:
-            loader.add_dependency(SHAPE_SCHEMA)
-            loader.set_metadata(
-                name=package_name,
-                family="ABS Census 2011",
-                description=package_description,
-                date_published=datetime(2012, 6, 21, 3, 0, 0)  # Set in UTC
-            )
-            columns_by_series, col_mapping = load_metadata_table_serises(loader, census_dir, metadata_filename)
-            data_tables, not_applicable_columns = load_datapacks(loader, census_dir, tmpdir, dirname, abbrev, geo_gid_mapping, columns_by_series, col_mapping)
-            load_metadata(loader, census_dir, metadata_filename, data_tables, columns_by_series, not_applicable_columns)
+    with stage("geo gid mapping"):
+        geo_gid_mapping = build_geo_gid_mapping(factory, selection)
+    # In the order the source extracts them (see archive.py)
+    packages = [package for package in PACKAGES if selection.package(package[1])]
+    if source is not None:
+        packages = source.ordered(packages, key=lambda package: os.path.join(census_dir, package_dirname(package[0])))
+    for package in packages:
+        abbrev = package[1]
+        with factory.make_loader(package_schema_name(abbrev)) as loader:
+            with stage(abbrev):
+                data_tables, registered = load_package(loader, census_dir, tmpdir, package, geo_gid_mapping, backend=backend, source=source, selection=selection, partition_by_state=partition_by_state, sparse_threshold=sparse_threshold)
+                if validate:
+                    report.info.setdefault("validation", OrderedDict())[abbrev] = validate_tables(loader.engine, loader.dbschema(), data_tables, registered)
+                if rollup:
+                    rollup_report, rollup_created = rollup_tables(loader, data_tables, registered, selection=selection)
+                    report.info.setdefault("rollup", OrderedDict())[abbrev] = rollup_report
+                    data_tables += rollup_created
+                if analysis_views:
+                    build_analysis_views(loader, data_tables, analysis_views)
+                build_column_search_index(loader, registered)
+                if concordance:
+                    build_concordance(loader.engine, loader.dbschema(), concordance)
             attr_results.append(loader.result())
     return attr_results
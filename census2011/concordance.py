@@ -0,0 +1,193 @@
+#
+# EAlGIS loader: Australian Census 2011; 2011 <-> 2016 concordance
+#
+# Which 2016 General Community Profile (G) table columns hold the same
+# counts as each 2011 column, so that time series across the two censuses
+# can be queried.
+#
+# Tables: concordance_2016.json maps each 2016 G table to the 2011 tables
+# it continues. It's many to many, e.g. G29 is B28 at the Basic Community
+# Profile's detail and X14-X22 at the Expanded Community Profile's.
+#
+# Columns: within each pair of concordant tables at the same census
+# division, columns are matched on their parsed row (type) and column
+# (kind) labels (see parseColumnMetadata) and series, normalised so that
+# punctuation, case, note markers and currency formatting don't matter.
+# Where the series don't match and the 2016 table isn't split by series,
+# the labels alone are matched. A 2011 column with no match is left out.
+#
+# Each package schema gets a census2016_concordance table, indexed on
+# both the 2011 and 2016 columns, e.g.
+#
+#   SELECT k.table_name_2016, k.column_name_2016
+#   FROM aus_census_2011_bcp.census2016_concordance k
+#   WHERE k.table_name = 'b04s1_aust_sa2' AND k.column_name = 'b3404'
+#
+
+import os
+import re
+import json
+import sqlalchemy
+from collections import OrderedDict
+
+from ealgis_common.util import make_logger
+from .instrument import stage
+
+logger = make_logger(__name__)
+
+CONCORDANCE_TABLE = "census2016_concordance"
+CENSUS2016_SCHEMA = "aus_census_2016_gcp"
+TABLE_CONCORDANCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "concordance_2016.json")
+
+# e.g. b04s1_aust_sa2, g04a_aust_sa2
+CONCORDANCE_TABLE_RE = re.compile(r'^(?P<table>[a-z]+[0-9]+)[a-z]?(s[0-9]{1,2})?_(?P<geo>[a-z]+)_(?P<division>[a-z0-9]+)$')
+
+
+def load_table_concordance(path=TABLE_CONCORDANCE_FILE):
+    """
+    Returns -
+    [(table_number_2016, table_number_2011)], every concordant pair
+    """
+    with open(path, "r") as f:
+        concordance = json.load(f)
+    return [(table_2016, table_2011) for table_2016, tables_2011 in concordance.items() for table_2011 in tables_2011]
+
+
+def tables_2011_for(table_number_2016, pairs=None):
+    """ The 2011 table numbers a 2016 table continues (e.g. "g29" -> ["b28", "x14", ...]). """
+    pairs = load_table_concordance() if pairs is None else pairs
+    return [t2011 for t2016, t2011 in pairs if t2016 == table_number_2016.lower()]
+
+
+def normalise_label(label):
+    """
+    "$1,000-$1,249 (c)" -> "1000 1249"
+    "Aboriginal &/or Torres Strait Islander" -> "aboriginal and or torres strait islander"
+    """
+    if label is None:
+        return ""
+    label = str(label).lower().replace("&", " and ").replace(",", "")
+    label = re.sub(r"\([a-z]\)", " ", label)
+    return " ".join(re.findall(r"[a-z0-9]+", label))
+
+
+def read_columns(conn, schema):
+    """
+    Read a schema's registered columns, with their normalised labels.
+
+    Returns -
+    columns[(table_number, division)] = [(table_name, column_name, series, type, kind)]
+    """
+    columns = OrderedDict()
+    rows = conn.execute("""
+        SELECT t.name, t.metadata_json, c.name, c.metadata_json
+        FROM "{schema}".table_info t
+        JOIN "{schema}".column_info c ON c.tableinfo_id = t.id
+        ORDER BY t.name, c.id""".format(schema=schema))
+    for table_name, table_json, column_name, column_json in rows:
+        m = CONCORDANCE_TABLE_RE.match(table_name)
+        if m is None:
+            continue
+        table_meta = json.loads(table_json) if table_json else {}
+        column_meta = json.loads(column_json) if column_json else {}
+        columns.setdefault((m.group("table"), m.group("division")), []).append((
+            table_name, column_name,
+            normalise_label(table_meta.get("series")),
+            normalise_label(column_meta.get("type")),
+            normalise_label(column_meta.get("kind"))))
+    return columns
+
+
+def match_columns(columns_2011, columns_2016, pairs):
+    """
+    Match the columns of each pair of concordant tables (see read_columns)
+    on their labels.
+
+    Returns -
+    [(table_name, column_name, table_name_2016, column_name_2016, match)],
+    match being "series" (series and labels matched) or "labels"
+    """
+    matches = []
+    for table_2016, table_2011 in pairs:
+        for (table_number, division), columns in columns_2011.items():
+            if table_number != table_2011 or (table_2016, division) not in columns_2016:
+                continue
+            by_series, by_labels = {}, {}
+            for table_name, column_name, series, type_, kind in columns_2016[(table_2016, division)]:
+                by_series.setdefault((series, type_, kind), []).append((table_name, column_name))
+                by_labels.setdefault((type_, kind), []).append((table_name, column_name))
+            # Only a table that isn't split by series can be matched on its
+            # labels alone; otherwise they'd match the column of every series
+            unsplit = len(set(series for series, _, _ in by_series)) <= 1
+            for table_name, column_name, series, type_, kind in columns:
+                if (series, type_, kind) in by_series:
+                    found, match = by_series[(series, type_, kind)], "series"
+                elif unsplit:
+                    found, match = by_labels.get((type_, kind), []), "labels"
+                else:
+                    continue
+                for table_name_2016, column_name_2016 in found:
+                    matches.append((table_name, column_name, table_name_2016, column_name_2016, match))
+    return matches
+
+
+def build_concordance(engine, schema, census2016_schema=CENSUS2016_SCHEMA, pairs=None):
+    """
+    (Re)build a package schema's census2016_concordance table against the
+    2016 census loaded into census2016_schema (in the same database).
+
+    Returns the number of column pairs, or None if census2016_schema isn't there.
+    """
+    pairs = load_table_concordance() if pairs is None else pairs
+    params = {"schema": schema, "table": CONCORDANCE_TABLE}
+    with stage("concordance"), engine.connect() as conn:
+        conn = conn.execution_options(autocommit=True)
+        exists = conn.execute(sqlalchemy.text("SELECT to_regclass(:name)"), name='"{}".table_info'.format(census2016_schema)).scalar()
+        if exists is None:
+            logger.warning("no 2016 census in schema %s, skipping the concordance for %s" % (census2016_schema, schema))
+            return None
+
+        matches = match_columns(read_columns(conn, schema), read_columns(conn, census2016_schema), pairs)
+        conn.execute('DROP TABLE IF EXISTS "{schema}"."{table}"'.format(**params))
+        conn.execute("""
+            CREATE TABLE "{schema}"."{table}" (
+                id serial PRIMARY KEY,
+                table_name varchar NOT NULL,
+                column_name varchar NOT NULL,
+                schema_2016 varchar NOT NULL,
+                table_name_2016 varchar NOT NULL,
+                column_name_2016 varchar NOT NULL,
+                match varchar NOT NULL
+            )""".format(**params))
+        if matches:
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO "{schema}"."{table}" (table_name, column_name, schema_2016, table_name_2016, column_name_2016, match)
+                VALUES (:table_name, :column_name, :schema_2016, :table_name_2016, :column_name_2016, :match)""".format(**params)), [
+                dict(table_name=t, column_name=c, schema_2016=census2016_schema, table_name_2016=t2016, column_name_2016=c2016, match=match)
+                for t, c, t2016, c2016, match in matches])
+        conn.execute('CREATE INDEX "{table}_2011_idx" ON "{schema}"."{table}" (table_name, column_name)'.format(**params))
+        conn.execute('CREATE INDEX "{table}_2016_idx" ON "{schema}"."{table}" (table_name_2016, column_name_2016)'.format(**params))
+        conn.execute('ANALYZE "{schema}"."{table}"'.format(**params))
+    logger.info("matched %d columns of %s with the 2016 census" % (len(matches), schema))
+    return len(matches)
+
+
+def find_concordant_columns(engine, schema, table_name, column_names=None, reverse=False):
+    """
+    Look up the 2016 columns of a 2011 table's columns (or with reverse,
+    the 2011 columns of a 2016 table's) in a package's concordance.
+
+    Returns -
+    [(table_name, column_name, schema_2016, table_name_2016, column_name_2016, match)]
+    """
+    side = "_2016" if reverse else ""
+    sql = """
+        SELECT table_name, column_name, schema_2016, table_name_2016, column_name_2016, match
+        FROM "{schema}"."{table}"
+        WHERE table_name{side} = :table_name""".format(schema=schema, table=CONCORDANCE_TABLE, side=side)
+    params = {"table_name": table_name}
+    if column_names is not None:
+        sql += " AND column_name{side} = ANY(:column_names)".format(side=side)
+        params["column_names"] = list(column_names)
+    with engine.connect() as conn:
+        return [tuple(r) for r in conn.execute(sqlalchemy.text(sql + " ORDER BY id"), **params)]
@@ -0,0 +1,234 @@
+#
+# EAlGIS loader: Australian Census 2011; correspondences between divisions
+#
+# Weights for re-aggregating data from one census division onto another
+# whose boundaries don't nest in it (e.g. SA1 to postal area, suburb to
+# LGA, SA2 to electoral division), precomputed once by overlaying the
+# loaded shapes, so that re-aggregating is a sparse matrix product instead
+# of a spatial join per request.
+#
+# Each (source, target, method) correspondence is a sparse matrix stored
+# as rows (source_gid, target_gid, weight) of the shape schema's
+# division_correspondence table, the weights of each source region
+# summing to 1:
+#   area: the share of the source region's area in each target region
+#   population: the share of the source region's population (Total
+#       persons, B01 at SA1) living in each target region, SA1s being
+#       allocated to a region by a point on their surface. Source regions
+#       without any population have no weights.
+#
+# e.g.
+#   c = load_correspondence(engine, "sa1", "poa")
+#   poa = c.reaggregate(q.fetch("bcp", "b01", "sa1", row_label="Total persons"))
+#
+
+import numpy
+import sqlalchemy
+
+from ealgis_common.util import make_logger
+from .shapes import SHAPE_LINKAGE, SHAPE_SCHEMA, SHAPE_GEOMETRY_COLUMN
+from .instrument import stage
+from .query import QueryResult
+
+logger = make_logger(__name__)
+
+CORRESPONDENCE_TABLE = "division_correspondence"
+CORRESPONDENCE_METHODS = ("area", "population")
+
+# The correspondences most often asked for
+CORRESPONDENCES = [
+    ("sa1", "poa"),
+    ("sa1", "ced"),
+    ("sa1", "sed"),
+    ("ssc", "lga"),
+    ("sa2", "ced"),
+    ("sa2", "lga"),
+]
+
+# The census column used as the population of each SA1: B01 Total persons
+POPULATION_SCHEMA = "aus_census_2011_bcp"
+POPULATION_TABLE = "b01_aust_sa1"
+POPULATION_COLUMN = "b3"
+
+# Overlaps smaller than this share of a source region are slivers from
+# boundaries that don't quite line up, and are dropped
+MIN_WEIGHT = 0.001
+
+
+def parse_correspondence(spec):
+    """ Parse a "sa1:poa" style (source_division, target_division) pair. """
+    source_division, target_division = spec.lower().split(":")
+    return source_division, target_division
+
+
+def _create_correspondence_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS "{schema}"."{table}" (
+            source_division varchar NOT NULL,
+            target_division varchar NOT NULL,
+            method varchar NOT NULL,
+            source_gid integer NOT NULL,
+            target_gid integer NOT NULL,
+            weight real NOT NULL,
+            PRIMARY KEY (source_division, target_division, method, source_gid, target_gid)
+        )""".format(schema=SHAPE_SCHEMA, table=CORRESPONDENCE_TABLE))
+
+
+def _area_weights_select(source_division, target_division):
+    """ (source_gid, target_gid, overlap) of the source regions' areas. """
+    return """
+        SELECT s.gid AS source_gid, t.gid AS target_gid,
+            CASE WHEN ST_Within(s."{geom}", t."{geom}") THEN 1.0
+            ELSE ST_Area(ST_Intersection(s."{geom}", t."{geom}")) / nullif(ST_Area(s."{geom}"), 0) END AS share
+        FROM "{schema}"."{source}" s
+        JOIN "{schema}"."{target}" t ON ST_Intersects(s."{geom}", t."{geom}")""".format(
+        schema=SHAPE_SCHEMA, source=source_division, target=target_division, geom=SHAPE_GEOMETRY_COLUMN)
+
+
+def _population_weights_select(source_division, target_division):
+    """ (source_gid, target_gid, population) of the SA1s in each overlap. """
+    return """
+        WITH blocks AS (
+            SELECT b.gid, ST_PointOnSurface(b."{geom}") AS point, p."{column}" AS population
+            FROM "{schema}".sa1 b
+            JOIN "{population_schema}"."{population_table}" p ON p.gid = b.gid
+            WHERE p."{column}" > 0)
+        SELECT s.gid AS source_gid, t.gid AS target_gid, sum(b.population) AS share
+        FROM blocks b
+        JOIN "{schema}"."{source}" s ON ST_Contains(s."{geom}", b.point)
+        JOIN "{schema}"."{target}" t ON ST_Contains(t."{geom}", b.point)
+        GROUP BY s.gid, t.gid""".format(
+        schema=SHAPE_SCHEMA, source=source_division, target=target_division, geom=SHAPE_GEOMETRY_COLUMN,
+        population_schema=POPULATION_SCHEMA, population_table=POPULATION_TABLE, column=POPULATION_COLUMN)
+
+
+def build_correspondence(engine, source_division, target_division, method="area", min_weight=MIN_WEIGHT):
+    """
+    (Re)build the weights of one correspondence, normalising each source
+    region's weights to sum to 1 after dropping slivers.
+
+    Returns the number of weights stored.
+    """
+    if method not in CORRESPONDENCE_METHODS:
+        raise ValueError("Unknown correspondence method '{}'".format(method))
+    select = (_area_weights_select if method == "area" else _population_weights_select)(source_division, target_division)
+    params = {"schema": SHAPE_SCHEMA, "table": CORRESPONDENCE_TABLE}
+    logger.info("building %s -> %s correspondence (%s)" % (source_division, target_division, method))
+    with stage("correspondence", table="{}_{}_{}".format(source_division, target_division, method)) as timer, engine.begin() as conn:
+        _create_correspondence_table(conn)
+        conn.execute(sqlalchemy.text("""
+            DELETE FROM "{schema}"."{table}"
+            WHERE source_division = :source AND target_division = :target AND method = :method""".format(**params)),
+            source=source_division, target=target_division, method=method)
+        rows = conn.execute(sqlalchemy.text("""
+            INSERT INTO "{schema}"."{table}" (source_division, target_division, method, source_gid, target_gid, weight)
+            SELECT :source, :target, :method, source_gid, target_gid, share / sum(share) OVER (PARTITION BY source_gid)
+            FROM (
+                SELECT source_gid, target_gid, share, sum(share) OVER (PARTITION BY source_gid) AS total
+                FROM ({select}) AS overlaps
+                WHERE share > 0) AS shares
+            WHERE share >= :min_weight * total""".format(select=select, **params)),
+            source=source_division, target=target_division, method=method, min_weight=min_weight).rowcount
+        timer.add(rows=rows)
+    return rows
+
+
+def build_correspondences(engine, correspondences=CORRESPONDENCES, methods=CORRESPONDENCE_METHODS):
+    """
+    Build each (source_division, target_division) correspondence by each
+    method. The population method needs B01 at SA1 to have been loaded,
+    and is skipped without it.
+    """
+    with engine.connect() as conn:
+        has_population = conn.execute(sqlalchemy.text("SELECT to_regclass(:name)"), name='"{}"."{}"'.format(POPULATION_SCHEMA, POPULATION_TABLE)).scalar() is not None
+    built = []
+    for source_division, target_division in correspondences:
+        for method in methods:
+            if method == "population" and not has_population:
+                logger.warning("%s.%s isn't loaded, skipping the %s -> %s population correspondence" % (POPULATION_SCHEMA, POPULATION_TABLE, source_division, target_division))
+                continue
+            build_correspondence(engine, source_division, target_division, method)
+            built.append((source_division, target_division, method))
+    with engine.connect() as conn:
+        conn.execution_options(autocommit=True).execute('ANALYZE "{}"."{}"'.format(SHAPE_SCHEMA, CORRESPONDENCE_TABLE))
+    return built
+
+
+class Correspondence:
+    """
+    A correspondence's weights as a sparse matrix, ordered by target
+    region (compressed sparse rows of the target x source matrix).
+
+    source_codes: region codes of the source regions with weights
+    target_codes: region codes of the target regions, one per output row
+    """
+
+    def __init__(self, source_codes, target_codes, source_index, target_starts, weights):
+        self.source_codes = source_codes
+        self.target_codes = target_codes
+        self._source_index = source_index
+        self._target_starts = target_starts
+        self._weights = weights
+
+    def apply(self, region_codes, values):
+        """
+        Re-aggregate values (a float matrix of shape (regions, columns),
+        one row per source region in region_codes, NaN where not
+        applicable) onto the target regions.
+
+        Returns a float matrix of shape (target regions, columns); a target
+        cell is NaN if none of its source cells had a value.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64).reshape(len(region_codes), -1)
+        if len(region_codes) == 0:
+            return numpy.full((len(self.target_codes), values.shape[1]), numpy.nan)
+        # The row of values holding each source region, or a row of NaN
+        region_codes = numpy.asarray(region_codes, dtype=object)
+        order = numpy.argsort(region_codes)
+        sorted_codes = region_codes[order]
+        position = numpy.minimum(numpy.searchsorted(sorted_codes, self.source_codes), len(sorted_codes) - 1)
+        rows = numpy.where(sorted_codes[position] == self.source_codes, order[position], len(region_codes))
+        padded = numpy.vstack([values, numpy.full((1, values.shape[1]), numpy.nan)])
+
+        contributions = padded[rows[self._source_index]]
+        present = ~numpy.isnan(contributions)
+        weighted = numpy.where(present, contributions, 0.0) * self._weights[:, None]
+        result = numpy.add.reduceat(weighted, self._target_starts, axis=0)
+        result[~numpy.logical_or.reduceat(present, self._target_starts, axis=0)] = numpy.nan
+        return result
+
+    def reaggregate(self, result):
+        """ Re-aggregate a CensusQuery QueryResult onto the target regions. """
+        return QueryResult(self.target_codes, result.columns, self.apply(result.region_codes, result.values))
+
+
+def load_correspondence(engine, source_division, target_division, method="area"):
+    """ Read a correspondence's weights (see build_correspondence). """
+    params = {
+        "schema": SHAPE_SCHEMA,
+        "table": CORRESPONDENCE_TABLE,
+        "source": source_division,
+        "target": target_division,
+        "source_geo": SHAPE_LINKAGE[source_division][0],
+        "target_geo": SHAPE_LINKAGE[target_division][0],
+    }
+    with engine.connect() as conn:
+        rows = conn.execute(sqlalchemy.text("""
+            SELECT s."{source_geo}"::varchar, t."{target_geo}"::varchar, w.weight
+            FROM "{schema}"."{table}" w
+            JOIN "{schema}"."{source}" s ON s.gid = w.source_gid
+            JOIN "{schema}"."{target}" t ON t.gid = w.target_gid
+            WHERE w.source_division = :source AND w.target_division = :target AND w.method = :method
+            ORDER BY w.target_gid, w.source_gid""".format(**params)), source=source_division, target=target_division, method=method).fetchall()
+    if not rows:
+        raise KeyError("No {} -> {} correspondence by {} has been built".format(source_division, target_division, method))
+    return make_correspondence([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows])
+
+
+def make_correspondence(source_codes, target_codes, weights):
+    """ A Correspondence from its weights, (source, target, weight) ordered by target. """
+    source_codes = numpy.asarray(source_codes, dtype=object)
+    target_codes = numpy.asarray(target_codes, dtype=object)
+    unique_sources, source_index = numpy.unique(source_codes, return_inverse=True)
+    target_starts = numpy.flatnonzero(numpy.r_[True, target_codes[1:] != target_codes[:-1]])
+    return Correspondence(unique_sources, target_codes[target_starts], source_index, target_starts, numpy.asarray(weights, dtype=numpy.float64))
@@ -0,0 +1,306 @@
+#
+# EAlGIS loader: Australian Census 2011; CSV scanner
+#
+# The sequential number DataPack CSV files are plain, unquoted numeric
+# text. Rather than building a str per cell with the csv module, the
+# scanner memory-maps a file, finds every row and field boundary in bulk
+# with NumPy, and parses the numeric fields straight into float columns,
+# detecting ".." (not applicable) from the raw bytes.
+#
+# The scanned buffer is shared by the steps that used to re-read each
+# file: merging profile table CSVs, splitting them by series (both written
+# by gathering field bytes, without parsing), detecting not applicable
+# columns and inferring column types.
+#
+# e.g.
+#   scan = scan_csv(path)
+#   scan.header           # ["region_id", "B130", ...]
+#   scan.region_ids       # ["101011001", ...]
+#   scan.values           # float64 array (rows, columns - 1), NaN where not numeric
+#   scan.na               # bool array, True where the cell is ".."
+#
+
+import mmap
+import numpy
+from collections import OrderedDict
+
+NEWLINE, CARRIAGE_RETURN, COMMA, QUOTE = ord("\n"), ord("\r"), ord(","), ord('"')
+DOT, MINUS, ZERO, NINE = ord("."), ord("-"), ord("0"), ord("9")
+
+# Fields wider than this are parsed one by one with float() (18 digits
+# always fit the int64 accumulator)
+MAX_FIELD_WIDTH = 18
+# Decimals with more digits than this can't be scaled exactly (the digits
+# are rounded to float64 before the division), so they're parsed with
+# float() too
+EXACT_DIGITS_LIMIT = 2 ** 53
+# Fields parsed (or written) per vectorised chunk, bounding scratch memory
+CHUNK_FIELDS = 1 << 17
+
+
+def parse_fields(data, starts, ends):
+    """
+    Parse the fields data[starts[i]:ends[i]] as numbers.
+
+    Returns (values, na, fractional, invalid): float64 values (NaN unless
+    the field is a number) and bool masks of the fields that are "..",
+    that have a decimal point and that are neither numbers, ".." nor empty.
+    """
+    n = len(starts)
+    values = numpy.full(n, numpy.nan)
+    na = numpy.zeros(n, dtype=bool)
+    fractional = numpy.zeros(n, dtype=bool)
+    invalid = numpy.zeros(n, dtype=bool)
+    inexact = numpy.zeros(n, dtype=bool)
+    if n == 0 or len(data) == 0:
+        return values, na, fractional, invalid
+
+    offsets = numpy.arange(MAX_FIELD_WIDTH)
+    last = len(data) - 1
+    for lo in range(0, n, CHUNK_FIELDS):
+        hi = min(n, lo + CHUNK_FIELDS)
+        s, lengths = starts[lo:hi], ends[lo:hi] - starts[lo:hi]
+        mask = offsets < lengths[:, None]
+        chars = numpy.where(mask, data[numpy.minimum(s[:, None] + offsets, last)], 0)
+
+        is_digit = (chars >= ZERO) & (chars <= NINE)
+        is_dot = chars == DOT
+        negative = chars[:, 0] == MINUS
+        allowed = is_digit | is_dot | ((offsets == 0) & (chars == MINUS)) | ~mask
+        number = allowed.all(axis=1) & (is_dot.sum(axis=1) <= 1) & is_digit.any(axis=1) & (lengths <= MAX_FIELD_WIDTH)
+
+        # Horner's rule over the digits, ignoring the decimal point
+        accumulated = numpy.zeros(hi - lo, dtype=numpy.int64)
+        for w in range(MAX_FIELD_WIDTH):
+            accumulated = numpy.where(is_digit[:, w], accumulated * 10 + (chars[:, w].astype(numpy.int64) - ZERO), accumulated)
+        has_dot = is_dot.any(axis=1)
+        dot_position = numpy.where(has_dot, numpy.argmax(is_dot, axis=1), lengths)
+        decimals = (is_digit & (offsets > dot_position[:, None])).sum(axis=1)
+        parsed = accumulated / numpy.power(10.0, decimals)
+        parsed = numpy.where(negative, -parsed, parsed)
+
+        chunk_na = (lengths == 2) & (chars[:, 0] == DOT) & (chars[:, 1] == DOT)
+        values[lo:hi] = numpy.where(number, parsed, numpy.nan)
+        na[lo:hi] = chunk_na
+        fractional[lo:hi] = number & has_dot
+        invalid[lo:hi] = ~number & ~chunk_na & (lengths > 0)
+        inexact[lo:hi] = number & (decimals > 0) & (accumulated >= EXACT_DIGITS_LIMIT)
+
+    # The (rare) fields too wide or too precise for the vectorised parse
+    for i in numpy.flatnonzero((invalid & ((ends - starts) > MAX_FIELD_WIDTH)) | inexact):
+        try:
+            values[i] = float(bytes(data[starts[i]:ends[i]]))
+            fractional[i] = DOT in data[starts[i]:ends[i]]
+            invalid[i] = False
+        except ValueError:
+            pass
+    return values, na, fractional, invalid
+
+
+class ScannedCSV:
+    """
+    A memory-mapped CSV file with the byte offsets of every field.
+
+    starts, ends: int64 arrays of shape (lines, columns), the header being
+        line 0. Fields are data[starts:ends], without separators.
+    """
+
+    def __init__(self, path, mm, data, starts, ends):
+        self.path = path
+        self._mm = mm
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+        self.header = [self.field(0, c) for c in range(starts.shape[1])]
+        self._parsed = None
+
+    @property
+    def rows(self):
+        """ The number of data rows (excluding the header). """
+        return self.starts.shape[0] - 1
+
+    @property
+    def columns(self):
+        return self.starts.shape[1]
+
+    def field(self, line, column):
+        return bytes(self.data[self.starts[line, column]:self.ends[line, column]]).decode("utf-8")
+
+    @property
+    def region_ids(self):
+        return [self.field(line, 0) for line in range(1, self.rows + 1)]
+
+    def _parse(self):
+        if self._parsed is None:
+            starts, ends = self.starts[1:, 1:], self.ends[1:, 1:]
+            shape = starts.shape
+            self._parsed = tuple(a.reshape(shape) for a in parse_fields(self.data, starts.ravel(), ends.ravel()))
+        return self._parsed
+
+    @property
+    def values(self):
+        """ float64 array of the data columns (all but the first), NaN where not a number. """
+        return self._parse()[0]
+
+    @property
+    def na(self):
+        return self._parse()[1]
+
+    @property
+    def invalid(self):
+        return self._parse()[3]
+
+    def not_applicable_columns(self):
+        """ The names of the data columns in which every cell is "..". """
+        if self.rows == 0:
+            return []
+        return [self.header[i + 1] for i in numpy.flatnonzero(self.na.all(axis=0))]
+
+    def invalid_cells(self, limit=10):
+        """ Up to limit (region_id, column name, value) cells that are neither numbers nor "..". """
+        cells = []
+        for row, column in zip(*numpy.nonzero(self.invalid)):
+            cells.append((self.field(row + 1, 0), self.header[column + 1], self.field(row + 1, column + 1)))
+            if len(cells) == limit:
+                break
+        return cells
+
+    def column_types(self):
+        """
+        The PostgreSQL type of each data column: bigint if it only holds
+        whole numbers (or nothing), double precision if it holds decimals,
+        text if it holds anything else.
+        """
+        _, _, fractional, invalid = self._parse()
+        types = []
+        for column in range(self.columns - 1):
+            if invalid[:, column].any():
+                types.append("text")
+            elif fractional[:, column].any():
+                types.append("double precision")
+            else:
+                types.append("bigint")
+        return types
+
+    def line_bytes(self, line, from_column=0):
+        """ The raw bytes of a line, from the start of from_column, without its newline. """
+        return self.data[self.starts[line, from_column]:self.ends[line, -1]]
+
+    def write_columns(self, f, columns, header=None):
+        """
+        Write the given columns (indexes, or None for an empty column) of
+        every line to the binary file f by gathering their bytes - no field
+        is parsed or decoded. The header line is replaced by header, if
+        given.
+        """
+        columns = list(columns)
+        k = len(columns)
+        if k == 0:
+            return
+        first_line = 0
+        if header is not None:
+            f.write((",".join(header) + "\n").encode("utf-8"))
+            first_line = 1
+        present = numpy.array([c is not None for c in columns])
+        indexes = numpy.array([c if c is not None else 0 for c in columns])
+        separators = numpy.full(k, COMMA, dtype=numpy.uint8)
+        separators[-1] = NEWLINE
+
+        lines_per_chunk = max(1, CHUNK_FIELDS // k)
+        for lo in range(first_line, self.starts.shape[0], lines_per_chunk):
+            hi = min(self.starts.shape[0], lo + lines_per_chunk)
+            starts = self.starts[lo:hi][:, indexes].ravel()
+            lengths = numpy.where(present, self.ends[lo:hi][:, indexes] - self.starts[lo:hi][:, indexes], 0).ravel()
+
+            # Every field is followed by a separator: a comma or a newline
+            out_lengths = lengths + 1
+            out_starts = numpy.cumsum(out_lengths) - out_lengths
+            out = numpy.empty(int(out_lengths.sum()), dtype=numpy.uint8)
+            out[out_starts + lengths] = numpy.tile(separators, hi - lo)
+
+            field_of_byte = numpy.repeat(numpy.arange(len(lengths)), lengths)
+            within = numpy.arange(int(lengths.sum())) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+            out[out_starts[field_of_byte] + within] = self.data[starts[field_of_byte] + within]
+            f.write(out.tobytes())
+
+    def close(self):
+        self._parsed = None
+        self.data = None
+        try:
+            self._mm.close()
+        except (BufferError, ValueError):
+            # Arrays derived from the map are still referenced; leave it to the GC
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def scan_csv(path):
+    """
+    Memory-map and scan a CSV file.
+
+    Raises ValueError if the file is empty, quoted or doesn't have the same
+    number of fields on every line.
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = numpy.frombuffer(mm, dtype=numpy.uint8)
+    if (data == QUOTE).any():
+        raise ValueError("{}: quoted CSV files aren't supported by the scanner".format(path))
+
+    newlines = numpy.flatnonzero(data == NEWLINE)
+    line_ends = newlines if data[-1] == NEWLINE else numpy.append(newlines, len(data))
+    line_starts = numpy.concatenate([[0], newlines + 1])[:len(line_ends)]
+    line_ends = line_ends - ((line_ends > line_starts) & (data[numpy.maximum(line_ends - 1, 0)] == CARRIAGE_RETURN))
+    nonblank = line_ends > line_starts
+    line_starts, line_ends = line_starts[nonblank], line_ends[nonblank]
+
+    commas = numpy.flatnonzero(data == COMMA)
+    first_comma = numpy.searchsorted(commas, line_starts)
+    per_line = numpy.searchsorted(commas, line_ends) - first_comma
+    if len(per_line) == 0 or (per_line != per_line[0]).any():
+        raise ValueError("{}: lines don't all have the same number of fields".format(path))
+
+    separators = commas[first_comma[:, None] + numpy.arange(per_line[0])]
+    starts = numpy.hstack([line_starts[:, None], separators + 1])
+    ends = numpy.hstack([separators, line_ends[:, None]])
+    return ScannedCSV(path, mm, data, starts, ends)
+
+
+def write_merged_csv(scans, path):
+    """
+    Join the lines of several scanned CSV files on their first column (as
+    the profile table CSVs of a DataPack table are): lines in the order of
+    the first file, the columns of each file in turn. Lines missing from a
+    file get empty fields.
+
+    Returns the number of lines written, header included.
+    """
+    order = OrderedDict()
+    by_key = []
+    for scan in scans:
+        keys = {}
+        for line in range(scan.starts.shape[0]):
+            key = bytes(scan.data[scan.starts[line, 0]:scan.ends[line, 0]])
+            keys[key] = line
+            order.setdefault(key, None)
+        by_key.append(keys)
+
+    with open(path, "wb") as f:
+        for key in order:
+            parts = [key]
+            for scan, keys in zip(scans, by_key):
+                line = keys.get(key)
+                if scan.columns == 1:
+                    continue
+                if line is None:
+                    parts.append(b"," * (scan.columns - 1))
+                else:
+                    parts.append(b"," + scan.line_bytes(line, from_column=1).tobytes())
+            parts.append(b"\n")
+            f.write(b"".join(parts))
+    return len(order)
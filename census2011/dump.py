@@ -0,0 +1,130 @@
+#
+# EAlGIS loader: Australian Census 2011; parallel dump and restore
+#
+# Dumps each schema to its own directory-format archive (pg_dump -Fd), so
+# that schemas are dumped concurrently and each schema's tables are dumped
+# and restored with several jobs (-j). Restores run the pre-data, data and
+# post-data sections separately, so indexes and constraints are built once
+# the data is in, and finish with a parallel ANALYZE of every table.
+#
+# Connection details come from the same environment variables as the
+# loader (DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD).
+#
+
+import os
+import time
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+
+from ealgis_common.util import make_logger
+from .instrument import stage, dir_size
+
+logger = make_logger(__name__)
+
+# pg_dump / pg_restore jobs per schema
+DUMP_JOBS = 4
+# Schemas dumped at the same time
+SCHEMA_WORKERS = 2
+ANALYZE_WORKERS = 8
+
+
+def pg_environ():
+    """ The environment for pg_dump / pg_restore, from the loader's DB_* variables. """
+    env = dict(os.environ)
+    for pg_var, db_var in (("PGHOST", "DB_HOST"), ("PGPORT", "DB_PORT"), ("PGUSER", "DB_USERNAME"), ("PGPASSWORD", "DB_PASSWORD")):
+        if db_var in os.environ:
+            env[pg_var] = os.environ[db_var]
+    return env
+
+
+def make_engine(db_name):
+    env = pg_environ()
+    return sqlalchemy.create_engine("postgresql://{}:{}@{}:{}/{}".format(
+        env.get("PGUSER", "postgres"), env.get("PGPASSWORD", ""),
+        env.get("PGHOST", "localhost"), env.get("PGPORT", "5432"), db_name))
+
+
+def _run(cmd):
+    logger.info(" ".join(cmd))
+    subprocess.check_call(cmd, env=pg_environ())
+
+
+def schema_dump_dir(dump_dir, schema):
+    return os.path.join(dump_dir, schema)
+
+
+def dump_schemas(db_name, dump_dir, schemas, jobs=DUMP_JOBS, workers=SCHEMA_WORKERS):
+    """
+    Dump each schema to <dump_dir>/<schema>/ in directory format, with
+    workers schemas dumped at a time and jobs parallel jobs per schema.
+
+    Returns the dump directories.
+    """
+    def dump_one(schema):
+        path = schema_dump_dir(dump_dir, schema)
+        if os.path.exists(path):
+            # pg_dump -Fd refuses to write into an existing directory
+            shutil.rmtree(path)
+        with stage("dump", table=schema) as timer:
+            _run(["pg_dump", "-Fd", "-j", str(jobs), "--schema", schema, "-f", path, db_name])
+            timer.add(bytes=dir_size(path))
+        return path
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(dump_one, schemas))
+
+
+def get_schema_tables(engine, schemas):
+    with engine.connect() as conn:
+        rows = conn.execute(sqlalchemy.text("""
+            SELECT schemaname, tablename FROM pg_tables
+            WHERE schemaname = ANY(:schemas)
+            ORDER BY schemaname, tablename"""), schemas=list(schemas))
+        return [(schema, table) for schema, table in rows]
+
+
+def analyze_tables(engine, tables, workers=ANALYZE_WORKERS):
+    """ ANALYZE each (schema, table), workers at a time on their own connections. """
+    def analyze_one(schema_table):
+        with engine.connect() as conn:
+            conn.execution_options(autocommit=True).execute('ANALYZE "{}"."{}"'.format(*schema_table))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(analyze_one, tables))
+
+
+def restore_schemas(db_name, dump_dir, schemas, jobs=DUMP_JOBS, analyze_workers=ANALYZE_WORKERS, clean=False):
+    """
+    Restore the directory-format dumps of schemas into db_name: the tables
+    (pre-data) for every schema first, then the data, then the indexes and
+    constraints (post-data), the latter two with jobs parallel jobs. Every
+    restored table is then analyzed.
+
+    Returns the total restore time in seconds.
+    """
+    started = time.perf_counter()
+    paths = [(schema, schema_dump_dir(dump_dir, schema)) for schema in schemas]
+    for schema, path in paths:
+        if not os.path.isdir(path):
+            raise Exception("No directory-format dump of '{}' at {}".format(schema, path))
+
+    for section, section_jobs in (("pre-data", 1), ("data", jobs), ("post-data", jobs)):
+        with stage("restore " + section):
+            for schema, path in paths:
+                with stage(section, table=schema):
+                    cmd = ["pg_restore", "--section", section, "-j", str(section_jobs), "--dbname", db_name]
+                    if clean and section == "pre-data":
+                        cmd += ["--clean", "--if-exists"]
+                    _run(cmd + [path])
+
+    engine = make_engine(db_name)
+    tables = get_schema_tables(engine, schemas)
+    with stage("analyze", rows=len(tables)):
+        analyze_tables(engine, tables, analyze_workers)
+
+    elapsed = time.perf_counter() - started
+    logger.info("restored %d schemas (%d tables) in %.1fs" % (len(schemas), len(tables), elapsed))
+    return elapsed
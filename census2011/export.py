@@ -0,0 +1,200 @@
+#
+# EAlGIS loader: Australian Census 2011; Parquet export
+#
+# Writes every attribute table and shape table as Parquet, for use from
+# DuckDB, pandas and friends, alongside the PostgreSQL dumps:
+#
+#   <export_dir>/<package>/<division>/<table>.parquet
+#   <export_dir>/shapes/<division>.parquet
+#
+# Rows are streamed out of PostgreSQL in batches (so no table is held in
+# memory), geometry is written as WKB, and the table and column metadata
+# registered by the loader is embedded as file-level key/value metadata.
+#
+# pyarrow is only required to export.
+#
+
+import os
+import re
+import json
+from decimal import Decimal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+
+from ealgis_common.util import make_logger
+from .attrs import PACKAGES, package_schema_name
+from .shapes import SHAPE_SCHEMA, SHAPE_LINKAGE
+from .instrument import report, stage, file_size
+from .selection import ALL
+
+logger = make_logger(__name__)
+
+EXPORT_WORKERS = 4
+EXPORT_BATCH_ROWS = 50000
+EXPORT_COMPRESSION = "zstd"
+
+# Prefix for the key/value metadata embedded in each file
+METADATA_PREFIX = "ealgis:"
+
+EXPORT_TABLE_RE = re.compile(r'^[a-z]+[0-9]+(s[0-9]{1,2})?_[a-z]+_(?P<division>[a-z0-9]+)$')
+
+
+def _arrow_type(pa, data_type, udt_name):
+    """ The Arrow type for a PostgreSQL column, as reported by information_schema. """
+    if udt_name == "geometry":
+        return pa.binary()
+    return {
+        "smallint": pa.int16(),
+        "integer": pa.int32(),
+        "bigint": pa.int64(),
+        "real": pa.float32(),
+        "double precision": pa.float64(),
+        "numeric": pa.float64(),
+        "boolean": pa.bool_(),
+        "date": pa.date32(),
+    }.get(data_type, pa.string())
+
+
+def get_table_columns(conn, schema, table_name):
+    """ Returns [(column_name, data_type, udt_name)] in table order. """
+    return list(conn.execute(sqlalchemy.text("""
+        SELECT column_name, data_type, udt_name FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :table
+        ORDER BY ordinal_position"""), schema=schema, table=table_name))
+
+
+def get_registered_metadata(conn, schema):
+    """
+    The table and column metadata registered for a package schema.
+
+    Returns -
+    metadata[table_name] = (table metadata json, {column_name: column metadata json})
+    """
+    metadata = OrderedDict()
+    rows = conn.execute("""
+        SELECT t.name, t.metadata_json, c.name, c.metadata_json
+        FROM "{schema}".table_info t
+        LEFT JOIN "{schema}".column_info c ON c.tableinfo_id = t.id
+        ORDER BY t.name, c.id""".format(schema=schema))
+    for table_name, table_json, column_name, column_json in rows:
+        if table_name not in metadata:
+            metadata[table_name] = (table_json, OrderedDict())
+        if column_name is not None:
+            metadata[table_name][1][column_name] = column_json
+    return metadata
+
+
+def plan_export(engine, export_dir, packages=PACKAGES, selection=ALL):
+    """
+    Returns [(schema, table_name, path, key_value_metadata)] for every
+    (selected) shape table and registered attribute table.
+    """
+    plan = []
+    for division in SHAPE_LINKAGE:
+        if not selection.division(division):
+            continue
+        plan.append((SHAPE_SCHEMA, division, os.path.join(export_dir, "shapes", division + ".parquet"), {
+            "division": division,
+            "geometry_encoding": "WKB",
+        }))
+
+    with engine.connect() as conn:
+        for _, abbrev, _, _ in packages:
+            if not selection.package(abbrev):
+                continue
+            schema = package_schema_name(abbrev)
+            for table_name, (table_json, columns) in get_registered_metadata(conn, schema).items():
+                m = EXPORT_TABLE_RE.match(table_name)
+                if m is None:
+                    continue
+                division = m.group("division")
+                path = os.path.join(export_dir, abbrev.lower(), division, table_name + ".parquet")
+                plan.append((schema, table_name, path, {
+                    "package": abbrev.lower(),
+                    "division": division,
+                    "table": table_json or "{}",
+                    "columns": json.dumps(OrderedDict((name, json.loads(meta) if meta else {}) for name, meta in columns.items())),
+                }))
+    return plan
+
+
+def export_table(engine, schema, table_name, path, key_value_metadata, batch_rows=EXPORT_BATCH_ROWS, compression=EXPORT_COMPRESSION):
+    """
+    Stream a table into a Parquet file, dictionary encoded and compressed.
+    Geometry columns are converted to WKB in the database.
+
+    Returns the number of rows written, or None if the table doesn't exist.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows_written = 0
+    with stage("export", table="{}.{}".format(schema, table_name)) as timer, engine.connect() as conn:
+        columns = get_table_columns(conn, schema, table_name)
+        if not columns:
+            logger.warning("%s.%s: no such table, not exported" % (schema, table_name))
+            return None
+        select = ", ".join(
+            'ST_AsBinary("{0}") AS "{0}"'.format(name) if udt_name == "geometry" else '"{}"'.format(name)
+            for name, _, udt_name in columns)
+        schema_metadata = dict(
+            (METADATA_PREFIX + k, v) for k, v in key_value_metadata.items())
+        arrow_schema = pa.schema(
+            [pa.field(name, _arrow_type(pa, data_type, udt_name)) for name, data_type, udt_name in columns],
+            metadata=schema_metadata)
+
+        result = conn.execution_options(stream_results=True).execute(
+            'SELECT {} FROM "{}"."{}" ORDER BY gid'.format(select, schema, table_name))
+        tmp_path = path + ".tmp"
+        with pq.ParquetWriter(tmp_path, arrow_schema, compression=compression, use_dictionary=True) as writer:
+            while True:
+                rows = result.fetchmany(batch_rows)
+                if not rows:
+                    break
+                arrays = [
+                    pa.array([_as_python(r[i]) for r in rows], type=field.type)
+                    for i, field in enumerate(arrow_schema)]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=arrow_schema))
+                rows_written += len(rows)
+        os.replace(tmp_path, path)
+        timer.add(rows=rows_written, bytes=file_size(path))
+    return rows_written
+
+
+def _as_python(value):
+    # psycopg2 hands bytea back as memoryview and numeric as Decimal
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def export_parquet(engine, export_dir, packages=PACKAGES, workers=EXPORT_WORKERS, batch_rows=EXPORT_BATCH_ROWS, compression=EXPORT_COMPRESSION, selection=ALL):
+    """
+    Export the shape tables and the attribute tables of packages to
+    export_dir, writing up to workers tables at a time (each on its own
+    database connection).
+
+    Returns the paths written.
+    """
+    with stage("export plan"):
+        plan = plan_export(engine, export_dir, packages, selection)
+    logger.info("exporting %d tables to %s" % (len(plan), export_dir))
+
+    # The workers' export stages are nested within the caller's stage
+    parent = report.current()
+
+    def export_one(entry):
+        schema, table_name, path, key_value_metadata = entry
+        with report.attach(parent):
+            exported = export_table(engine, schema, table_name, path, key_value_metadata, batch_rows, compression)
+        if exported is None:
+            return None
+        return path
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [path for path in executor.map(export_one, plan) if path is not None]
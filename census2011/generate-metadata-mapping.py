@@ -1,18 +1,124 @@
+#!/usr/bin/env python
+
+#
+# EAlGIS loader: Australian Census 2011; metadata mapping generator
+#
+# Regenerates the *_metadata_mapping.json files (each table's metadata
+# URLs and notes, merged into the table metadata by load_metadata) from the
+# ABS profile template workbooks, e.g.
+#
+#   python census2011/generate-metadata-mapping.py "/data/2011 Datapacks BCP_IP_TSP_PEP_ECP_WPP_ERP_Release 3/Metadata/"
+#
+# Each workbook is read once, in read-only mode, into an in-memory grid per
+# sheet (hyperlinks, which read-only mode doesn't provide, are read from
+# the workbook's XML), and the sheets of every workbook are parsed across a
+# process pool. Workbooks whose SHA-256 hasn't changed since the mapping
+# was last generated from them are skipped (see CACHE_FILENAME).
+#
+# The notes of some tables were merged by hand (see the end of this file
+# and HAND_MERGED_TABLES); their entries in an existing mapping are kept
+# as they are. A mapping that exists but wasn't generated by this script
+# (it has no cache entry) is only overwritten with --force. Check the diff
+# of a regenerated mapping before committing it.
+#
+
 import os
-import openpyxl
 import re
+import glob
 import json
+import zipfile
+import hashlib
+import argparse
+import posixpath
+import openpyxl
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
 
 
 class ParserWarning(Exception):
     pass
 
 
+# Profile_template_with_sequential_numbers_2011_XCP.xlsx (BCP and IP have a space for the second underscore)
+TEMPLATE_GLOB = "Profile_template_with*sequential_numbers_2011_*.xlsx"
+TEMPLATE_RE = re.compile(r'^Profile_template_with[ _]sequential_numbers_2011_([A-Z]+)\.xlsx$')
+CACHE_FILENAME = ".metadata_mapping_cache.json"
+
+# The tables whose records or notes were created by hand, by package
+HAND_MERGED_TABLES = {
+    "BCP": ("B01", "B02", "B04", "B10", "B13"),
+}
+
+# A worksheet read into memory: rows[row - 1][column - 1] is a cell's
+# value, hyperlinks[(row, column)] its hyperlink's target (1-based, as in
+# Excel)
+Sheet = namedtuple("Sheet", ["name", "rows", "hyperlinks"])
+
+_XLSX_NS = {
+    "main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "rel": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "pkg": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+
+
+def _cell_position(ref):
+    """ "B12" -> (12, 2) """
+    m = re.match(r'^([A-Z]+)([0-9]+)$', ref)
+    column = 0
+    for letter in m.group(1):
+        column = column * 26 + ord(letter) - ord("A") + 1
+    return int(m.group(2)), column
+
+
+def read_hyperlinks(path):
+    """
+    Returns -
+    hyperlinks[sheet_name][(row, column)] = target, for every external hyperlink
+    """
+    def rels(z, part):
+        rels_path = posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels")
+        if rels_path not in z.namelist():
+            return {}
+        root = ElementTree.fromstring(z.read(rels_path))
+        return {r.get("Id"): r.get("Target") for r in root.findall("pkg:Relationship", _XLSX_NS)}
+
+    hyperlinks = {}
+    with zipfile.ZipFile(path) as z:
+        workbook_rels = rels(z, "xl/workbook.xml")
+        workbook = ElementTree.fromstring(z.read("xl/workbook.xml"))
+        for sheet in workbook.find("main:sheets", _XLSX_NS):
+            target = workbook_rels[sheet.get("{%s}id" % _XLSX_NS["rel"])]
+            part = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+            sheet_rels = rels(z, part)
+            links = {}
+            for link in ElementTree.fromstring(z.read(part)).iterfind("main:hyperlinks/main:hyperlink", _XLSX_NS):
+                rel_id = link.get("{%s}id" % _XLSX_NS["rel"])
+                if rel_id in sheet_rels:
+                    links[_cell_position(link.get("ref").split(":")[0])] = sheet_rels[rel_id]
+            hyperlinks[sheet.get("name")] = links
+    return hyperlinks
+
+
+def read_workbook(path):
+    """ Read every sheet of a workbook (but the first, the contents) into a Sheet. """
+    hyperlinks = read_hyperlinks(path)
+    wb = openpyxl.load_workbook(path, read_only=True)
+    sheets = []
+    for ws in wb.worksheets[1:]:
+        rows = [[cell.value for cell in row] for row in ws.iter_rows()]
+        width = max([len(row) for row in rows] or [0])
+        sheets.append(Sheet(ws.title, [row + [None] * (width - len(row)) for row in rows], hyperlinks.get(ws.title, {})))
+    wb.close()
+    return sheets
+
+
 def findFindOutMoreCell(sheet):
-    for row in sheet.iter_rows():
-        for cell in row:
-            if cell.value == "Find out more:":
-                return cell
+    """ The (row, column) of the "Find out more:" cell. """
+    for row, values in enumerate(sheet.rows, 1):
+        for column, value in enumerate(values, 1):
+            if value == "Find out more:":
+                return row, column
     # raise Exception("Failed to find the 'Find out more:' row.")
     return None
 
@@ -22,10 +128,10 @@ def findStartRow(sheet):
     if findOutMoreCell is None:
         return 2  # If there are metadata URLs (e.g. T01) then we start on row 2
 
-    for row in sheet.iter_rows(row_offset=findOutMoreCell.row):
-        cell = row[findOutMoreCell.col_idx - 1]
-        if cell.value is None:
-            return cell.row + 1
+    findOutMoreRow, column = findOutMoreCell
+    for row in range(findOutMoreRow + 1, len(sheet.rows) + 1):
+        if sheet.rows[row - 1][column - 1] is None:
+            return row + 1
     raise Exception("Failed to find start row.")
 
 
@@ -34,11 +140,12 @@ def getMetadataURLs(sheet):
     if findOutMoreCell is None:
         return []  # No metadata URLs is OK (e.g. T01)
 
+    findOutMoreRow, column = findOutMoreCell
     metadataUrls = []
-    for row in sheet.iter_rows(row_offset=findOutMoreCell.row):
-        cell = row[findOutMoreCell.col_idx - 1]
-        if cell.hyperlink is not None and cell.hyperlink.target is not None:
-            metadataUrls.append({"name": cell.value, "url": cell.hyperlink.target})
+    for row in range(findOutMoreRow + 1, len(sheet.rows) + 1):
+        target = sheet.hyperlinks.get((row, column))
+        if target is not None:
+            metadataUrls.append({"name": sheet.rows[row - 1][column - 1], "url": target})
     return metadataUrls
 
 
@@ -64,41 +171,39 @@ def getMetadataURLs(sheet):
 
 
 def getNotes(sheet):
-    def getFirstCellFromRow(row):
-        if sheetName == "T 32d" or sheetName == "T 33" or\
-                sheetName == "P 38b":
-            return row[1]  # Column A in these tables is hidden...Because Reasons
-        return row[0]
+    def getFirstCell(row):
+        """ The value of the first column of a row (1-based). """
+        if sheet.name == "T 32d" or sheet.name == "T 33" or\
+                sheet.name == "P 38b":
+            return sheet.rows[row - 1][1]  # Column A in these tables is hidden...Because Reasons
+        return sheet.rows[row - 1][0]
 
     def findNotesStartRow(sheet):
         firstRowWithAValue = None
-        for row in reversed(list(sheet.iter_rows())):
-            firstCell = getFirstCellFromRow(row)
-            if firstRowWithAValue is None and firstCell.value is not None:
+        for row in range(len(sheet.rows), 0, -1):
+            firstCell = getFirstCell(row)
+            if firstRowWithAValue is None and firstCell is not None:
                 # First row is also the only row with notes
-                if str(firstCell.value).startswith("This table is based"):
-                    return firstCell.row - 1
-                firstRowWithAValue = firstCell.value
+                if str(firstCell).startswith("This table is based"):
+                    return row - 1
+                firstRowWithAValue = firstCell
             elif firstRowWithAValue is not None:
                 # The first row with no value signals the end of the notes section
-                if firstCell.value is None or str(firstCell.value).strip() == "":
-                    return firstCell.row
+                if firstCell is None or str(firstCell).strip() == "":
+                    return row
         raise Exception("Failed to find notes start row.")
 
     def findRowLabelsForNoteIdentifier(sheet, noteId):
         rowLabels = []
-        for row in sheet.iter_rows(row_offset=findStartRow(sheet)):
-            firstCell = getFirstCellFromRow(row)
-            if firstCell.row == notesStartRow:
+        for row in range(startRow + 1, len(sheet.rows) + 1):
+            firstCell = getFirstCell(row)
+            if row == notesStartRow:
                 break
-            if firstCell.value is None:
+            if firstCell is None:
                 continue
 
-            # print("Checking {noteId} in '{rowVal}'".format(noteId=noteId, rowVal=firstCell.value))
-            match = re.search(r"^(?P<rowLabel>.+?)(?P<noteIdentifier>\({noteId}\))+[:]?".format(noteId=noteId), firstCell.value)
+            match = re.search(r"^(?P<rowLabel>.+?)(?P<noteIdentifier>\({noteId}\))+[:]?".format(noteId=noteId), firstCell)
             if match is not None:
-                # print("Found!")
-                # print(match.groups(), "//", match.group("rowLabel").strip(), "//", match.group("noteIdentifier"))
                 rowLabels.append(match.group("rowLabel").strip())
         # Where profile tables span multiple worksheets notes may refer to rows on another page (e.g. B01A)
         return rowLabels
@@ -109,11 +214,9 @@ def getNotes(sheet):
             match = re.search(r"^(?P<noteIdentifier>\([a-z]{1}\))\s", note)
             if match is not None:
                 noteId = match.group("noteIdentifier")
-                # print(noteId)
 
                 rowLabels = findRowLabelsForNoteIdentifier(sheet, noteId)
                 if len(rowLabels) > 0:
-                    # print(rowLabels)
                     # Reformat the note to include the name of the row we're referring to e.g.
                     # "(a) Applicable to persons who are of both Aboriginal and Torres Strait Islander origin."
                     # becomes
@@ -126,22 +229,21 @@ def getNotes(sheet):
             else:
                 # For the start of the notes e.g. "This table is based on..."
                 formattedNotes.append(note)
-            # print
         return formattedNotes
 
     # The whole ERP series has two tables and no notes in either
-    if sheetName == "E01" or sheetName == "E02":
+    if sheet.name == "E01" or sheet.name == "E02":
         return []
 
     notesStartRow = findNotesStartRow(sheet)
-    # print("notesStartRow", notesStartRow)
+    startRow = findStartRow(sheet)
 
     notes = []
-    for row in sheet.iter_rows(row_offset=notesStartRow):
-        firstCell = getFirstCellFromRow(row)
-        if firstCell.value is None:
+    for row in range(notesStartRow + 1, len(sheet.rows) + 1):
+        firstCell = getFirstCell(row)
+        if firstCell is None:
             break
-        notes.append(firstCell.value.strip())
+        notes.append(firstCell.strip())
 
     notes = linkNotesAndColumns(sheet, notes)
     return notes
@@ -222,51 +324,138 @@ def mergeNotesFromMultipleProfileTables(notes, newNotes):
 #         print
 
 
-base_dir = "/Users/keithmoss/Documents/Work/GitHub/ealgis/data-loader/data/ealgis-aus-census-2011-master/2011 Datapacks BCP_IP_TSP_PEP_ECP_WPP_ERP_Release 3_Partial/Metadata/"
-# seriesName = "MALES"
-
-# xl = openpyxl.load_workbook(os.path.join(base_dir, "Profile_template_with sequential_numbers_2011_BCP.xlsx"))
-# xl = openpyxl.load_workbook(os.path.join(base_dir, "Profile_template_with sequential_numbers_2011_IP.xlsx"))
-# xl = openpyxl.load_workbook(os.path.join(base_dir, "Profile_template_with sequential_numbers_2011_TSP.xlsx"))
-# xl = openpyxl.load_workbook(os.path.join(base_dir, "Profile_template_with_sequential_numbers_2011_ERP.xlsx"))
-# xl = openpyxl.load_workbook(os.path.join(base_dir, "Profile_template_with_sequential_numbers_2011_PEP.xlsx"))
-# xl = openpyxl.load_workbook(os.path.join(base_dir, "Profile_template_with_sequential_numbers_2011_WPP.xlsx"))
-xl = openpyxl.load_workbook(os.path.join(base_dir, "Profile_template_with_sequential_numbers_2011_XCP.xlsx"))
-# print(xl.get_sheet_names())
-
-
-metadataMapping = {"tables": {}}
-
-for sheetName in xl.get_sheet_names()[1:]:
-    # if sheetName == "B 04" or sheetName == "B 02":
-    #     continue
-    # if not (sheetName == "I 01a" or sheetName == "I 01b"):
-    #     continue
-    # if sheetName != "T 32d":
-    #     continue
-    m = re.match('^([A-Za-z]+[0-9]+)([a-z]+)?$', sheetName.replace(" ", ""))
+def parse_sheet(sheet):
+    """ Returns (table_number, metadataUrls, notes) for a profile table's sheet. """
+    m = re.match('^([A-Za-z]+[0-9]+)([a-z]+)?$', sheet.name.replace(" ", ""))
     table_number = m.groups()[0]  # b46a -> b46
-    print("{} ({})".format(sheetName, table_number))
-
-    sheet = xl[sheetName]
-
-    # serises = findSerises(sheet)
-    metadataUrls = getMetadataURLs(sheet)
-    notes = getNotes(sheet)
-
-    if table_number not in metadataMapping["tables"]:
-        metadataMapping["tables"][table_number] = {
-            "metadataUrls": metadataUrls,
-            "notes": notes,
-        }
-    else:
-        metadataMapping["tables"][table_number]["notes"] = mergeNotesFromMultipleProfileTables(metadataMapping["tables"][table_number]["notes"], notes)
-
-for table_name in metadataMapping["tables"]:
-    metadataMapping["tables"][table_name]["notes"] = "<br />".join(metadataMapping["tables"][table_name]["notes"])
-
-with open("xcp_metadata_mapping.json", "w") as f:
-    f.write(json.dumps(metadataMapping, indent=2, sort_keys=True))
+    return table_number, getMetadataURLs(sheet), getNotes(sheet)
+
+
+def build_metadata_mapping(parsed_sheets):
+    """ Merge the parsed sheets of a workbook (in order) into its metadata mapping. """
+    metadataMapping = {"tables": {}}
+    for table_number, metadataUrls, notes in parsed_sheets:
+        if table_number not in metadataMapping["tables"]:
+            metadataMapping["tables"][table_number] = {
+                "metadataUrls": metadataUrls,
+                "notes": notes,
+            }
+        else:
+            metadataMapping["tables"][table_number]["notes"] = mergeNotesFromMultipleProfileTables(metadataMapping["tables"][table_number]["notes"], notes)
+
+    for table_name in metadataMapping["tables"]:
+        metadataMapping["tables"][table_name]["notes"] = "<br />".join(metadataMapping["tables"][table_name]["notes"])
+    return metadataMapping
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_templates(metadata_dir, packages=None):
+    """ Returns [(abbrev, workbook path)] for the profile templates in metadata_dir. """
+    templates = []
+    for path in sorted(glob.glob(os.path.join(metadata_dir, TEMPLATE_GLOB))):
+        m = TEMPLATE_RE.match(os.path.basename(path))
+        if m is None:
+            continue
+        abbrev = m.group(1)
+        if packages is None or abbrev.lower() in packages:
+            templates.append((abbrev, path))
+    return templates
+
+
+def mapping_filename(abbrev):
+    return "{}_metadata_mapping.json".format(abbrev.lower())
+
+
+def keep_hand_merged(metadataMapping, abbrev, output_path):
+    """ Keep the existing mapping's entries for the tables merged by hand (see HAND_MERGED_TABLES). """
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "r") as f:
+        existing = json.load(f)["tables"]
+    for table_number in HAND_MERGED_TABLES.get(abbrev.upper(), ()):
+        if table_number in existing:
+            metadataMapping["tables"][table_number] = existing[table_number]
+
+
+def generate_metadata_mappings(metadata_dir, output_dir, packages=None, workers=None, force=False):
+    """
+    Regenerate the metadata mapping of every profile template in
+    metadata_dir that has changed since its mapping was last generated.
+
+    Returns the mapping files written.
+    """
+    cache_path = os.path.join(output_dir, CACHE_FILENAME)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+
+    pending = []
+    for abbrev, path in find_templates(metadata_dir, packages):
+        output_path = os.path.join(output_dir, mapping_filename(abbrev))
+        digest = file_sha256(path)
+        if not force and cache.get(mapping_filename(abbrev)) == digest and os.path.exists(output_path):
+            print("{}: unchanged, skipping".format(os.path.basename(path)))
+            continue
+        if not force and mapping_filename(abbrev) not in cache and os.path.exists(output_path):
+            print("{}: {} wasn't generated by this script, skipping (--force to overwrite it)".format(os.path.basename(path), mapping_filename(abbrev)))
+            continue
+        pending.append((abbrev, path, output_path, digest))
+
+    written = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Read the workbooks in parallel, then parse all of their sheets in parallel
+        workbooks = list(executor.map(read_workbook, [path for _, path, _, _ in pending]))
+        sheets = [(i, sheet) for i, workbook in enumerate(workbooks) for sheet in workbook]
+        parsed = list(executor.map(parse_sheet, [sheet for _, sheet in sheets], chunksize=4))
+
+        for i, (abbrev, path, output_path, digest) in enumerate(pending):
+            names = [sheet.name for j, sheet in sheets if j == i]
+            print("{}: {} sheets ({})".format(os.path.basename(path), len(names), ", ".join(names)))
+            metadataMapping = build_metadata_mapping([result for (j, _), result in zip(sheets, parsed) if j == i])
+            keep_hand_merged(metadataMapping, abbrev, output_path)
+            with open(output_path, "w") as f:
+                f.write(json.dumps(metadataMapping, indent=2, sort_keys=True))
+            cache[mapping_filename(abbrev)] = digest
+            written.append(output_path)
+
+    with open(cache_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate the *_metadata_mapping.json files from the ABS profile template workbooks")
+    parser.add_argument(
+        "metadata_dir",
+        help="The census release's Metadata directory, holding the Profile_template_with_sequential_numbers_2011_*.xlsx workbooks")
+    parser.add_argument(
+        "--output-dir", default=os.path.dirname(os.path.abspath(__file__)),
+        help="Where to write the mapping files (default: alongside this script)")
+    parser.add_argument(
+        "--packages",
+        help="Only these packages (e.g. BCP,XCP)")
+    parser.add_argument(
+        "--workers", type=int,
+        help="Worker processes (default: one per CPU)")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Regenerate every mapping, even if its workbook hasn't changed")
+    args = parser.parse_args()
+    packages = None if args.packages is None else set(p.strip().lower() for p in args.packages.split(",") if p.strip())
+    for path in generate_metadata_mappings(args.metadata_dir, args.output_dir, packages, args.workers, args.force):
+        print("wrote {}".format(path))
+
+
+if __name__ == '__main__':
+    main()
 
 
 # Validate Metadata Mapping
@@ -0,0 +1,343 @@
+#
+# EAlGIS loader: Australian Census 2011; run instrumentation
+#
+# Hierarchical stage timers with row and byte counters, written out as a
+# JSON run report so that runs can be compared with each other.
+#
+# e.g.
+#   with stage("attrs"):
+#       with stage("rewrite", table="b01_aust_sa1") as s:
+#           ...
+#           s.add(rows=1000, bytes=65536)
+#
+# Memory profiling is opt-in (see RunReport.profile_memory) and adds the
+# peak RSS, the tracemalloc peak and the top allocating source lines to
+# each stage and table.
+#
+
+import os
+import json
+import time
+import socket
+import resource
+import threading
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.children = OrderedDict()
+        self.tables = OrderedDict()
+        self.memory = None
+
+    def child(self, name):
+        if name not in self.children:
+            self.children[name] = Stage(name)
+        return self.children[name]
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = {"calls": 0, "seconds": 0.0, "rows": 0, "bytes": 0}
+        return self.tables[name]
+
+    def to_dict(self):
+        d = OrderedDict([
+            ("name", self.name),
+            ("calls", self.calls),
+            ("seconds", round(self.seconds, 6)),
+            ("rows", self.rows),
+            ("bytes", self.bytes),
+        ])
+        if self.seconds > 0 and self.rows > 0:
+            d["rows_per_sec"] = round(self.rows / self.seconds, 1)
+        if self.seconds > 0 and self.bytes > 0:
+            d["bytes_per_sec"] = round(self.bytes / self.seconds, 1)
+        if self.memory is not None:
+            d["memory"] = self.memory
+        if self.tables:
+            d["tables"] = self.tables
+        if self.children:
+            d["stages"] = [c.to_dict() for c in self.children.values()]
+        return d
+
+
+def _read_proc_status(field):
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class MemoryProfiler:
+    """
+    Track the high-water marks of RSS and of tracemalloc'd memory for
+    nested stages, plus the source lines that grew the most during each
+    table-level stage.
+
+    Peak RSS relies on resetting VmHWM through /proc/self/clear_refs
+    (Linux); where that isn't possible the process-wide ru_maxrss is
+    reported instead. Both measures are process-wide, so stages that run
+    concurrently on other threads are attributed to each other.
+    """
+
+    # Ignore the profiler's own bookkeeping
+    TRACE_FILTERS = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ]
+
+    def __init__(self, top=10, frames=1):
+        self.top = top
+        self.frames = frames
+        self._local = threading.local()
+        self._can_reset_hwm = True
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _rss_peak_and_reset(self):
+        hwm = _read_proc_status("VmHWM")
+        if hwm is None:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self._can_reset_hwm:
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                self._can_reset_hwm = False
+        return hwm
+
+    def _traced_peak_and_reset(self):
+        _, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        return peak
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(self.TRACE_FILTERS)
+
+    def enter(self, snapshot):
+        stack = self._stack()
+        rss, traced = self._rss_peak_and_reset(), self._traced_peak_and_reset()
+        if stack:
+            stack[-1]["rss"] = max(stack[-1]["rss"], rss)
+            stack[-1]["traced"] = max(stack[-1]["traced"], traced)
+        stack.append({"rss": 0, "traced": 0, "snapshot": self._take_snapshot() if snapshot else None})
+
+    def exit(self):
+        stack = self._stack()
+        frame = stack.pop()
+        rss = max(frame["rss"], self._rss_peak_and_reset())
+        traced = max(frame["traced"], self._traced_peak_and_reset())
+        if stack:
+            stack[-1]["rss"] = max(stack[-1]["rss"], rss)
+            stack[-1]["traced"] = max(stack[-1]["traced"], traced)
+
+        top_allocators = []
+        if frame["snapshot"] is not None:
+            for stat in self._take_snapshot().compare_to(frame["snapshot"], "lineno")[:self.top]:
+                top_allocators.append({
+                    "location": "%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                    "size_diff_kb": stat.size_diff // 1024,
+                    "count_diff": stat.count_diff,
+                })
+        return {"peak_rss_kb": rss, "peak_traced_kb": traced // 1024, "top_allocators": top_allocators}
+
+
+def _merge_memory(existing, measured):
+    if existing is None:
+        return dict(measured)
+    merged = {
+        "peak_rss_kb": max(existing["peak_rss_kb"], measured["peak_rss_kb"]),
+        "peak_traced_kb": max(existing["peak_traced_kb"], measured["peak_traced_kb"]),
+        "top_allocators": existing["top_allocators"],
+    }
+    # Keep the allocators from whichever call had the highest peak
+    if measured["peak_traced_kb"] >= existing["peak_traced_kb"]:
+        merged["top_allocators"] = measured["top_allocators"]
+    return merged
+
+
+class StageTimer:
+    """
+    Handle returned by RunReport.stage() for counting the rows and bytes
+    processed by a stage.
+    """
+
+    def __init__(self, report, stage, table):
+        self._report = report
+        self.stage = stage
+        self.table = table
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, rows=0, bytes=0):
+        self.rows += rows
+        self.bytes += bytes
+
+
+class RunReport:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.root = Stage("run")
+        self.started = datetime.utcnow()
+        self.info = OrderedDict()
+        self.memory_profiler = None
+
+    def profile_memory(self, top=10, frames=1):
+        """
+        Opt in to recording peak RSS, tracemalloc peaks and the top
+        allocating source lines for each stage (and table) from now on.
+        tracemalloc slows Python allocations down considerably (and that
+        overhead lands in the enclosing stages' timings), so this is for
+        sizing runs rather than production loads.
+        """
+        self.memory_profiler = MemoryProfiler(top=top, frames=frames)
+        self.memory_profiler.start()
+
+    def memory_ranking(self, limit=20):
+        """
+        The most memory-hungry (stage, table) pairs of the run, ranked by
+        their tracemalloc peak.
+        """
+        ranking = []
+
+        def visit(node, path):
+            for child in node.children.values():
+                child_path = path + [child.name]
+                for table_name, t in child.tables.items():
+                    if "memory" in t:
+                        ranking.append(OrderedDict([
+                            ("stage", "/".join(child_path)),
+                            ("table", table_name),
+                            ("peak_traced_kb", t["memory"]["peak_traced_kb"]),
+                            ("peak_rss_kb", t["memory"]["peak_rss_kb"]),
+                        ]))
+                visit(child, child_path)
+        visit(self.root, [])
+        return sorted(ranking, key=lambda r: (r["peak_traced_kb"], r["peak_rss_kb"]), reverse=True)[:limit]
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        """ The stage active on the current thread (None at the top level). """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def attach(self, node):
+        """
+        Nest the stages of a worker thread within node, a stage from another
+        thread (see current()), instead of at the top level of the report.
+        """
+        stack = self._stack()
+        if node is not None:
+            stack.append(node)
+        try:
+            yield
+        finally:
+            if node is not None:
+                stack.pop()
+
+    @contextmanager
+    def stage(self, name, table=None, rows=0, bytes=0):
+        """
+        Time a stage of the run, nested within whichever stage is active
+        on the current thread. Repeated stages with the same name are
+        accumulated, with a per-table breakdown if a table is given.
+        """
+        stack = self._stack()
+        with self._lock:
+            node = (stack[-1] if stack else self.root).child(name)
+        timer = StageTimer(self, node, table)
+        timer.add(rows, bytes)
+        stack.append(node)
+        profiler = self.memory_profiler
+        if profiler is not None:
+            profiler.enter(snapshot=table is not None)
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            memory = profiler.exit() if profiler is not None else None
+            with self._lock:
+                if memory is not None:
+                    node.memory = _merge_memory(node.memory, memory)
+                node.calls += 1
+                node.seconds += elapsed
+                node.rows += timer.rows
+                node.bytes += timer.bytes
+                if table is not None:
+                    t = node.table(table)
+                    t["calls"] += 1
+                    t["seconds"] = round(t["seconds"] + elapsed, 6)
+                    t["rows"] += timer.rows
+                    t["bytes"] += timer.bytes
+                    if memory is not None:
+                        t["memory"] = _merge_memory(t.get("memory"), memory)
+
+    def to_dict(self):
+        self.root.seconds = (datetime.utcnow() - self.started).total_seconds()
+        d = OrderedDict([
+            ("started", self.started.isoformat() + "Z"),
+            ("host", socket.gethostname()),
+            ("info", self.info),
+            ("stages", [c.to_dict() for c in self.root.children.values()]),
+            ("seconds", round(self.root.seconds, 6)),
+        ])
+        if self.memory_profiler is not None:
+            d["memory_ranking"] = self.memory_ranking()
+        return d
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+
+# The report for this process
+report = RunReport()
+stage = report.stage
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            total += file_size(os.path.join(root, fname))
+    return total
@@ -0,0 +1,67 @@
+#
+# EAlGIS loader: Australian Census 2011; attribute table linkage
+#
+# Registering attribute tables against the census division shapes, and
+# the gid indexes that make attribute-to-shape joins fast.
+#
+
+import sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
+
+from ealgis_common.util import make_logger
+from .shapes import SHAPE_SCHEMA
+
+logger = make_logger(__name__)
+
+# Connections used to build the attribute tables' gid indexes concurrently
+GID_INDEX_WORKERS = 4
+
+
+def add_geolinkages(loader, linkages):
+    """
+    Register the linkage between each attribute table's gid and its
+    census division's shape table in a single pass over the shape schema,
+    committing once at the end rather than per table.
+
+    linkages: [(attr_table, census_division)]
+    """
+    if len(linkages) == 0:
+        return
+    with loader.access_schema(SHAPE_SCHEMA) as geo_access:
+        for attr_table, census_division in linkages:
+            loader.add_geolinkage(
+                geo_access,
+                census_division, "gid",
+                attr_table, "gid")
+        loader.session.commit()
+
+
+def index_gid_columns(loader, table_names, workers=GID_INDEX_WORKERS):
+    """
+    Make sure every attribute table has an index leading on gid (normally
+    the primary key created by CSVLoader), then ANALYZE it so the planner
+    has statistics for attribute-to-shape joins on gid.
+
+    Tables are processed concurrently, each on its own connection.
+    """
+    schema = loader.dbschema()
+
+    def has_gid_index(conn, table_name):
+        return conn.execute(sqlalchemy.text("""
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass(:table) AND a.attname = 'gid'
+            LIMIT 1"""), table='"{}"."{}"'.format(schema, table_name)).scalar() is not None
+
+    def index(table_name):
+        with loader.engine.connect() as conn:
+            conn = conn.execution_options(autocommit=True)
+            if not has_gid_index(conn, table_name):
+                logger.info("creating gid index for %s" % (table_name))
+                conn.execute('CREATE INDEX "{table}_gid_idx" ON "{schema}"."{table}" (gid)'.format(schema=schema, table=table_name))
+            conn.execute('ANALYZE "{schema}"."{table}"'.format(schema=schema, table=table_name))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() so that any exception raised by a worker is re-raised here
+        list(executor.map(index, table_names))
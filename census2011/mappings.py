@@ -0,0 +1,46 @@
+#
+# EAlGIS loader: Australian Census 2011; metadata and topic mappings
+#
+# The hand-maintained JSON mappings shipped alongside the loader:
+#   *_metadata_mapping.json   each table's metadata URLs and notes (see
+#                             generate-metadata-mapping.py)
+#   *_topic_mapping.json      the tables of each topic
+#
+# Only the standard library is needed, so tooling that just reads the
+# mappings doesn't pay for importing the loader.
+#
+
+import os
+import glob
+import json
+
+MAPPING_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_metadata_mapping(mapping_dir=MAPPING_DIR):
+    """
+    Returns -
+    mapping[table_number] = {"metadataUrls": [...], "notes": "..."}, e.g. mapping["B01"]
+    """
+    files = {}
+    for json_file in sorted(glob.glob(os.path.join(mapping_dir, "*_metadata_mapping.json"))):
+        with open(json_file, "r") as f:
+            files = {**files, **json.load(f)["tables"]}
+    return files
+
+
+def get_topic_to_table_mapping(mapping_dir=MAPPING_DIR):
+    """
+    Returns -
+    mapping[table_number] = [topic_name], e.g. mapping["B01"]
+    """
+    mapping = {}
+    for json_file in sorted(glob.glob(os.path.join(mapping_dir, "*_topic_mapping.json"))):
+        with open(json_file, "r") as f:
+            for topic_name, tables in json.load(f).items():
+                for table_number in tables:
+                    table_number = table_number.upper()
+                    if table_number not in mapping:
+                        mapping[table_number] = []
+                    mapping[table_number].append(topic_name)
+    return mapping
@@ -0,0 +1,99 @@
+#
+# EAlGIS loader: Australian Census 2011; state partitioned tables
+#
+# The SA1, SA2 and suburb variants of the larger tables have tens of
+# thousands of rows, but are mostly queried a state (or capital city) at a
+# time. Optionally (load_datapacks' partition_by_state), those tables are
+# stored as declarative partitions by state, so that queries for one state
+# only read that state's partition.
+#
+# Every ASGS region code starts with its state's code (e.g. SA1 1010101 is
+# in NSW, 1), so each table gains a ste_code column derived from its
+# region_id and is partitioned by LIST (ste_code), one partition per state
+# (<table>_ste<code>, 0 for any region without a code). The primary key
+# becomes (gid, ste_code), as a partitioned table's keys must include the
+# partition key; gid is still unique and still leads the index EAlGIS
+# joins on.
+#
+# Tables are loaded as usual and then converted, each state's partition
+# being filled on its own connection, before their geolinkage and gid
+# indexes are added.
+#
+# To prune, queries filter on ste_code, e.g.
+#   SELECT * FROM aus_census_2011_bcp.b04s1_aust_sa1 WHERE ste_code = 2
+#
+
+import re
+import sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
+
+from ealgis_common.util import make_logger
+from .instrument import stage
+
+logger = make_logger(__name__)
+
+PARTITIONED_DIVISIONS = ("sa1", "sa2", "ssc")
+STATE_COLUMN = "ste_code"
+# Connections filling partitions concurrently
+PARTITION_WORKERS = 4
+
+# The state code: the first digit of the region code (SSC codes are prefixed,
+# e.g. SSC10001; CSVLoader may have typed all-digit region ids as integers)
+STATE_EXPRESSION = "coalesce(substring(region_id::text from '[0-9]')::smallint, 0)"
+
+
+def partition_name(table_name, state_code):
+    return "{}_ste{}".format(table_name, state_code)
+
+
+def region_state_code(region_code):
+    m = re.search('[0-9]', str(region_code))
+    return int(m.group(0)) if m is not None else None
+
+
+def partition_tables_by_state(engine, schema, table_names, workers=PARTITION_WORKERS):
+    """
+    Convert each of table_names (as loaded, with gid and region_id columns)
+    to a table partitioned by state, under the same name.
+    """
+    for table_name in table_names:
+        with stage("partition", table=table_name) as timer:
+            timer.add(rows=_partition_table(engine, schema, table_name, workers))
+
+
+def _partition_table(engine, schema, table_name, workers):
+    params = {"schema": schema, "table": table_name, "new": table_name + "__partitioned", "state": STATE_COLUMN, "expr": STATE_EXPRESSION}
+    with engine.connect() as conn:
+        conn = conn.execution_options(autocommit=True)
+        columns = [r[0] for r in conn.execute(sqlalchemy.text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = :schema AND table_name = :table
+            ORDER BY ordinal_position"""), schema=schema, table=table_name)]
+        states = [r[0] for r in conn.execute('SELECT DISTINCT {expr} FROM "{schema}"."{table}" ORDER BY 1'.format(**params))]
+        logger.info("partitioning %s by state (%d partitions)" % (table_name, len(states)))
+
+        conn.execute('DROP TABLE IF EXISTS "{schema}"."{new}"'.format(**params))
+        conn.execute("""
+            CREATE TABLE "{schema}"."{new}" (LIKE "{schema}"."{table}" INCLUDING DEFAULTS, {state} smallint, PRIMARY KEY (gid, {state}))
+            PARTITION BY LIST ({state})""".format(**params))
+        for state_code in states:
+            conn.execute('CREATE TABLE "{schema}"."{partition}" PARTITION OF "{schema}"."{new}" FOR VALUES IN ({code})'.format(
+                partition=partition_name(table_name, state_code), code=int(state_code), **params))
+
+    column_list = ", ".join('"{}"'.format(c) for c in columns)
+
+    def fill(state_code):
+        with engine.connect() as conn:
+            conn = conn.execution_options(autocommit=True)
+            # Straight into the partition, so each worker only locks its own
+            return conn.execute('INSERT INTO "{schema}"."{partition}" ({columns}, {state}) SELECT {columns}, {expr} FROM "{schema}"."{table}" WHERE {expr} = {code}'.format(
+                partition=partition_name(table_name, state_code), columns=column_list, code=int(state_code), **params)).rowcount
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = sum(executor.map(fill, states))
+
+    with engine.begin() as conn:
+        conn.execute('DROP TABLE "{schema}"."{table}"'.format(**params))
+        conn.execute('ALTER TABLE "{schema}"."{new}" RENAME TO "{table}"'.format(**params))
+        conn.execute('ALTER INDEX "{schema}"."{new}_pkey" RENAME TO "{table}_pkey"'.format(**params))
+    return rows
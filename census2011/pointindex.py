@@ -0,0 +1,287 @@
+#
+# EAlGIS loader: Australian Census 2011; offline point-in-polygon index
+#
+# Resolves (longitude, latitude) points to the region of every census
+# division at once (e.g. to geocode addresses to their SA1, SA2, LGA and
+# postal area) without a database. The index is built from the same
+# digital boundary zips as load_shapes, and exported as a directory of
+# .npy files per division that lookups memory map, so that the worker
+# processes of a batch lookup share one copy:
+#
+#   <index_dir>/<division>/
+#       meta.json           the division and its region code column
+#       codes.npy           region code of each feature
+#       tree.npy            packed STR-tree: the bounds of every node,
+#                           leaves (the features' bounds) first
+#       level_offsets.npy   where each level of the tree starts in tree.npy
+#       feature_edges.npy   where each feature's edges start in edges.npy
+#       edges.npy           the features' prepared edges
+#
+# Features are stored in STR (sort-tile-recursive) order, so the children
+# of node i of a level are nodes [i * NODE_SIZE, (i + 1) * NODE_SIZE) of
+# the level below, and leaf i is feature i. Each edge is stored prepared
+# for the crossing number test as (x0, y0, y1, dx/dy), with horizontal
+# edges (which never cross) left out.
+#
+# Coordinates are GDA94, the datum of the ABS boundaries, which is within
+# a couple of metres of WGS84. A point on a boundary shared by two regions
+# resolves to one of them.
+#
+
+import os
+import json
+import numpy
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from .shapes import SHAPE_ZIPS, SHAPE_LINKAGE
+from .shp import read_polygon_shapefile
+from .instrument import stage, file_size
+from .archive import DirectorySource
+from .selection import ALL
+
+# Children per node of the tree: small nodes mean fewer bounds tested per point
+NODE_SIZE = 4
+LOOKUP_WORKERS = 4
+# Points per task of a batch lookup
+LOOKUP_CHUNK = 100000
+# Upper bound on the (edges x points) cells tested against a feature at once
+TEST_CELLS = 4 * 1024 * 1024
+
+INDEX_ARRAYS = ("codes", "tree", "level_offsets", "feature_edges", "edges")
+
+
+def _feature_edges(parts, points):
+    """ The prepared, non-horizontal edges of a feature's rings. """
+    ring_ends = list(parts[1:]) + [len(points)]
+    starts = numpy.concatenate([numpy.arange(start, end - 1) for start, end in zip(parts, ring_ends) if end - start > 1] or [numpy.zeros(0, dtype=numpy.int64)])
+    x0, y0 = points[starts, 0], points[starts, 1]
+    x1, y1 = points[starts + 1, 0], points[starts + 1, 1]
+    keep = y0 != y1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+    return numpy.column_stack([x0, y0, y1, (x1 - x0) / (y1 - y0)])
+
+
+def _str_order(bounds, node_size):
+    """ The sort-tile-recursive order of features with the given bounds. """
+    count = len(bounds)
+    if count == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    centres_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    centres_y = (bounds[:, 1] + bounds[:, 3]) / 2
+    slices = int(numpy.ceil(numpy.sqrt(numpy.ceil(count / node_size))))
+    slice_size = slices * node_size
+    by_x = numpy.argsort(centres_x, kind="stable")
+    order = []
+    for start in range(0, count, slice_size):
+        members = by_x[start:start + slice_size]
+        order.append(members[numpy.argsort(centres_y[members], kind="stable")])
+    return numpy.concatenate(order)
+
+
+def _pack_tree(leaf_bounds, node_size):
+    """ Returns (tree, level_offsets): the bounds of every level, leaves first. """
+    levels = [leaf_bounds]
+    while len(levels[-1]) > 1:
+        below = levels[-1]
+        groups = numpy.arange(0, len(below), node_size)
+        levels.append(numpy.column_stack([
+            numpy.minimum.reduceat(below[:, 0], groups),
+            numpy.minimum.reduceat(below[:, 1], groups),
+            numpy.maximum.reduceat(below[:, 2], groups),
+            numpy.maximum.reduceat(below[:, 3], groups)]))
+    level_offsets = numpy.cumsum([0] + [len(level) for level in levels])
+    return numpy.concatenate(levels).reshape(-1, 4), level_offsets
+
+
+def build_division_index(features, code_column, node_size=NODE_SIZE):
+    """
+    Build the index arrays of a division from its shapefile features (see
+    read_polygon_shapefile). Features without a geometry are left out.
+    """
+    codes, bounds, edges = [], [], []
+    for record, parts, points in features:
+        if len(parts) == 0:
+            continue
+        codes.append(record[code_column])
+        bounds.append((points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()))
+        edges.append(_feature_edges(parts, points))
+    bounds = numpy.array(bounds, dtype=numpy.float64).reshape(-1, 4)
+    order = _str_order(bounds, node_size)
+    tree, level_offsets = _pack_tree(bounds[order], node_size)
+    edges = [edges[i] for i in order]
+    return {
+        "codes": numpy.array([codes[i] for i in order], dtype=str),
+        "tree": tree,
+        "level_offsets": level_offsets,
+        "feature_edges": numpy.cumsum([0] + [len(e) for e in edges]),
+        "edges": numpy.concatenate(edges or [numpy.zeros((0, 4))]),
+    }
+
+
+def _shapefile_code_column(record, census_division):
+    """ The shapefile's field holding the division's region code (shp2pgsql lowercases them). """
+    code_column = SHAPE_LINKAGE[census_division][0]
+    for name in record:
+        if name.lower() == code_column:
+            return name
+    raise KeyError("No {} column in the {} boundaries".format(code_column, census_division))
+
+
+def index_shapefile_zip(zip_path, census_division, index_dir, node_size=NODE_SIZE):
+    """
+    Index the boundaries of a census division from its digital boundary
+    zip, writing them to <index_dir>/<census_division>/.
+
+    Returns the number of features indexed.
+    """
+    features = []
+    with zipfile.ZipFile(zip_path) as z:
+        for name in z.namelist():
+            if name.lower().endswith(".shp"):
+                dbf_name = [n for n in z.namelist() if n.lower() == name[:-4].lower() + ".dbf"][0]
+                features += read_polygon_shapefile(z.read(name), z.read(dbf_name))
+    code_column = _shapefile_code_column(features[0][0], census_division) if features else None
+    arrays = build_division_index(features, code_column, node_size)
+
+    division_dir = os.path.join(index_dir, census_division)
+    os.makedirs(division_dir, exist_ok=True)
+    for name in INDEX_ARRAYS:
+        numpy.save(os.path.join(division_dir, name + ".npy"), arrays[name])
+    with open(os.path.join(division_dir, "meta.json"), "w") as f:
+        json.dump({"division": census_division, "code_column": SHAPE_LINKAGE[census_division][0], "node_size": node_size, "features": len(arrays["codes"])}, f)
+    return len(arrays["codes"])
+
+
+def build_point_index(census_dir, index_dir, source=None, selection=ALL):
+    """
+    Build the point index of every census division (those selected, see
+    selection.py) from the digital boundary zips.
+    """
+    source = source or DirectorySource(census_dir)
+    for census_division, fname in SHAPE_ZIPS:
+        if not selection.division(census_division):
+            continue
+        zip_path = source.wait(os.path.join(census_dir + '/Digital Boundaries/', fname))
+        with stage("point index", table=census_division, bytes=file_size(zip_path)) as timer:
+            timer.add(rows=index_shapefile_zip(zip_path, census_division, index_dir))
+        source.release(zip_path)
+
+
+class DivisionIndex:
+    """ The (memory mapped) point index of one census division. """
+
+    def __init__(self, division_dir):
+        with open(os.path.join(division_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.division = meta["division"]
+        self.node_size = meta["node_size"]
+        for name in INDEX_ARRAYS:
+            # A plain array view of the memory map (indexing a numpy.memmap is slower)
+            setattr(self, name, numpy.asarray(numpy.load(os.path.join(division_dir, name + ".npy"), mmap_mode="r")))
+
+    def _candidates(self, x, y):
+        """ (point, feature) pairs whose feature's bounds contain the point. """
+        points = numpy.arange(len(x))
+        levels = len(self.level_offsets) - 1
+        if len(self.codes) == 0:
+            return points[:0], points[:0]
+        nodes = numpy.zeros(len(x), dtype=numpy.int64)
+        for level in range(levels - 1, -1, -1):
+            if level < levels - 1:
+                # Expand each node into its children on this level
+                level_size = self.level_offsets[level + 1] - self.level_offsets[level]
+                first = nodes * self.node_size
+                counts = numpy.minimum(self.node_size, level_size - first)
+                points = numpy.repeat(points, counts)
+                nodes = numpy.repeat(first, counts) + numpy.arange(len(points)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            bounds = self.tree[self.level_offsets[level] + nodes]
+            px, py = x[points], y[points]
+            keep = (bounds[:, 0] <= px) & (px <= bounds[:, 2]) & (bounds[:, 1] <= py) & (py <= bounds[:, 3])
+            points, nodes = points[keep], nodes[keep]
+        return points, nodes
+
+    def lookup(self, x, y):
+        """
+        Returns the index of the feature containing each point, -1 where
+        none does.
+        """
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        found = numpy.full(len(x), -1, dtype=numpy.int64)
+        points, features = self._candidates(x, y)
+        counts = self.feature_edges[features + 1] - self.feature_edges[features]
+        points, features, counts = points[counts > 0], features[counts > 0], counts[counts > 0]
+
+        # Test every candidate pair against each of its feature's edges, in
+        # batches of about TEST_CELLS edges
+        ends = numpy.cumsum(counts)
+        batch_ends = numpy.unique(numpy.searchsorted(ends, numpy.arange(TEST_CELLS, ends[-1] + TEST_CELLS, TEST_CELLS) if len(ends) else [], side="right"))
+        start = 0
+        for end in batch_ends:
+            end = max(end, start + 1)
+            if start >= len(points):
+                break
+            batch_points, batch_features, batch_counts = points[start:end], features[start:end], counts[start:end]
+            pair_starts = numpy.cumsum(batch_counts) - batch_counts
+            pair_of_edge = numpy.repeat(numpy.arange(len(batch_points)), batch_counts)
+            edges = self.edges[self.feature_edges[batch_features][pair_of_edge] + numpy.arange(len(pair_of_edge)) - pair_starts[pair_of_edge]]
+            px, py = x[batch_points][pair_of_edge], y[batch_points][pair_of_edge]
+            # Crossing number: cast a ray towards +x and count the edges it crosses
+            crosses = ((edges[:, 1] > py) != (edges[:, 2] > py)) & (px < edges[:, 0] + (py - edges[:, 1]) * edges[:, 3])
+            inside = numpy.add.reduceat(crosses.astype(numpy.int64), pair_starts) % 2 == 1
+            found[batch_points[inside]] = batch_features[inside]
+            start = end
+        return found
+
+    def lookup_codes(self, x, y):
+        """ Returns the region code containing each point, "" where none does. """
+        found = self.lookup(x, y)
+        codes = numpy.full(len(found), "", dtype=self.codes.dtype)
+        codes[found >= 0] = self.codes[found[found >= 0]]
+        return codes
+
+
+def open_point_index(index_dir, divisions=None):
+    """ Returns OrderedDict: census division -> DivisionIndex, for the divisions indexed. """
+    indexes = OrderedDict()
+    for census_division, _ in SHAPE_ZIPS:
+        division_dir = os.path.join(index_dir, census_division)
+        if (divisions is None or census_division in divisions) and os.path.exists(os.path.join(division_dir, "meta.json")):
+            indexes[census_division] = DivisionIndex(division_dir)
+    return indexes
+
+
+# Indexes opened by this (worker) process
+_open_indexes = {}
+
+
+def _lookup_chunk(args):
+    index_dir, divisions, x, y = args
+    key = (index_dir, divisions)
+    if key not in _open_indexes:
+        _open_indexes[key] = open_point_index(index_dir, divisions)
+    return OrderedDict((division, index.lookup_codes(x, y)) for division, index in _open_indexes[key].items())
+
+
+def lookup_points(index_dir, longitudes, latitudes, divisions=None, workers=LOOKUP_WORKERS, chunk_size=LOOKUP_CHUNK):
+    """
+    Resolve points to the region of every census division indexed (or just
+    those in divisions), in chunks across a pool of worker processes.
+
+    Returns OrderedDict: census division -> array of region codes, one per
+    point ("" for a point outside every region)
+    """
+    x = numpy.asarray(longitudes, dtype=numpy.float64)
+    y = numpy.asarray(latitudes, dtype=numpy.float64)
+    divisions = None if divisions is None else tuple(divisions)
+    chunks = [(index_dir, divisions, x[i:i + chunk_size], y[i:i + chunk_size]) for i in range(0, len(x), chunk_size)]
+    if len(chunks) > 1 and (workers is None or workers > 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_lookup_chunk, chunks))
+    else:
+        results = [_lookup_chunk(chunk) for chunk in chunks]
+    if not results:
+        return OrderedDict((division, numpy.zeros(0, dtype=str)) for division in open_point_index(index_dir, divisions))
+    return OrderedDict((division, numpy.concatenate([r[division] for r in results])) for division in results[0])
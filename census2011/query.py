@@ -0,0 +1,245 @@
+#
+# EAlGIS loader: Australian Census 2011; read API
+#
+# Fetch census values by (package, table, series, row label, column
+# label, division, regions) instead of hand-written SQL against the
+# sequential column names (e.g. G1234). Labels are resolved through the
+# column metadata registered by load_metadata, values are fetched with
+# one query per attribute table, and results are kept in an LRU cache
+# bounded by memory.
+#
+# e.g.
+#   q = CensusQuery(engine)
+#   result = q.fetch("bcp", "b04", "sa2", ["101011001", "101011002"], series="PERSONS", column_label="Total")
+#   result.values  # numpy array, one row per region, one column per matching census column
+#
+
+import re
+import sys
+import json
+import numpy
+import threading
+import sqlalchemy
+from collections import OrderedDict, namedtuple
+
+from .shapes import SHAPE_SCHEMA, SHAPE_LINKAGE
+from .attrs import package_schema_name
+from .partition import STATE_COLUMN, region_state_code
+
+# Default upper bound on the memory held by cached results
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+CensusColumn = namedtuple("CensusColumn", ["table_name", "name", "series", "type", "kind"])
+
+
+class QueryResult:
+    """
+    Census values for a set of regions.
+
+    region_codes: numpy array of the region codes (one per row of values)
+    columns: [CensusColumn] describing each column of values
+    values: float numpy array of shape (regions, columns), NaN where a cell
+        is not applicable or a region wasn't found
+    """
+
+    def __init__(self, region_codes, columns, values):
+        self.region_codes = region_codes
+        self.columns = columns
+        self.values = values
+        self._nbytes = None
+
+    @property
+    def nbytes(self):
+        """
+        The memory held by the result (as the cache bounds it): its arrays
+        plus the region code and column label objects they refer to.
+        """
+        if self._nbytes is None:
+            nbytes = self.values.nbytes + self.region_codes.nbytes
+            if self.region_codes.dtype == object:
+                nbytes += sum(sys.getsizeof(code) for code in self.region_codes)
+            nbytes += sys.getsizeof(self.columns) + sum(
+                sys.getsizeof(column) + sum(sys.getsizeof(field) for field in column) for column in self.columns)
+            self._nbytes = nbytes
+        return self._nbytes
+
+    def to_frame(self):
+        import pandas
+        index = pandas.MultiIndex.from_tuples(
+            [(c.series, c.type, c.kind) for c in self.columns], names=["series", "type", "kind"])
+        return pandas.DataFrame(self.values, index=pandas.Index(self.region_codes, name="region_id"), columns=index)
+
+
+class LRUCache:
+    """ A least-recently-used cache bounded by the total nbytes of its values. """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        size = value.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key).nbytes
+            self._items[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _as_filter(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [value]
+    return frozenset(v.lower() for v in value)
+
+
+class CensusQuery:
+    def __init__(self, engine, max_cache_bytes=DEFAULT_CACHE_BYTES):
+        self.engine = engine
+        self.cache = LRUCache(max_cache_bytes)
+        self._metadata = {}
+        self._partitioned = {}
+        self._metadata_lock = threading.Lock()
+
+    def _load_metadata(self, schema):
+        """
+        Read the registered table and column metadata for a package.
+
+        Returns -
+        tables[table_name] = (series, [CensusColumn])
+        """
+        with self._metadata_lock:
+            if schema in self._metadata:
+                return self._metadata[schema]
+
+            tables = OrderedDict()
+            with self.engine.connect() as conn:
+                rows = conn.execute("""
+                    SELECT t.name, t.metadata_json, c.name, c.metadata_json
+                    FROM "{schema}".table_info t
+                    JOIN "{schema}".column_info c ON c.tableinfo_id = t.id
+                    ORDER BY t.name, c.id""".format(schema=schema))
+                for table_name, table_json, column_name, column_json in rows:
+                    table_meta = json.loads(table_json) if table_json else {}
+                    column_meta = json.loads(column_json) if column_json else {}
+                    series = table_meta.get("series")
+                    if table_name not in tables:
+                        tables[table_name] = (series, [])
+                    tables[table_name][1].append(CensusColumn(
+                        table_name, column_name, series, column_meta.get("type"), column_meta.get("kind")))
+            self._metadata[schema] = tables
+            return tables
+
+    def _partitioned_tables(self, schema):
+        """ The tables of a package that are partitioned by state (see partition.py). """
+        with self._metadata_lock:
+            if schema not in self._partitioned:
+                with self.engine.connect() as conn:
+                    rows = conn.execute(sqlalchemy.text("""
+                        SELECT c.relname FROM pg_partitioned_table p
+                        JOIN pg_class c ON c.oid = p.partrelid
+                        JOIN pg_namespace n ON n.oid = c.relnamespace
+                        WHERE n.nspname = :schema"""), schema=schema)
+                    self._partitioned[schema] = frozenset(r[0] for r in rows)
+            return self._partitioned[schema]
+
+    def resolve(self, package, table, division, series=None, row_label=None, column_label=None):
+        """
+        Find the census columns matching the given labels (each a string,
+        a list of strings or None for any), case-insensitively.
+
+        Returns OrderedDict: table_name -> [CensusColumn]
+        """
+        tables = self._load_metadata(package_schema_name(package))
+        table_re = re.compile(r'^{}(s[0-9]{{1,2}})?_[a-z]+_{}$'.format(re.escape(table.lower()), re.escape(division.lower())))
+        series, row_label, column_label = _as_filter(series), _as_filter(row_label), _as_filter(column_label)
+
+        resolved = OrderedDict()
+        for table_name, (table_series, columns) in tables.items():
+            if table_re.match(table_name) is None:
+                continue
+            if series is not None and (table_series or "").lower() not in series:
+                continue
+            matches = [
+                c for c in columns
+                if (row_label is None or (c.type or "").lower() in row_label) and
+                (column_label is None or (c.kind or "").lower() in column_label)
+            ]
+            if matches:
+                resolved[table_name] = matches
+        if not resolved:
+            raise KeyError("No columns match {} {} at {} (series={}, row_label={}, column_label={})".format(
+                package, table, division, series, row_label, column_label))
+        return resolved
+
+    def fetch(self, package, table, division, region_codes=None, series=None, row_label=None, column_label=None, as_frame=False):
+        """
+        Fetch the values of the matching census columns for region_codes
+        (or every region of the division if None).
+
+        Returns a QueryResult, or a pandas DataFrame if as_frame is True.
+        """
+        key = (
+            package.lower(), table.lower(), division.lower(),
+            None if region_codes is None else tuple(str(r) for r in region_codes),
+            _as_filter(series), _as_filter(row_label), _as_filter(column_label))
+        result = self.cache.get(key)
+        if result is None:
+            result = self._fetch(package, division, key[3], self.resolve(package, table, division, series, row_label, column_label))
+            self.cache.put(key, result)
+        return result.to_frame() if as_frame else result
+
+    def _fetch(self, package, division, region_codes, resolved):
+        schema = package_schema_name(package)
+        geo_column = SHAPE_LINKAGE[division][0]
+        columns = [c for table_columns in resolved.values() for c in table_columns]
+
+        per_table = []
+        with self.engine.connect() as conn:
+            for table_name, table_columns in resolved.items():
+                sql = 'SELECT s."{geo}"::varchar, {cols} FROM "{schema}"."{table}" a JOIN "{shapes}"."{division}" s ON s.gid = a.gid'.format(
+                    geo=geo_column, cols=", ".join('a."{}"'.format(c.name) for c in table_columns),
+                    schema=schema, table=table_name, shapes=SHAPE_SCHEMA, division=division)
+                states = []
+                if region_codes is not None:
+                    sql += ' WHERE s."{geo}"::varchar = ANY(:codes)'.format(geo=geo_column)
+                    if table_name in self._partitioned_tables(schema):
+                        # Only read the partitions of the regions' states
+                        states = sorted(set(region_state_code(code) or 0 for code in region_codes))
+                        sql += ' AND a."{}" = ANY(:states)'.format(STATE_COLUMN)
+                rows = conn.execute(sqlalchemy.text(sql), codes=list(region_codes or []), states=states).fetchall()
+                per_table.append(({r[0]: r[1:] for r in rows}, len(table_columns)))
+
+        if region_codes is None:
+            region_codes = sorted(set(code for by_code, _ in per_table for code in by_code))
+        values = numpy.full((len(region_codes), len(columns)), numpy.nan)
+        offset = 0
+        for by_code, width in per_table:
+            for i, code in enumerate(region_codes):
+                if code in by_code:
+                    values[i, offset:offset + width] = numpy.array(by_code[code], dtype=numpy.float64)
+            offset += width
+        return QueryResult(numpy.array(region_codes, dtype=object), columns, values)
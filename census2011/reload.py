@@ -0,0 +1,400 @@
+#
+# EAlGIS loader: Australian Census 2011; shadow reloads
+#
+# Reload a table (e.g. after fixing its metadata or repair rules) in a
+# live database without taking it offline:
+#
+#   1. the table is loaded, in every selected census division, into a
+#      shadow schema (<package schema>__shadow) with the normal loader, so
+#      that it gets its gid index and geolinkage as usual
+#   2. in a single transaction, the live tables are renamed out of the way
+#      (to <table>__old_<stamp>, their indexes likewise), the shadow tables
+#      are moved into the live schema under the live names, their grants
+#      are copied over and the live metadata is updated from the shadow's
+#   3. analysis views and the column search index are rebuilt for the
+#      reloaded tables, each swapped in the same way
+#
+# Queries keep working throughout: until the swap they read the old tables
+# and after it the new ones, and the swap itself only holds its locks for
+# as long as the renames take. It waits at most LOCK_TIMEOUT for queries
+# already reading a table, retrying if need be, so that it never queues
+# new queries behind a long running one.
+#
+# A table stored sparsely (see sparse.py) is a view over its storage
+# table; the two are renamed, moved and dropped together. The reloaded
+# table itself is stored as a normal table.
+#
+# The old tables are kept, and the metadata they were registered with is
+# recorded in the schema's reload_history table, so that a reload can be
+# rolled back by swapping them back in (rollback_reload). Kept tables are
+# dropped with drop_old_tables.
+#
+# e.g.
+#   stamp, tables = reload_table(factory, census_dir, tmpdir, "bcp", "b04")
+#   rollback_reload(engine, package_schema_name("bcp"), stamp)
+#
+
+import re
+import json
+import time
+import sqlalchemy
+from collections import OrderedDict
+
+from ealgis_common.util import make_logger
+from .analysis_views import analysis_view_name, replace_analysis_view
+from .attrs import build_geo_gid_mapping, find_package, load_package, package_schema_name
+from .instrument import stage
+from .search import SEARCH_TABLE, update_column_search_index
+from .selection import LoadSelection
+from .shapes import SHAPE_SCHEMA
+
+logger = make_logger(__name__)
+
+SHADOW_SUFFIX = "__shadow"
+HISTORY_TABLE = "reload_history"
+
+# How long the swap waits for a table's readers before giving up (and
+# letting queued queries through), and how many times it's attempted
+LOCK_TIMEOUT = "2s"
+SWAP_ATTEMPTS = 10
+
+
+def shadow_schema_name(schema):
+    return schema + SHADOW_SUFFIX
+
+
+def old_table_name(table_name, stamp):
+    return "{}__old_{}".format(table_name, stamp)
+
+
+def _census_division(table_name):
+    # e.g. b04s1_aust_sa1 -> sa1
+    decoded = table_name.split("_")
+    return decoded[2] if len(decoded) == 3 else None
+
+
+def _exists(conn, schema, name):
+    return conn.execute(sqlalchemy.text("SELECT to_regclass(:name)"), name='"{}"."{}"'.format(schema, name)).scalar() is not None
+
+
+def _table_indexes(conn, schema, table_name):
+    return [row[0] for row in conn.execute(sqlalchemy.text("""
+        SELECT indexname FROM pg_indexes
+        WHERE schemaname = :schema AND tablename = :table"""), schema=schema, table=table_name)]
+
+
+def _table_grants(conn, schema, table_name):
+    return [tuple(row) for row in conn.execute(sqlalchemy.text("""
+        SELECT grantee, privilege_type FROM information_schema.role_table_grants
+        WHERE table_schema = :schema AND table_name = :table"""), schema=schema, table=table_name)]
+
+
+def _grant(conn, schema, table_name, grants):
+    for grantee, privilege in grants:
+        grantee = grantee if grantee == "PUBLIC" else '"{}"'.format(grantee)
+        conn.execute('GRANT {} ON "{}"."{}" TO {}'.format(privilege, schema, table_name, grantee))
+
+
+def _partitions(conn, schema, table_name):
+    """ The partitions of a table partitioned by state (see partition.py), if it is. """
+    return [row[0] for row in conn.execute(sqlalchemy.text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:table)
+        ORDER BY c.relname"""), table='"{}"."{}"'.format(schema, table_name))]
+
+
+def _rename_indexes(conn, schema, table_name, rename):
+    for index_name in _table_indexes(conn, schema, table_name):
+        conn.execute('ALTER INDEX "{}"."{}" RENAME TO "{}"'.format(schema, index_name, rename(index_name)))
+
+
+def _is_view(conn, schema, name):
+    return conn.execute(sqlalchemy.text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), name='"{}"."{}"'.format(schema, name)).scalar() == "v"
+
+
+def _view_storage(conn, schema, name):
+    """
+    The tables a view reads, e.g. the <table>__sparse (or __stored) table
+    holding a sparse table's data (see sparse.py), whatever they've been
+    renamed to since.
+    """
+    return [row[0] for row in conn.execute(sqlalchemy.text("""
+        SELECT DISTINCT c.relname FROM pg_rewrite r
+        JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid
+        JOIN pg_class c ON c.oid = d.refobjid
+        WHERE r.ev_class = to_regclass(:view) AND c.oid <> r.ev_class AND c.relkind = 'r'
+        ORDER BY c.relname"""), view='"{}"."{}"'.format(schema, name))]
+
+
+def _rename_table(conn, schema, table_name, rename):
+    """
+    Rename a table, its partitions and all of their indexes with
+    rename(name). A sparse table's view is renamed along with its storage
+    table.
+    """
+    if _is_view(conn, schema, table_name):
+        for storage in _view_storage(conn, schema, table_name):
+            _rename_table(conn, schema, storage, rename)
+        conn.execute('ALTER VIEW "{}"."{}" RENAME TO "{}"'.format(schema, table_name, rename(table_name)))
+        return
+    for partition in _partitions(conn, schema, table_name):
+        _rename_indexes(conn, schema, partition, rename)
+        conn.execute('ALTER TABLE "{}"."{}" RENAME TO "{}"'.format(schema, partition, rename(partition)))
+    _rename_indexes(conn, schema, table_name, rename)
+    conn.execute('ALTER TABLE "{}"."{}" RENAME TO "{}"'.format(schema, table_name, rename(table_name)))
+
+
+def _move_table(conn, from_schema, table_name, to_schema):
+    """ Move a table and its partitions (with their indexes), or a sparse table's view and storage, to another schema. """
+    if _is_view(conn, from_schema, table_name):
+        storage = _view_storage(conn, from_schema, table_name)
+        conn.execute('ALTER VIEW "{}"."{}" SET SCHEMA "{}"'.format(from_schema, table_name, to_schema))
+        for storage_table in storage:
+            _move_table(conn, from_schema, storage_table, to_schema)
+        return
+    partitions = _partitions(conn, from_schema, table_name)
+    conn.execute('ALTER TABLE "{}"."{}" SET SCHEMA "{}"'.format(from_schema, table_name, to_schema))
+    for partition in partitions:
+        conn.execute('ALTER TABLE "{}"."{}" SET SCHEMA "{}"'.format(from_schema, partition, to_schema))
+
+
+def _drop_table(conn, schema, table_name):
+    """ Drop a table, or a sparse table's view and storage, if it exists. """
+    if _is_view(conn, schema, table_name):
+        storage = _view_storage(conn, schema, table_name)
+        conn.execute('DROP VIEW "{}"."{}"'.format(schema, table_name))
+        for storage_table in storage:
+            conn.execute('DROP TABLE IF EXISTS "{}"."{}"'.format(schema, storage_table))
+    else:
+        conn.execute('DROP TABLE IF EXISTS "{}"."{}"'.format(schema, table_name))
+
+
+def _create_history_table(conn, schema):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS "{schema}"."{table}" (
+            id serial PRIMARY KEY,
+            stamp varchar NOT NULL,
+            table_name varchar NOT NULL,
+            old_table_name varchar NOT NULL,
+            table_metadata_json text,
+            column_metadata_json text,
+            reloaded_at timestamp with time zone NOT NULL DEFAULT now()
+        )""".format(schema=schema, table=HISTORY_TABLE))
+
+
+def _with_lock_timeout(engine, fn):
+    """
+    Run fn(conn) in a transaction that waits at most LOCK_TIMEOUT for each
+    lock, retrying up to SWAP_ATTEMPTS times.
+    """
+    for attempt in range(1, SWAP_ATTEMPTS + 1):
+        try:
+            with engine.begin() as conn:
+                conn.execute("SET LOCAL lock_timeout = '{}'".format(LOCK_TIMEOUT))
+                return fn(conn)
+        except sqlalchemy.exc.OperationalError as e:
+            # 55P03: lock_not_available
+            if getattr(e.orig, "pgcode", None) != "55P03" or attempt == SWAP_ATTEMPTS:
+                raise
+            logger.warning("swap attempt %d/%d timed out waiting for readers, retrying" % (attempt, SWAP_ATTEMPTS))
+            time.sleep(attempt)
+
+
+def swap_tables(engine, schema, shadow_schema, table_names, stamp):
+    """
+    Swap the shadow schema's copies of table_names in for the live tables
+    of schema, keeping the live tables as <table>__old_<stamp> and
+    recording their metadata in the schema's reload_history table.
+    """
+    def swap(conn):
+        _create_history_table(conn, schema)
+        for table_name in table_names:
+            old_name = old_table_name(table_name, stamp)
+            grants = _table_grants(conn, schema, table_name)
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO "{schema}"."{history}" (stamp, table_name, old_table_name, table_metadata_json, column_metadata_json)
+                SELECT :stamp, t.name, :old_name, t.metadata_json,
+                    (SELECT json_object_agg(c.name, c.metadata_json) FROM "{schema}".column_info c WHERE c.tableinfo_id = t.id)::text
+                FROM "{schema}".table_info t
+                WHERE t.name = :table""".format(schema=schema, history=HISTORY_TABLE)), stamp=stamp, old_name=old_name, table=table_name)
+
+            _rename_table(conn, schema, table_name, lambda name: old_table_name(name, stamp))
+            _move_table(conn, shadow_schema, table_name, schema)
+            _grant(conn, schema, table_name, grants)
+
+            conn.execute(sqlalchemy.text("""
+                UPDATE "{schema}".table_info t SET metadata_json = s.metadata_json
+                FROM "{shadow}".table_info s
+                WHERE t.name = :table AND s.name = :table""".format(schema=schema, shadow=shadow_schema)), table=table_name)
+            conn.execute(sqlalchemy.text("""
+                UPDATE "{schema}".column_info c SET metadata_json = sc.metadata_json
+                FROM "{schema}".table_info t, "{shadow}".table_info st, "{shadow}".column_info sc
+                WHERE t.name = :table AND c.tableinfo_id = t.id
+                    AND st.name = :table AND sc.tableinfo_id = st.id AND sc.name = c.name""".format(schema=schema, shadow=shadow_schema)), table=table_name)
+
+    with stage("swap", rows=len(table_names)):
+        _with_lock_timeout(engine, swap)
+    logger.info("swapped in %d tables in %s, old tables kept as *__old_%s" % (len(table_names), schema, stamp))
+
+
+def _refresh_dependents(engine, schema, table_names, registered):
+    """ Rebuild the analysis views and search rows of table_names (which have just been swapped). """
+    with engine.connect() as conn:
+        views = [table_name for table_name in table_names if _exists(conn, schema, analysis_view_name(table_name))]
+        has_search = _exists(conn, schema, SEARCH_TABLE)
+    for table_name in views:
+        replace_analysis_view(engine, schema, table_name, _census_division(table_name))
+    if has_search:
+        update_column_search_index(engine, schema, registered)
+
+
+def _drop_schema(engine, schema):
+    with engine.connect() as conn:
+        conn.execution_options(autocommit=True).execute('DROP SCHEMA IF EXISTS "{}" CASCADE'.format(schema))
+
+
+def reload_table(factory, census_dir, tmpdir, abbrev, table_number, divisions=None, backend="sync", source=None, partition_by_state=False):
+    """
+    Reload a table (every series of it, in every census division or just
+    divisions) of a package into a live database: load it into a shadow
+    schema, then swap it in (see above).
+
+    The tables must already exist in the live schema - new tables are
+    added with a normal load. partition_by_state should match the load
+    that created them (see partition.py).
+
+    Returns -
+    (stamp, table names): stamp identifies the reload for rollback_reload
+    """
+    package = find_package(abbrev)
+    schema = package_schema_name(package[1])
+    shadow_schema = shadow_schema_name(schema)
+    selection = LoadSelection(packages=[package[1]], tables=[table_number], divisions=divisions)
+    with factory.make_schema_access(SHAPE_SCHEMA) as shape_access:
+        engine = shape_access.session.get_bind()
+
+    _drop_schema(engine, shadow_schema)
+    with stage("reload", table="{}.{}".format(schema, table_number)):
+        with stage("geo gid mapping"):
+            geo_gid_mapping = build_geo_gid_mapping(factory, selection)
+        with factory.make_loader(shadow_schema) as loader:
+            with stage("shadow load"):
+                data_tables, registered = load_package(loader, census_dir, tmpdir, package, geo_gid_mapping, backend=backend, source=source, selection=selection, partition_by_state=partition_by_state)
+        if not data_tables:
+            _drop_schema(engine, shadow_schema)
+            raise Exception("No {} tables found for {} (divisions: {})".format(table_number, package[1], divisions or "all"))
+
+        with engine.connect() as conn:
+            missing = [table_name for table_name in data_tables if not _exists(conn, schema, table_name)]
+        if missing:
+            _drop_schema(engine, shadow_schema)
+            raise Exception("Can't reload tables that aren't in {}: {}".format(schema, ", ".join(missing)))
+
+        stamp = time.strftime("%Y%m%d%H%M%S")
+        swap_tables(engine, schema, shadow_schema, data_tables, stamp)
+        _drop_schema(engine, shadow_schema)
+        _refresh_dependents(engine, schema, data_tables, registered)
+    return stamp, data_tables
+
+
+def get_reload_history(engine, schema):
+    """
+    Returns -
+    [(stamp, table_name, old_table_name, reloaded_at)] for the reloads
+    whose old tables are still kept, most recent first.
+    """
+    with engine.connect() as conn:
+        if not _exists(conn, schema, HISTORY_TABLE):
+            return []
+        return [tuple(row) for row in conn.execute("""
+            SELECT stamp, table_name, old_table_name, reloaded_at
+            FROM "{}"."{}" ORDER BY stamp DESC, table_name""".format(schema, HISTORY_TABLE))]
+
+
+def _registered_metadata(conn, schema, table_names):
+    """ registered[table_name] = (table metadata, [(column_name, column metadata)]) as loaded in schema. """
+    registered = OrderedDict()
+    rows = conn.execute(sqlalchemy.text("""
+        SELECT t.name, t.metadata_json, c.name, c.metadata_json
+        FROM "{schema}".table_info t
+        JOIN "{schema}".column_info c ON c.tableinfo_id = t.id
+        WHERE t.name = ANY(:tables)
+        ORDER BY t.name, c.id""".format(schema=schema)), tables=list(table_names))
+    for table_name, table_json, column_name, column_json in rows:
+        if table_name not in registered:
+            registered[table_name] = (json.loads(table_json) if table_json else {}, [])
+        registered[table_name][1].append((column_name, json.loads(column_json) if column_json else {}))
+    return registered
+
+
+def rollback_reload(engine, schema, stamp):
+    """
+    Undo the reload identified by stamp: swap its old tables (and their
+    metadata) back in and drop the reloaded tables.
+
+    Returns the table names rolled back.
+    """
+    with engine.connect() as conn:
+        history = [(table_name, old_name) for s, table_name, old_name, _ in get_reload_history(engine, schema) if s == stamp]
+        missing = [old_name for _, old_name in history if not _exists(conn, schema, old_name)]
+    if not history:
+        raise Exception("No reload {} in {}".format(stamp, schema))
+    if missing:
+        raise Exception("The old tables of reload {} have been dropped: {}".format(stamp, ", ".join(missing)))
+
+    suffix = "__old_{}".format(stamp)
+
+    def swap(conn):
+        for table_name, old_name in history:
+            grants = _table_grants(conn, schema, table_name)
+            _rename_table(conn, schema, table_name, lambda name: "{}__rolledback_{}".format(name, stamp))
+            _rename_table(conn, schema, old_name, lambda name: re.sub(re.escape(suffix) + "$", "", name))
+            _grant(conn, schema, table_name, grants)
+
+            conn.execute(sqlalchemy.text("""
+                UPDATE "{schema}".table_info t SET metadata_json = h.table_metadata_json
+                FROM "{schema}"."{history}" h
+                WHERE t.name = :table AND h.table_name = :table AND h.stamp = :stamp""".format(schema=schema, history=HISTORY_TABLE)), table=table_name, stamp=stamp)
+            conn.execute(sqlalchemy.text("""
+                UPDATE "{schema}".column_info c SET metadata_json = old.value
+                FROM "{schema}".table_info t, "{schema}"."{history}" h, json_each_text(h.column_metadata_json::json) old
+                WHERE t.name = :table AND c.tableinfo_id = t.id
+                    AND h.table_name = :table AND h.stamp = :stamp AND old.key = c.name""".format(schema=schema, history=HISTORY_TABLE)), table=table_name, stamp=stamp)
+            conn.execute(sqlalchemy.text('DELETE FROM "{}"."{}" WHERE stamp = :stamp AND table_name = :table'.format(schema, HISTORY_TABLE)), stamp=stamp, table=table_name)
+
+    table_names = [table_name for table_name, _ in history]
+    with stage("rollback", rows=len(table_names)):
+        _with_lock_timeout(engine, swap)
+        with engine.connect() as conn:
+            registered = _registered_metadata(conn, schema, table_names)
+        # The analysis views still read the rolled back tables until rebuilt
+        _refresh_dependents(engine, schema, table_names, registered)
+        with engine.connect() as conn:
+            conn = conn.execution_options(autocommit=True)
+            for table_name in table_names:
+                _drop_table(conn, schema, "{}__rolledback_{}".format(table_name, stamp))
+    logger.info("rolled back reload %s of %d tables in %s" % (stamp, len(table_names), schema))
+    return table_names
+
+
+def drop_old_tables(engine, schema, keep=1):
+    """
+    Drop the old tables kept by all but the keep most recent reloads of
+    each table, and their history.
+
+    Returns the tables dropped.
+    """
+    seen = {}
+    dropped = []
+    with engine.connect() as conn:
+        conn = conn.execution_options(autocommit=True)
+        for stamp, table_name, old_name, _ in get_reload_history(engine, schema):
+            seen[table_name] = seen.get(table_name, 0) + 1
+            if seen[table_name] <= keep:
+                continue
+            _drop_table(conn, schema, old_name)
+            conn.execute(sqlalchemy.text('DELETE FROM "{}"."{}" WHERE stamp = :stamp AND table_name = :table'.format(schema, HISTORY_TABLE)), stamp=stamp, table=table_name)
+            dropped.append(old_name)
+    logger.info("dropped %d old tables from %s" % (len(dropped), schema))
+    return dropped
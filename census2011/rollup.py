@@ -0,0 +1,253 @@
+#
+# EAlGIS loader: Australian Census 2011; hierarchical roll-up
+#
+# Aggregates count tables from a finer division of the ASGS main
+# structure to every coarser one (set-based, in SQL), checks the sums
+# against the tables the ABS published for those divisions (vectorised,
+# in NumPy), and writes aggregates for divisions that weren't published.
+#
+# Published figures are perturbed by the ABS to protect confidentiality,
+# so rolled-up sums are only expected to agree within a tolerance.
+#
+
+import re
+import numpy
+import sqlalchemy
+from collections import OrderedDict
+
+from ealgis_common.util import make_logger
+from .shapes import SHAPE_LINKAGE, SHAPE_SCHEMA, SHAPE_GEOMETRY_COLUMN
+from .linkage import add_geolinkages, index_gid_columns
+from .instrument import stage
+from .selection import ALL
+from .partition import STATE_COLUMN
+from .stats import summarise_columns
+
+logger = make_logger(__name__)
+
+# The ASGS main structure, finest first. Each level nests wholly within
+# the levels after it.
+ROLLUP_HIERARCHY = ["sa1", "sa2", "sa3", "sa4", "ste"]
+
+# Medians, averages and means aren't additive: tables (e.g. B02, I04) with
+# columns labelled as such in their registered metadata are never rolled up
+NON_ADDITIVE_RE = re.compile(r'\b(median|average|mean)s?\b', re.IGNORECASE)
+
+CONTAINMENT_TABLE = "division_containment"
+
+# A rolled-up cell is a discrepancy if it differs from the published
+# cell by more than max(ABSOLUTE_TOLERANCE, RELATIVE_TOLERANCE * published)
+ABSOLUTE_TOLERANCE = 10
+RELATIVE_TOLERANCE = 0.05
+
+ROLLUP_TABLE_RE = re.compile(r'^(?P<table>[a-z]+[0-9]+(s[0-9]{1,2})?)_(?P<geo>[a-z]+)_(?P<division>[a-z0-9]+)$')
+
+
+def ensure_containment(engine, fine_division, coarse_division):
+    """
+    Populate the shape schema's containment table, which maps every region
+    of fine_division to the coarse_division region containing it.
+
+    Containment is derived spatially (the coarse region that contains a
+    point on the surface of the fine region), so it doesn't depend on the
+    boundary files carrying their parent codes.
+    """
+    params = {
+        "schema": SHAPE_SCHEMA,
+        "containment": CONTAINMENT_TABLE,
+        "fine": fine_division,
+        "coarse": coarse_division,
+        "geom": SHAPE_GEOMETRY_COLUMN,
+    }
+    with engine.connect() as conn:
+        conn = conn.execution_options(autocommit=True)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS "{schema}"."{containment}" (
+                fine_division varchar NOT NULL,
+                coarse_division varchar NOT NULL,
+                fine_gid integer NOT NULL,
+                coarse_gid integer NOT NULL,
+                PRIMARY KEY (fine_division, coarse_division, fine_gid)
+            )""".format(**params))
+        exists = conn.execute(sqlalchemy.text("""
+            SELECT 1 FROM "{schema}"."{containment}"
+            WHERE fine_division = :fine AND coarse_division = :coarse
+            LIMIT 1""".format(**params)), fine=fine_division, coarse=coarse_division).scalar()
+        if exists is None:
+            logger.info("building %s -> %s containment" % (fine_division, coarse_division))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO "{schema}"."{containment}" (fine_division, coarse_division, fine_gid, coarse_gid)
+                SELECT DISTINCT ON (f.gid) :fine, :coarse, f.gid, c.gid
+                FROM "{schema}"."{fine}" f
+                JOIN "{schema}"."{coarse}" c ON ST_Contains(c."{geom}", ST_PointOnSurface(f."{geom}"))
+                ORDER BY f.gid, c.gid""".format(**params)), fine=fine_division, coarse=coarse_division)
+
+
+def is_non_additive(*labels):
+    """ Whether any of a column's (or table's) metadata labels names a median, average or mean. """
+    return any(NON_ADDITIVE_RE.search(str(label or "")) for label in labels)
+
+
+def non_additive_table(meta, columns):
+    """ Whether a table, given its registered metadata, has any columns that can't be summed. """
+    return is_non_additive(meta.get("type"), meta.get("series")) or any(
+        is_non_additive(column_meta.get("type"), column_meta.get("kind")) for _, column_meta in columns)
+
+
+def get_data_columns(conn, schema, table_name):
+    rows = conn.execute(sqlalchemy.text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :table
+        ORDER BY ordinal_position"""), schema=schema, table=table_name)
+    return [r[0] for r in rows if r[0] not in ("gid", "region_id", STATE_COLUMN)]
+
+
+def rollup_select(schema, table_name, columns, fine_division, coarse_division):
+    """
+    SQL aggregating table_name from fine_division up to coarse_division,
+    one row per coarse region, ordered by gid.
+    """
+    geo_column = SHAPE_LINKAGE[coarse_division][0]
+    sums = ", ".join('sum(a."{col}") AS "{col}"'.format(col=col) for col in columns)
+    return """
+        SELECT c.coarse_gid AS gid, s."{geo_column}"::varchar AS region_id, {sums}
+        FROM "{schema}"."{table}" a
+        JOIN "{shape_schema}"."{containment}" c
+            ON c.fine_division = '{fine}' AND c.coarse_division = '{coarse}' AND c.fine_gid = a.gid
+        JOIN "{shape_schema}"."{coarse}" s ON s.gid = c.coarse_gid
+        GROUP BY c.coarse_gid, s."{geo_column}"
+        ORDER BY c.coarse_gid""".format(
+        schema=schema, table=table_name, sums=sums, geo_column=geo_column,
+        shape_schema=SHAPE_SCHEMA, containment=CONTAINMENT_TABLE,
+        fine=fine_division, coarse=coarse_division)
+
+
+def fetch_matrix(conn, sql, columns):
+    """
+    Run sql and return (gids, values) where values is a float matrix of
+    shape (regions, columns) with NaN for NULL (not applicable) cells.
+    """
+    rows = conn.execute(sql).fetchall()
+    gids = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+    values = numpy.array([r[-len(columns):] for r in rows], dtype=numpy.float64).reshape(len(rows), len(columns))
+    return gids, values
+
+
+def compare(rolled_gids, rolled, published_gids, published, columns, absolute_tolerance, relative_tolerance):
+    """
+    Compare rolled-up values with the published ones for the regions
+    present in both, returning the discrepancy summary.
+    """
+    common, rolled_idx, published_idx = numpy.intersect1d(rolled_gids, published_gids, return_indices=True)
+    a = rolled[rolled_idx]
+    b = published[published_idx]
+    with numpy.errstate(invalid="ignore"):
+        diff = numpy.abs(a - b)
+        tolerance = numpy.maximum(absolute_tolerance, relative_tolerance * numpy.abs(b))
+        comparable = ~(numpy.isnan(a) | numpy.isnan(b))
+        violations = comparable & (diff > tolerance)
+
+    per_column = violations.sum(axis=0)
+    worst = numpy.argsort(-per_column)[:10]
+    return OrderedDict([
+        ("regions", int(len(common))),
+        ("missing_regions", int(len(published_gids) - len(common))),
+        ("cells", int(comparable.sum())),
+        ("discrepant_cells", int(violations.sum())),
+        ("max_abs_diff", float(numpy.nanmax(numpy.where(comparable, diff, numpy.nan))) if comparable.any() else 0.0),
+        ("mean_abs_diff", float(numpy.nanmean(numpy.where(comparable, diff, numpy.nan))) if comparable.any() else 0.0),
+        ("worst_columns", [
+            OrderedDict([("column", columns[i]), ("discrepant_regions", int(per_column[i]))])
+            for i in worst if per_column[i] > 0
+        ]),
+    ])
+
+
+def plan_rollups(data_tables, registered, selection=ALL):
+    """
+    For each additive table (and series) find the finest division it was
+    loaded at and the coarser divisions (of those selected) it can be
+    rolled up to. Additivity is judged from the metadata registered for
+    the table (see non_additive_table); unregistered tables are skipped.
+
+    Returns [(table_prefix, geo, source_division, [target_divisions])]
+    e.g. ("b04s1", "aust", "sa1", ["sa2", "sa3", "sa4", "ste"])
+    """
+    loaded = OrderedDict()
+    for table_name in data_tables:
+        m = ROLLUP_TABLE_RE.match(table_name)
+        if m is None or m.group("division") not in ROLLUP_HIERARCHY:
+            continue
+        if table_name not in registered or non_additive_table(*registered[table_name]):
+            continue
+        loaded.setdefault((m.group("table"), m.group("geo")), []).append(m.group("division"))
+
+    plans = []
+    for (prefix, geo), divisions in loaded.items():
+        source = min(divisions, key=ROLLUP_HIERARCHY.index)
+        targets = [d for d in ROLLUP_HIERARCHY[ROLLUP_HIERARCHY.index(source) + 1:] if selection.division(d)]
+        if targets:
+            plans.append((prefix, geo, source, targets))
+    return plans
+
+
+def rollup_tables(loader, data_tables, registered, absolute_tolerance=ABSOLUTE_TOLERANCE, relative_tolerance=RELATIVE_TOLERANCE, selection=ALL):
+    """
+    Roll every additive table up the ASGS main structure from the finest
+    division it was loaded at.
+
+    Where the ABS published the coarser division, the rolled-up values are
+    checked against it. Where it didn't, the aggregate is written as a new
+    attribute table (registered with the source table's metadata, plus a
+    "rollup_from" key and its own column statistics) and linked to the
+    division's shapes, and added to registered.
+
+    Returns (report, created_tables)
+    """
+    schema = loader.dbschema()
+    report = []
+    created = []
+    for prefix, geo, source, targets in plan_rollups(data_tables, registered, selection):
+        source_table = "{}_{}_{}".format(prefix, geo, source)
+        with stage("rollup", table=source_table), loader.engine.connect() as conn:
+            conn = conn.execution_options(autocommit=True)
+            columns = get_data_columns(conn, schema, source_table)
+            if len(columns) == 0:
+                continue
+            for target in targets:
+                ensure_containment(loader.engine, source, target)
+                target_table = "{}_{}_{}".format(prefix, geo, target)
+                sql = rollup_select(schema, source_table, columns, source, target)
+
+                if target_table in data_tables:
+                    rolled_gids, rolled = fetch_matrix(conn, sql, columns)
+                    published_gids, published = fetch_matrix(conn, 'SELECT gid, {} FROM "{}"."{}" ORDER BY gid'.format(
+                        ", ".join('"{}"'.format(c) for c in columns), schema, target_table), columns)
+                    result = compare(rolled_gids, rolled, published_gids, published, columns, absolute_tolerance, relative_tolerance)
+                    result["table"] = target_table
+                    result["source"] = source_table
+                    if result["discrepant_cells"] > 0:
+                        logger.warning("%s: %d of %d cells differ from the %s roll-up beyond tolerance (max %.0f)" % (
+                            target_table, result["discrepant_cells"], result["cells"], source, result["max_abs_diff"]))
+                    report.append(result)
+                else:
+                    logger.info("%s: writing %s -> %s roll-up" % (target_table, source, target))
+                    conn.execute('CREATE TABLE "{}"."{}" AS {}'.format(schema, target_table, sql))
+                    conn.execute('ALTER TABLE "{}"."{}" ADD PRIMARY KEY (gid)'.format(schema, target_table))
+                    # Registered as CSVLoader registers the tables it loads, before its metadata is set
+                    loader.register_table(target_table)
+                    meta, registered_columns = registered[source_table]
+                    # The source's column statistics don't describe the aggregate
+                    _, rolled = fetch_matrix(conn, 'SELECT gid, {} FROM "{}"."{}" ORDER BY gid'.format(
+                        ", ".join('"{}"'.format(c) for c in columns), schema, target_table), columns)
+                    stats = dict(zip(columns, summarise_columns(rolled)))
+                    registered_columns = [(name, dict(col, stats=stats[name]) if name in stats else col) for name, col in registered_columns]
+                    loader.set_table_metadata(target_table, dict(meta, rollup_from=source))
+                    loader.register_columns(target_table, registered_columns)
+                    registered[target_table] = (dict(meta, rollup_from=source), registered_columns)
+                    created.append((target_table, target))
+
+    if created:
+        add_geolinkages(loader, created)
+        index_gid_columns(loader, [table_name for table_name, _ in created])
+    return report, [table_name for table_name, _ in created]
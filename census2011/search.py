@@ -0,0 +1,150 @@
+#
+# EAlGIS loader: Australian Census 2011; column search index
+#
+# A tokenised full-text index (tsvector + GIN) over the column metadata
+# registered by load_metadata, so queries like "rent weekly 350" return
+# ranked columns without ILIKE scans over tens of thousands of columns.
+#
+# Each package schema gets a column_search table with one row per column:
+#   A weight: the column's row (type) and column (kind) labels
+#   B weight: the series and the table number
+#   C weight: the table's title, population, topics and classifications
+#   D weight: the table's notes
+#
+
+import re
+import sqlalchemy
+
+from ealgis_common.util import make_logger
+from .instrument import stage
+
+logger = make_logger(__name__)
+
+SEARCH_TABLE = "column_search"
+SEARCH_CONFIG = "english"
+
+# "1,000" -> "1000", as concordance.normalise_label does, so "$1,000-$1,249"
+# is found by "1000" as well as "1,000"
+THOUSANDS_SEPARATOR_RE = re.compile(r"(?<=[0-9]),(?=[0-9]{3}(?![0-9]))")
+
+
+def _words(text):
+    """
+    Reduce text to space separated words: strip HTML (the notes) and
+    thousands separators, and split ranges and currency (e.g.
+    "$1,000-$1,249" -> "1000 1249") so each number is a token.
+    """
+    if text is None:
+        return ""
+    text = re.sub(r"<[^>]+>", " ", str(text))
+    text = THOUSANDS_SEPARATOR_RE.sub("", text)
+    return " ".join(re.findall(r"[A-Za-z0-9]+", text))
+
+
+def _search_rows(registered):
+    rows = []
+    for table_name, (meta, columns) in registered.items():
+        table_words = {
+            "b": _words(" ".join(filter(None, [meta.get("series"), meta.get("family"), table_name.split("_")[0]]))),
+            "c": _words(" ".join(filter(None, [meta.get("type"), meta.get("kind")] + list(meta.get("topics", [])) + [u.get("name") for u in meta.get("metadataUrls", [])]))),
+            "d": _words(meta.get("notes")),
+        }
+        for column_name, column_meta in columns:
+            rows.append(dict(
+                table_words,
+                table_name=table_name,
+                column_name=column_name,
+                series=meta.get("series"),
+                type=column_meta.get("type"),
+                kind=column_meta.get("kind"),
+                a=_words("{} {}".format(column_meta.get("type", ""), column_meta.get("kind", ""))),
+            ))
+    return rows
+
+
+def _insert_rows(conn, schema, rows):
+    if rows:
+        conn.execute(sqlalchemy.text("""
+            INSERT INTO "{schema}"."{table}" (table_name, column_name, series, type, kind, document)
+            VALUES (:table_name, :column_name, :series, :type, :kind,
+                setweight(to_tsvector('{config}', :a), 'A') ||
+                setweight(to_tsvector('{config}', :b), 'B') ||
+                setweight(to_tsvector('{config}', :c), 'C') ||
+                setweight(to_tsvector('{config}', :d), 'D'))""".format(schema=schema, table=SEARCH_TABLE, config=SEARCH_CONFIG)), rows)
+
+
+def build_column_search_index(loader, registered):
+    """
+    (Re)build the package's column_search table from the metadata that
+    load_metadata registered.
+
+    registered[table_name] = (table metadata, [(column_name, column metadata)])
+    """
+    schema = loader.dbschema()
+    rows = _search_rows(registered)
+
+    with stage("search index", rows=len(rows)), loader.engine.connect() as conn:
+        conn = conn.execution_options(autocommit=True)
+        params = {"schema": schema, "table": SEARCH_TABLE}
+        conn.execute('DROP TABLE IF EXISTS "{schema}"."{table}"'.format(**params))
+        conn.execute("""
+            CREATE TABLE "{schema}"."{table}" (
+                id serial PRIMARY KEY,
+                table_name varchar NOT NULL,
+                column_name varchar NOT NULL,
+                series varchar,
+                type varchar,
+                kind varchar,
+                document tsvector NOT NULL
+            )""".format(**params))
+        _insert_rows(conn, schema, rows)
+        conn.execute('CREATE INDEX "{table}_document_idx" ON "{schema}"."{table}" USING GIN (document)'.format(**params))
+        conn.execute('ANALYZE "{schema}"."{table}"'.format(**params))
+    logger.info("indexed %d columns for search" % (len(rows)))
+
+
+def update_column_search_index(engine, schema, registered):
+    """
+    Replace the column_search rows of just the tables in registered (e.g.
+    after reloading them, see reload.py), in one transaction.
+    """
+    rows = _search_rows(registered)
+    with stage("search index", rows=len(rows)), engine.begin() as conn:
+        conn.execute(sqlalchemy.text('DELETE FROM "{}"."{}" WHERE table_name = ANY(:tables)'.format(schema, SEARCH_TABLE)), tables=list(registered))
+        _insert_rows(conn, schema, rows)
+    logger.info("re-indexed %d columns for search" % (len(rows)))
+
+
+def to_tsquery_text(query):
+    """
+    "rent weekly 350" -> "rent:* & weekly:* & 350:*"
+
+    Every word must match, and matches on word prefixes so that partially
+    typed queries work.
+    """
+    words = re.findall(r"[a-z0-9]+", THOUSANDS_SEPARATOR_RE.sub("", query.lower()))
+    return " & ".join("{}:*".format(w) for w in words)
+
+
+def search_columns(engine, query, schemas, limit=20):
+    """
+    Search the column_search tables of the given package schemas.
+
+    Returns up to limit dicts (schema, table_name, column_name, series,
+    type, kind, rank), best match first.
+    """
+    tsquery = to_tsquery_text(query)
+    if not tsquery or not schemas:
+        return []
+    union = " UNION ALL ".join("""
+        SELECT '{schema}' AS schema, table_name, column_name, series, type, kind,
+            ts_rank_cd(document, q) AS rank
+        FROM "{schema}"."{table}", q
+        WHERE document @@ q""".format(schema=schema, table=SEARCH_TABLE) for schema in schemas)
+    sql = """
+        WITH q AS (SELECT to_tsquery('{config}', :tsquery) AS q)
+        SELECT * FROM ({union}) AS matches
+        ORDER BY rank DESC, schema, table_name, column_name
+        LIMIT :limit""".format(config=SEARCH_CONFIG, union=union)
+    with engine.connect() as conn:
+        return [dict(row) for row in conn.execute(sqlalchemy.text(sql), tsquery=tsquery, limit=limit)]
@@ -0,0 +1,49 @@
+#
+# EAlGIS loader: Australian Census 2011; selective loads
+#
+# Restrict a load to some packages (by abbreviation, e.g. BCP), table
+# numbers (e.g. b04) and census divisions (e.g. sa2), for development and
+# staging loads. Anything not restricted is loaded in full.
+#
+# e.g.
+#   selection = LoadSelection(packages=["BCP"], divisions=["sa2"])
+#   load_shapes(factory, census_dir, tmpdir, selection=selection)
+#   load_attrs(factory, census_dir, tmpdir, selection=selection)
+#
+
+
+def _normalise(values):
+    if values is None:
+        return None
+    return frozenset(v.strip().lower() for v in values if v.strip())
+
+
+class LoadSelection:
+    def __init__(self, packages=None, tables=None, divisions=None):
+        self.packages = _normalise(packages)
+        self.tables = _normalise(tables)
+        self.divisions = _normalise(divisions)
+
+    def package(self, abbrev):
+        return self.packages is None or abbrev.lower() in self.packages
+
+    def table(self, table_number):
+        return self.tables is None or table_number.lower() in self.tables
+
+    def division(self, census_division):
+        return self.divisions is None or census_division.lower() in self.divisions
+
+    def __repr__(self):
+        def show(values):
+            return "all" if values is None else ",".join(sorted(values))
+        return "LoadSelection(packages={}, tables={}, divisions={})".format(
+            show(self.packages), show(self.tables), show(self.divisions))
+
+
+# Load everything
+ALL = LoadSelection()
+
+
+def parse_list(value):
+    """ Parse a comma separated command line option, e.g. "bcp,xcp". """
+    return [v for v in value.split(",") if v.strip()]
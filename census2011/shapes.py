@@ -4,16 +4,19 @@
 # EAlGIS loader: Australian Census 2011; Data Pack 1
 #
 
-from ealgis_common.loaders import ZipAccess, ShapeLoader
 from ealgis_common.util import make_logger
+from .instrument import stage, file_size
+from .archive import DirectorySource
+from .selection import ALL
 import os
 import os.path
-import sqlalchemy
 from datetime import datetime
 
 
 logger = make_logger(__name__)
 SHAPE_SCHEMA = 'aus_census_2011_shapes'
+# The geometry column created by ShapeLoader (shp2pgsql)
+SHAPE_GEOMETRY_COLUMN = 'geom'
 SHAPE_ZIPS = [
     ('ced', '2011_CED_shape.zip'),
     ('gccsa', '2011_GCCSA_POW_shape.zip'),
@@ -36,6 +39,8 @@ SHAPE_ZIPS = [
     ('sua', '2011_SUA_shape.zip'),
     ('ucl', '2011_UCL_shape.zip'),
 ]
+# division -> (region code column, the sqlalchemy.types type to cast it to
+# when matching DataPack region ids (if any), description)
 SHAPE_LINKAGE = {
     'ced': ('ced_code', None, 'Commonwealth Electoral Division'),
     'gccsa': ('gccsa_code', None, 'Greater Capital City Statistical Areas'),
@@ -45,7 +50,7 @@ SHAPE_LINKAGE = {
     'lga': ('lga_code', None, 'Local Government Area'),
     'poa': ('poa_code', None, 'Postal Areas'),
     'ra': ('ra_code', None, 'Remoteness Area'),
-    'sa1': ('sa1_7digit', sqlalchemy.types.Integer, 'Statistical Area Level 1'),
+    'sa1': ('sa1_7digit', 'Integer', 'Statistical Area Level 1'),
     'sa2': ('sa2_main', None, 'Statistical Area Level 2'),
     'sa3': ('sa3_code', None, 'Statistical Area Level 3'),
     'sa4': ('sa4_code', None, 'Statistical Area Level 4'),
@@ -60,27 +65,46 @@ SHAPE_LINKAGE = {
 }
 
 
-def load_shapes(factory, census_dir, tmpdir):
+def load_shapes(factory, census_dir, tmpdir, source=None, selection=ALL):
+    """
+    Load the shapefiles of every census division.
+
+    source: where to find the shapefile zips (see archive.py), by default
+        census_dir itself
+    selection: the census divisions to load (see selection.py)
+    """
+    # Imported here so that SHAPE_LINKAGE and friends can be used without the loader (see __main__.py)
+    import sqlalchemy
+    from ealgis_common.loaders import ZipAccess, ShapeLoader
+
+    source = source or DirectorySource(census_dir)
     with factory.make_loader(SHAPE_SCHEMA, mandatory_srids=[3112, 3857]) as loader:
 
         def load_shapes():
             logger.info("load census shapefiles")
             for table_name, fname in SHAPE_ZIPS:
-                with ZipAccess(None, tmpdir, os.path.join(census_dir + '/Digital Boundaries/', fname)) as z:
+                if not selection.division(table_name):
+                    continue
+                zip_path = source.wait(os.path.join(census_dir + '/Digital Boundaries/', fname))
+                with stage("shapefile", table=table_name, bytes=file_size(zip_path)), ZipAccess(None, tmpdir, zip_path) as z:
                     for shpfile in z.glob("*.shp"):
                         instance = ShapeLoader(loader.dbschema(), shpfile, 4283, table_name=table_name)
                         instance.load(loader)
+                source.release(zip_path)
             logger.info("loaded shapefiles OK")
             logger.info("creating shape indexes")
             # create column indexes on shape linkage
             loader.session.commit()
             for census_division in SHAPE_LINKAGE:
+                if not selection.division(census_division):
+                    continue
                 logger.info('creating index for %s' % (census_division))
-                table = loader.get_table(census_division)
-                col, _, descr = SHAPE_LINKAGE[census_division]
-                loader.set_table_metadata(census_division, {'description': descr})
-                idx = sqlalchemy.Index("%s_%s_idx" % (census_division, col), table.columns[col], unique=True)
-                idx.create(loader.engine)
+                with stage("index", table=census_division):
+                    table = loader.get_table(census_division)
+                    col, _, descr = SHAPE_LINKAGE[census_division]
+                    loader.set_table_metadata(census_division, {'description': descr})
+                    idx = sqlalchemy.Index("%s_%s_idx" % (census_division, col), table.columns[col], unique=True)
+                    idx.create(loader.engine)
 
         loader.set_metadata(
             name='ABS Census 2011',
@@ -0,0 +1,164 @@
+#
+# EAlGIS loader: Australian Census 2011; minimal ESRI Shapefile reader and writer
+#
+# Just enough of the shapefile format to produce polygon layers that
+# shp2pgsql (and therefore ShapeLoader) will happily ingest, and to read
+# the ABS digital boundaries back (see pointindex.py), without pulling in
+# GDAL or pyshp.
+#
+
+import numpy
+import struct
+import datetime
+
+SHAPE_TYPE_POLYGON = 5
+
+# GDA94 (EPSG:4283), the datum used by the ABS digital boundaries
+GDA94_WKT = (
+    'GEOGCS["GCS_GDA_1994",DATUM["D_GDA_1994",SPHEROID["GRS_1980",6378137.0,298.257222101]],'
+    'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]'
+)
+
+
+def _bbox(rings):
+    xs = [x for ring in rings for x, _ in ring]
+    ys = [y for ring in rings for _, y in ring]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _merge_bbox(a, b):
+    if a is None:
+        return b
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def _file_header(file_length_bytes, bbox):
+    return (
+        struct.pack(">7i", 9994, 0, 0, 0, 0, 0, file_length_bytes // 2) +
+        struct.pack("<2i", 1000, SHAPE_TYPE_POLYGON) +
+        struct.pack("<8d", bbox[0], bbox[1], bbox[2], bbox[3], 0.0, 0.0, 0.0, 0.0))
+
+
+def _polygon_record(rings):
+    points = [pt for ring in rings for pt in ring]
+    parts = []
+    offset = 0
+    for ring in rings:
+        parts.append(offset)
+        offset += len(ring)
+    content = struct.pack("<i4d2i", SHAPE_TYPE_POLYGON, *_bbox(rings), len(rings), len(points))
+    content += struct.pack("<%di" % len(parts), *parts)
+    content += b"".join(struct.pack("<2d", x, y) for x, y in points)
+    return content
+
+
+def _dbf(fields, records):
+    """
+    fields: [(name, type ('C' or 'N'), length, decimals)]
+    """
+    today = datetime.date.today()
+    header_length = 32 + 32 * len(fields) + 1
+    record_length = 1 + sum(f[2] for f in fields)
+    out = [struct.pack("<4BIHH20x", 3, today.year - 1900, today.month, today.day, len(records), header_length, record_length)]
+    for name, ftype, length, decimals in fields:
+        out.append(struct.pack("<11sc4xBB14x", name.encode("ascii")[:10], ftype.encode("ascii"), length, decimals))
+    out.append(b"\r")
+    for record in records:
+        out.append(b" ")
+        for (name, ftype, length, decimals), value in zip(fields, record):
+            value = "" if value is None else str(value)
+            if ftype == "N":
+                out.append(value.rjust(length)[:length].encode("ascii"))
+            else:
+                out.append(value.ljust(length)[:length].encode("latin-1"))
+    out.append(b"\x1a")
+    return b"".join(out)
+
+
+def write_polygon_shapefile(basepath, fields, features):
+    """
+    Write a polygon shapefile (.shp, .shx, .dbf and .prj) to basepath.
+
+    fields: [(name, type ('C' or 'N'), length, decimals)]
+    features: iterable of (rings, record), where rings is a list of
+        closed, clockwise rings of (x, y) tuples and record is a sequence
+        of attribute values in the same order as fields.
+    """
+    shp_records = []
+    shx_entries = []
+    dbf_records = []
+    bbox = None
+    offset = 100
+    for number, (rings, record) in enumerate(features, start=1):
+        content = _polygon_record(rings)
+        shp_records.append(struct.pack(">2i", number, len(content) // 2) + content)
+        shx_entries.append(struct.pack(">2i", offset // 2, len(content) // 2))
+        offset += 8 + len(content)
+        dbf_records.append(record)
+        bbox = _merge_bbox(bbox, _bbox(rings))
+    if bbox is None:
+        bbox = (0.0, 0.0, 0.0, 0.0)
+
+    with open(basepath + ".shp", "wb") as f:
+        f.write(_file_header(offset, bbox))
+        f.writelines(shp_records)
+    with open(basepath + ".shx", "wb") as f:
+        f.write(_file_header(100 + 8 * len(shx_entries), bbox))
+        f.writelines(shx_entries)
+    with open(basepath + ".dbf", "wb") as f:
+        f.write(_dbf(fields, dbf_records))
+    with open(basepath + ".prj", "w") as f:
+        f.write(GDA94_WKT)
+    return [basepath + ext for ext in (".shp", ".shx", ".dbf", ".prj")]
+
+
+def _read_dbf(data):
+    """ Returns the records of a .dbf as dicts of (stripped) strings. """
+    count, header_length, record_length = struct.unpack("<IHH", data[4:12])
+    fields = []
+    offset = 32
+    while data[offset:offset + 1] != b"\r":
+        name, ftype, length = struct.unpack("<11sc4xB15x", data[offset:offset + 32])
+        fields.append((name.split(b"\0")[0].decode("ascii"), length))
+        offset += 32
+    records = []
+    for i in range(count):
+        record = data[header_length + i * record_length:header_length + (i + 1) * record_length]
+        position = 1  # after the deletion flag
+        values = {}
+        for name, length in fields:
+            values[name] = record[position:position + length].decode("latin-1").strip()
+            position += length
+        records.append(None if record[:1] == b"*" else values)
+    return records
+
+
+def read_polygon_shapefile(shp_data, dbf_data):
+    """
+    Read the features of a polygon shapefile from the contents of its .shp
+    and .dbf (Z and M values are ignored).
+
+    Returns -
+    [(record, parts, points)] where record is a dict of attribute values
+        (as strings), parts the index of the first point of each ring and
+        points a float (x, y) array of shape (points, 2); a null shape has
+        no parts
+    """
+    records = _read_dbf(dbf_data)
+    features = []
+    offset = 100
+    for record in records:
+        content_length = struct.unpack(">i", shp_data[offset + 4:offset + 8])[0] * 2
+        content = shp_data[offset + 8:offset + 8 + content_length]
+        offset += 8 + content_length
+        shape_type = struct.unpack("<i", content[:4])[0]
+        if shape_type == 0:
+            parts, points = [], numpy.zeros((0, 2))
+        else:
+            num_parts, num_points = struct.unpack("<2i", content[36:44])
+            parts = list(struct.unpack("<%di" % num_parts, content[44:44 + 4 * num_parts]))
+            start = 44 + 4 * num_parts
+            points = numpy.frombuffer(content, dtype="<f8", count=2 * num_points, offset=start).reshape(num_points, 2)
+        if record is not None:
+            features.append((record, parts, points))
+    return features
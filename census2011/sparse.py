@@ -0,0 +1,223 @@
+#
+# EAlGIS loader: Australian Census 2011; sparse attribute tables
+#
+# At the finer census divisions most cells of many tables are 0 or ".."
+# (not applicable): e.g. an SA1 has a few hundred people, so most of the
+# cells of the country of birth or ancestry tables are 0. Optionally
+# (load_datapacks' sparse_threshold), tables are stored by what they
+# hold rather than by their shape:
+#
+#   - A table whose density (the share of its cells that have to be
+#     stored: those that aren't 0, in columns with any values, measured
+#     from the column statistics computed as each CSV file is scanned, see
+#     stats.py) is below the threshold is packed into
+#     <table>__sparse: one row per region, holding arrays of the ids (the
+#     column's position among the columns stored) and values of its
+#     non-zero cells. Not applicable cells are kept, as NULL values.
+#   - The columns of any other table without a single value (e.g. every
+#     cell ".."), are dropped from it, the rest being kept in
+#     <table>__stored (just gid and region_id, if no column has a value).
+#
+# Columns without a value are still registered with their metadata (as
+# "na" if every cell was "..", see load_metadata), but aren't stored. The
+# table itself is replaced by a view with its original columns, so
+# readers can't tell the difference: a packed column is 0 unless it's in
+# the row's arrays, and a column without values is NULL.
+#
+# e.g. for b10a_aust_sa1, with 6% of its cells non-zero
+#   b10a_aust_sa1__sparse (gid, region_id, column_ids smallint[], column_values bigint[])
+#   CREATE VIEW b10a_aust_sa1 AS SELECT gid, region_id,
+#       CASE WHEN 1 = ANY(column_ids) THEN column_values[array_position(column_ids, 1::smallint)] ELSE 0 END::bigint AS "b2431",
+#       ...
+#
+# The storage tables keep the gid primary key (which index_gid_columns
+# checks for) and are what the run report's sizes are measured on. Tables
+# holding text aren't packed, and tables stored either way aren't
+# partitioned by state (see partition.py).
+#
+
+import sqlalchemy
+
+from ealgis_common.util import make_logger
+from .instrument import stage, report
+
+logger = make_logger(__name__)
+
+# Tables with fewer non-zero cells than this are packed
+DENSITY_THRESHOLD = 0.25
+
+SPARSE_SUFFIX = "__sparse"
+STORED_SUFFIX = "__stored"
+
+# The columns of every attribute table that aren't census data
+KEY_COLUMNS = ("gid", "region_id")
+
+# The column types that can be packed (as loaded by CSVLoader or the async
+# backend), the packed values being numeric if any column is, double
+# precision if any column is floating point, and bigint otherwise
+INTEGER_TYPES = ("smallint", "integer", "bigint")
+FLOAT_TYPES = ("real", "double precision")
+NUMERIC_TYPES = ("numeric",)
+
+
+def table_density(table_stats):
+    """
+    The density of a table from the summary statistics of its columns
+    (see stats.py).
+
+    Returns -
+    (density, [names of the columns without any values])
+    """
+    cells = stored = 0
+    empty = []
+    for column_name, summary in table_stats.items():
+        cells += summary["count"] + summary["nulls"]
+        if summary["count"] == 0:
+            empty.append(column_name)
+        else:
+            # Not applicable cells of a column with values are stored, as NULL
+            stored += summary["count"] - summary["zeros"] + summary["nulls"]
+    return (stored / cells if cells else 1.0), empty
+
+
+def plan_storage(column_stats, table_names, threshold=DENSITY_THRESHOLD):
+    """
+    Decide how each of table_names is stored, from its column statistics.
+
+    Returns -
+    plan[table_name] = (layout, density, empty columns), layout being
+    "sparse" or "stored"; tables kept as they are aren't in the plan.
+    """
+    plan = {}
+    for table_name in table_names:
+        table_stats = column_stats.get(table_name)
+        if not table_stats:
+            continue
+        density, empty = table_density(table_stats)
+        if len(empty) == len(table_stats):
+            # Nothing to pack: only the key columns are stored
+            plan[table_name] = ("stored", density, empty)
+        elif density < threshold:
+            plan[table_name] = ("sparse", density, empty)
+        elif empty:
+            plan[table_name] = ("stored", density, empty)
+    return plan
+
+
+def storage_table_name(table_name, layout):
+    return table_name + (SPARSE_SUFFIX if layout == "sparse" else STORED_SUFFIX)
+
+
+def _table_columns(conn, schema, table_name):
+    """ [(column_name, data_type)] of a table, in order. """
+    return [tuple(r) for r in conn.execute(sqlalchemy.text("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :table
+        ORDER BY ordinal_position"""), schema=schema, table=table_name)]
+
+
+def _table_size(conn, schema, table_name):
+    return conn.execute(sqlalchemy.text("SELECT pg_total_relation_size(to_regclass(:table))"), table='"{}"."{}"'.format(schema, table_name)).scalar()
+
+
+def _pack_select(schema, table_name, data_columns, value_type):
+    """ The rows of <table>__sparse: each region's non-zero cells as (column id, value) arrays. """
+    cells = ", ".join('({}, t."{}"::{})'.format(column_id, name, value_type) for column_id, (name, _) in enumerate(data_columns, 1))
+    return """
+        SELECT t.gid, t.region_id,
+            coalesce(p.column_ids, '{{}}')::smallint[] AS column_ids,
+            coalesce(p.column_values, '{{}}')::{value_type}[] AS column_values
+        FROM "{schema}"."{table}" t
+        LEFT JOIN LATERAL (
+            SELECT array_agg(c.id ORDER BY c.id) AS column_ids, array_agg(c.value ORDER BY c.id) AS column_values
+            FROM (VALUES {cells}) AS c(id, value)
+            WHERE c.value IS DISTINCT FROM 0) p ON true""".format(schema=schema, table=table_name, cells=cells, value_type=value_type)
+
+
+def _view_columns(layout, data_columns, empty):
+    """ The select list of the view standing in for a table; column ids are positions among the stored columns. """
+    select = ['"{}"'.format(name) for name in KEY_COLUMNS]
+    column_id = 0
+    for name, data_type in data_columns:
+        if name in empty:
+            expression = "NULL"
+        else:
+            column_id += 1
+            if layout == "sparse":
+                expression = "CASE WHEN {id} = ANY(column_ids) THEN column_values[array_position(column_ids, {id}::smallint)] ELSE 0 END".format(id=column_id)
+            else:
+                expression = '"{}"'.format(name)
+        select.append('{}::{} AS "{}"'.format(expression, data_type, name))
+    return ",\n            ".join(select)
+
+
+def store_table(engine, schema, table_name, layout, empty):
+    """
+    Move a table's data into its storage table (see plan_storage) and
+    replace it with a view of its original columns.
+
+    Returns (bytes before, bytes after).
+    """
+    storage_table = storage_table_name(table_name, layout)
+    params = {"schema": schema, "table": table_name, "storage": storage_table}
+    with engine.begin() as conn:
+        columns = _table_columns(conn, schema, table_name)
+        data_columns = [(name, data_type) for name, data_type in columns if name not in KEY_COLUMNS]
+        stored = [(name, data_type) for name, data_type in data_columns if name not in empty]
+        size_before = _table_size(conn, schema, table_name)
+
+        if layout == "sparse":
+            types = set(data_type for _, data_type in stored)
+            if not stored or not types <= set(INTEGER_TYPES + FLOAT_TYPES + NUMERIC_TYPES):
+                raise ValueError("{}.{} has non-numeric columns and can't be packed".format(schema, table_name))
+            if types & set(NUMERIC_TYPES):
+                value_type = "numeric"
+            elif types & set(FLOAT_TYPES):
+                value_type = "double precision"
+            else:
+                value_type = "bigint"
+            select = _pack_select(schema, table_name, stored, value_type)
+        else:
+            select = 'SELECT {} FROM "{schema}"."{table}"'.format(", ".join('"{}"'.format(name) for name in list(KEY_COLUMNS) + [name for name, _ in stored]), **params)
+
+        conn.execute('DROP TABLE IF EXISTS "{schema}"."{storage}"'.format(**params))
+        conn.execute('CREATE TABLE "{schema}"."{storage}" AS {select}'.format(select=select, **params))
+        conn.execute('ALTER TABLE "{schema}"."{storage}" ADD PRIMARY KEY (gid)'.format(**params))
+        conn.execute('DROP TABLE "{schema}"."{table}"'.format(**params))
+        conn.execute("""
+            CREATE VIEW "{schema}"."{table}" AS
+            SELECT {columns}
+            FROM "{schema}"."{storage}\"""".format(columns=_view_columns(layout, data_columns, empty), **params))
+        return size_before, _table_size(conn, schema, storage_table)
+
+
+def store_tables(engine, schema, table_names, column_stats, threshold=DENSITY_THRESHOLD):
+    """
+    Store each of table_names that is sparse, or has columns without any
+    values, as planned by plan_storage. What was done, with the tables'
+    sizes, is added to the run report.
+
+    Returns -
+    storage[table_name] = the table now holding its data, for every table
+    replaced by a view
+    """
+    plan = plan_storage(column_stats, table_names, threshold)
+    storage = {}
+    for table_name, (layout, density, empty) in plan.items():
+        with stage("sparse", table=table_name) as timer:
+            try:
+                size_before, size_after = store_table(engine, schema, table_name, layout, empty)
+            except ValueError as e:
+                logger.warning(e)
+                continue
+            timer.add(bytes=size_after)
+        logger.info("%s: stored %s (density %.2f, %d empty columns), %d -> %d bytes" % (table_name, layout, density, len(empty), size_before, size_after))
+        report.info.setdefault("storage", {})[table_name] = {
+            "layout": layout,
+            "density": round(density, 4),
+            "empty_columns": len(empty),
+            "bytes_before": size_before,
+            "bytes_after": size_after,
+        }
+        storage[table_name] = storage_table_name(table_name, layout)
+    return storage
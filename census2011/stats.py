@@ -0,0 +1,86 @@
+#
+# EAlGIS loader: Australian Census 2011; column statistics
+#
+# Summary statistics of every attribute column, registered with its
+# column metadata (as "stats"), so that EAlGIS can classify a column for a
+# choropleth (e.g. quantile or equal interval breaks) without scanning
+# its table. They're computed from the values the CSV scanner has already
+# parsed (see csvscan.py), for all of a table's columns at once.
+#
+# e.g.
+#   {"count": 2196, "nulls": 0, "zeros": 410, "min": 0, "max": 1204, "mean": 123.4,
+#    "quantiles": {"0.1": 3, "0.25": 22, ..., "0.9": 311},
+#    "histogram": {"edges": [0, 120.4, ..., 1204], "counts": [1502, 388, ...]}}
+#
+
+import numpy
+from collections import OrderedDict
+
+QUANTILES = (0.05, 0.1, 0.2, 0.25, 0.3, 0.4, 0.5, 0.6, 0.7, 0.75, 0.8, 0.9, 0.95)
+HISTOGRAM_BINS = 10
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else round(value, 6)
+
+
+def summarise_columns(values, quantiles=QUANTILES, bins=HISTOGRAM_BINS):
+    """
+    Summarise each column of values, a float matrix of shape (regions,
+    columns) with NaN where a cell is empty or not applicable.
+
+    Returns a summary per column (zeros counting the cells that are 0, from
+    which the column's density follows); min, max, mean, quantiles and histogram
+    are None for a column without any values.
+    """
+    rows, columns = values.shape
+    present = ~numpy.isnan(values)
+    counts = present.sum(axis=0)
+    zeros = (values == 0).sum(axis=0)
+    summaries = [OrderedDict([("count", int(counts[c])), ("nulls", int(rows - counts[c])), ("zeros", int(zeros[c]))]) for c in range(columns)]
+    with_values = numpy.flatnonzero(counts > 0)
+    for summary in summaries:
+        summary.update(min=None, max=None, mean=None, quantiles=None, histogram=None)
+    if len(with_values) == 0:
+        return summaries
+
+    # One sort gives the min, max and quantiles (NaNs sort last)
+    data = numpy.sort(values[:, with_values], axis=0)
+    n = counts[with_values]
+    columns_index = numpy.arange(len(with_values))
+    minimum = data[0]
+    maximum = data[n - 1, columns_index]
+    mean = numpy.nanmean(data, axis=0)
+    breaks = []
+    for q in quantiles:
+        # Linear interpolation between the closest ranks, as numpy.quantile
+        position = q * (n - 1)
+        lower = numpy.floor(position).astype(numpy.int64)
+        upper = numpy.minimum(lower + 1, n - 1)
+        fraction = position - lower
+        breaks.append(data[lower, columns_index] * (1 - fraction) + data[upper, columns_index] * fraction)
+
+    # Equal interval histogram per column, counted for every column at once
+    # by offsetting each column's bin numbers
+    span = numpy.where(maximum > minimum, maximum - minimum, 1.0)
+    bin_of = numpy.floor((data - minimum) / span * bins)
+    bin_of = numpy.clip(numpy.nan_to_num(bin_of, nan=-1), -1, bins - 1).astype(numpy.int64)
+    valid = bin_of >= 0
+    histogram = numpy.bincount((bin_of + columns_index * bins)[valid], minlength=len(with_values) * bins).reshape(len(with_values), bins)
+
+    for i, c in enumerate(with_values):
+        if maximum[i] > minimum[i]:
+            edges = [_number(minimum[i] + span[i] * b / bins) for b in range(bins + 1)]
+            column_histogram = [int(count) for count in histogram[i]]
+        else:
+            edges = [_number(minimum[i]), _number(maximum[i])]
+            column_histogram = [int(n[i])]
+        summaries[c].update(
+            min=_number(minimum[i]),
+            max=_number(maximum[i]),
+            mean=_number(mean[i]),
+            quantiles=OrderedDict((str(q), _number(breaks[j][i])) for j, q in enumerate(quantiles)),
+            histogram=OrderedDict([("edges", edges), ("counts", column_histogram)]),
+        )
+    return summaries
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+#
+# EAlGIS loader: Australian Census 2011; synthetic DataPack generator
+#
+# Writes a census tree with the same layout that load_shapes and
+# load_attrs expect (metadata workbooks, digital boundary zips and
+# sequential number descriptor CSVs), at a configurable scale, so the
+# loader can be exercised and benchmarked without the 7z release.
+#
+
+import os
+import csv
+import json
+import random
+import zipfile
+import argparse
+import tempfile
+import openpyxl
+
+from ealgis_common.util import make_logger
+from .shapes import SHAPE_ZIPS, SHAPE_LINKAGE
+from .attrs import PACKAGES, package_dirname
+from .shp import write_polygon_shapefile
+
+logger = make_logger(__name__)
+
+NOT_APPLICABLE = ".."
+SUMMARY_FILENAME = "synthetic.json"
+
+# The ASGS main structure, coarsest first. Each level nests wholly
+# within the level above it.
+MAIN_STRUCTURE = ["ste", "sa4", "sa3", "sa2", "sa1"]
+
+# Number of child regions per parent at scale=1.0 (roughly the real 2011 ASGS)
+MAIN_STRUCTURE_FANOUT = {
+    "sa4": 13,  # per ste
+    "sa3": 3,  # per sa4
+    "sa2": 7,  # per sa3
+    "sa1": 25,  # per sa2
+}
+
+# Regions per state at scale=1.0 and code width for the other structures
+OTHER_STRUCTURES = {
+    "ced": (19, 3),
+    "gccsa": (2, 5),
+    "iare": (54, 6),
+    "iloc": (140, 8),
+    "ireg": (7, 3),
+    "lga": (70, 5),
+    "poa": (314, 4),
+    "ra": (5, 2),
+    "sed": (50, 5),
+    "sla": (174, 9),
+    "sos": (4, 2),
+    "sosr": (8, 3),
+    "ssc": (1037, 5),
+    "sua": (13, 4),
+    "ucl": (225, 6),
+}
+FIXED_SIZE_STRUCTURES = ("gccsa", "ra", "sos", "sosr")
+
+STATES = 8
+
+# Australia, roughly, in GDA94 lon/lat
+EXTENT = (113.0, -43.0, 153.0, -10.0)
+
+# (table_number, category rows, has series, datapack parts)
+# Tables with repair rules in attrs_repair are avoided so that every
+# synthetic column parses cleanly.
+SYNTHETIC_TABLES = {
+    "IP": [("i03", 8, False, 1), ("i04", 6, True, 2)],
+    "BCP": [("b01", 20, False, 2), ("b04", 12, True, 2), ("b13", 10, True, 1), ("b05", 6, False, 1)],
+    "PEP": [("p01", 20, False, 1), ("p04", 12, True, 1)],
+    "XCP": [("x01", 15, True, 3), ("x03", 10, False, 2)],
+    "TSP": [("t01", 10, False, 1), ("t02", 6, True, 1)],
+    "WPP": [("w01", 8, False, 1), ("w02", 6, True, 1)],
+}
+
+KINDS = ["Males", "Females", "Persons"]
+SERIES = ["MALES", "FEMALES", "PERSONS"]
+SERIES_KINDS = ["Employed", "Unemployed", "Total"]
+
+
+def _split_rect(rect, n, axis):
+    x0, y0, x1, y1 = rect
+    rects = []
+    for i in range(n):
+        if axis == 0:
+            step = (x1 - x0) / n
+            rects.append((x0 + step * i, y0, x0 + step * (i + 1), y1))
+        else:
+            step = (y1 - y0) / n
+            rects.append((x0, y0 + step * i, x1, y0 + step * (i + 1)))
+    return rects
+
+
+def _rect_rings(rect):
+    # A single clockwise exterior ring
+    x0, y0, x1, y1 = rect
+    return [[(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]]
+
+
+def _scaled(n, scale):
+    return max(1, int(round(n * scale)))
+
+
+def build_regions(scale):
+    """
+    Build the synthetic regions for every census division.
+
+    Returns -
+    regions[census_division] = [{
+        "code": "1100101",
+        "rect": (x0, y0, x1, y1),
+        "state": "1",
+        "parents": {"sa2": "101011001", ...},  # Main structure only
+    }]
+    """
+    regions = {division: [] for division in SHAPE_LINKAGE}
+    fanout = dict(MAIN_STRUCTURE_FANOUT)
+    # Scale the finer levels harder so small runs keep a realistic hierarchy
+    fanout["sa2"] = _scaled(fanout["sa2"], scale ** 0.5)
+    fanout["sa1"] = _scaled(fanout["sa1"], scale ** 0.5)
+
+    state_rects = _split_rect(EXTENT, STATES, 0)
+    for state_idx, state_rect in enumerate(state_rects):
+        state = str(state_idx + 1)
+        regions["ste"].append({"code": state, "rect": state_rect, "state": state, "parents": {}})
+        sa2_seq = 1001
+        for i, sa4_rect in enumerate(_split_rect(state_rect, fanout["sa4"], 1)):
+            sa4 = "%s%02d" % (state, i + 1)
+            regions["sa4"].append({"code": sa4, "rect": sa4_rect, "state": state, "parents": {"ste": state}})
+            for j, sa3_rect in enumerate(_split_rect(sa4_rect, fanout["sa3"], 0)):
+                sa3 = "%s%02d" % (sa4, j + 1)
+                regions["sa3"].append({"code": sa3, "rect": sa3_rect, "state": state, "parents": {"ste": state, "sa4": sa4}})
+                for sa2_rect in _split_rect(sa3_rect, fanout["sa2"], 1):
+                    sa2 = "%s%04d" % (sa3, sa2_seq)
+                    sa2_seq += 1
+                    regions["sa2"].append({"code": sa2, "rect": sa2_rect, "state": state, "parents": {"ste": state, "sa4": sa4, "sa3": sa3}})
+                    for k, sa1_rect in enumerate(_split_rect(sa2_rect, fanout["sa1"], 0)):
+                        sa1 = "%s%s%02d" % (state, sa2[-4:], k + 1)
+                        regions["sa1"].append({"code": sa1, "rect": sa1_rect, "state": state, "parents": {"ste": state, "sa4": sa4, "sa3": sa3, "sa2": sa2}})
+
+        for division, (per_state, width) in OTHER_STRUCTURES.items():
+            count = per_state if division in FIXED_SIZE_STRUCTURES else _scaled(per_state, scale)
+            width = max(width, len(str(count)) + 1)
+            for i, rect in enumerate(_split_rect(state_rect, count, (state_idx + len(division)) % 2)):
+                if division == "gccsa":
+                    code = "%sGCC%d" % (state, i + 1)
+                else:
+                    code = state + str(i + 1).zfill(width - 1)
+                regions[division].append({"code": code, "rect": rect, "state": state, "parents": {}})
+    return regions
+
+
+def write_shapes(census_dir, regions):
+    boundaries_dir = os.path.join(census_dir, "Digital Boundaries")
+    os.makedirs(boundaries_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for division, fname in SHAPE_ZIPS:
+            geo_column = SHAPE_LINKAGE[division][0]
+            parents = [] if division not in MAIN_STRUCTURE else MAIN_STRUCTURE[:MAIN_STRUCTURE.index(division)]
+            parent_fields = [SHAPE_LINKAGE[p][0].upper() for p in parents]
+            fields = [(geo_column.upper(), "C", 20, 0), ("%s_NAME" % (division.upper()), "C", 50, 0)]
+            fields += [(f, "C", 20, 0) for f in parent_fields]
+            with_state = division != "ste" and "ste" not in parents
+            if with_state:
+                fields.append(("STATE_CODE", "C", 1, 0))
+
+            def features():
+                for region in regions[division]:
+                    record = [region["code"], "Synthetic %s %s" % (division.upper(), region["code"])]
+                    record += [region["parents"][p] for p in parents]
+                    if with_state:
+                        record.append(region["state"])
+                    yield _rect_rings(region["rect"]), record
+
+            basepath = os.path.join(tmpdir, "%s_2011_AUST" % (division.upper()))
+            paths = write_polygon_shapefile(basepath, fields, features())
+            with zipfile.ZipFile(os.path.join(boundaries_dir, fname), "w", zipfile.ZIP_DEFLATED) as z:
+                for path in paths:
+                    z.write(path, os.path.basename(path))
+                    os.remove(path)
+            logger.info("wrote %d %s boundaries" % (len(regions[division]), division))
+
+
+def build_table_columns(abbrev, table_number, category_rows, has_series, parts, first_column):
+    """
+    Describe the columns of a synthetic table.
+
+    Returns a list of dicts with the sequential column name, the values
+    needed for the metadata workbook and enough structure to generate
+    internally consistent values.
+    """
+    rows = ["Category %d" % (i + 1) for i in range(category_rows)] + ["Not applicable", "Total"]
+    columns = []
+    seq = first_column
+    for series in (SERIES if has_series else [None]):
+        for row in rows:
+            for kind in (SERIES_KINDS if has_series else KINDS):
+                long_name = "_".join(([series] if series else []) + row.split(" ") + kind.split(" "))
+                columns.append({
+                    "name": "%s%d" % (abbrev[0], seq),
+                    "short": "%s_%s_%s" % (kind[:3], row.split(" ")[-1][:3], series[0] if series else "T"),
+                    "long": long_name,
+                    "heading": kind if series is None else "%s|%s" % (kind, series),
+                    "series": series,
+                    "row": row,
+                    "kind": kind,
+                })
+                seq += 1
+
+    # Spread the columns over the datapack parts (e.g. B01A, B01B)
+    per_part = -(-len(columns) // parts)
+    for i, column in enumerate(columns):
+        part = i // per_part
+        column["datapack"] = table_number.upper() + (chr(ord("A") + part) if parts > 1 else "")
+    return columns, seq
+
+
+def _cell_values(columns, rng):
+    """
+    Generate one region's values for a table such that
+    Males + Females = Persons and the Total row/kind are true sums.
+    """
+    rows = list(dict.fromkeys(c["row"] for c in columns))
+    values = {}
+    for column in columns:
+        key = (column["series"], column["row"], column["kind"])
+        if column["row"] == "Not applicable":
+            values[key] = None
+        elif column["row"] == "Total" or column["kind"] in ("Persons", "Total") or column["series"] == "PERSONS":
+            continue
+        else:
+            values[key] = rng.randint(0, 40)
+
+    def get(series, row, kind):
+        key = (series, row, kind)
+        if key in values:
+            return values[key]
+        if row == "Not applicable":
+            return None
+        if series == "PERSONS":
+            value = get("MALES", row, kind) + get("FEMALES", row, kind)
+        elif row == "Total":
+            value = sum(get(series, r, kind) for r in rows if r not in ("Total", "Not applicable"))
+        elif kind == "Persons":
+            value = get(series, row, "Males") + get(series, row, "Females")
+        elif kind == "Total":
+            value = get(series, row, "Employed") + get(series, row, "Unemployed")
+        values[key] = value
+        return value
+
+    return [get(c["series"], c["row"], c["kind"]) for c in columns]
+
+
+def _format(value):
+    return NOT_APPLICABLE if value is None else str(value)
+
+
+def _add(a, b):
+    return [None if x is None else x + y for x, y in zip(a, b)]
+
+
+def generate_table_values(division, regions, columns, rng):
+    """
+    Yield (region_code, values) for every region of a division.
+
+    Main structure values are generated at sa1 and summed upwards, so
+    the synthetic census is consistent across the ASGS hierarchy.
+    """
+    if division not in MAIN_STRUCTURE:
+        for region in regions[division]:
+            yield region["code"], _cell_values(columns, rng)
+        return
+
+    totals = {}
+    for region in regions["sa1"]:
+        values = _cell_values(columns, rng)
+        if division == "sa1":
+            yield region["code"], values
+        else:
+            parent = region["parents"][division]
+            totals[parent] = values if parent not in totals else _add(totals[parent], values)
+    if division != "sa1":
+        for region in regions[division]:
+            yield region["code"], totals[region["code"]]
+
+
+def write_datapacks(census_dir, regions, abbrev, tables, divisions, rng):
+    package_name = [p[0] for p in PACKAGES if p[1] == abbrev][0]
+    base_dir = os.path.join(census_dir, package_dirname(package_name), "Sequential Number Descriptor")
+    stats = {"rows": 0, "bytes": 0, "files": 0}
+    metadata = []
+    next_column = 1
+
+    for table_number, category_rows, has_series, parts in tables:
+        columns, next_column = build_table_columns(abbrev, table_number, category_rows, has_series, parts, next_column)
+        metadata.append((table_number, columns))
+        datapacks = list(dict.fromkeys(c["datapack"] for c in columns))
+
+        for division in divisions:
+            geo_dir = os.path.join(base_dir, division.upper(), "AUST")
+            os.makedirs(geo_dir, exist_ok=True)
+            handles = {}
+            for datapack in datapacks:
+                path = os.path.join(geo_dir, "2011Census_%s_AUST_%s_sequential.csv" % (datapack, division.upper()))
+                f = open(path, "w", newline="")
+                writer = csv.writer(f)
+                indexes = [i for i, c in enumerate(columns) if c["datapack"] == datapack]
+                writer.writerow(["region_id"] + [columns[i]["name"] for i in indexes])
+                handles[datapack] = (f, writer, indexes)
+
+            for region_code, values in generate_table_values(division, regions, columns, rng):
+                for f, writer, indexes in handles.values():
+                    writer.writerow([region_code] + [_format(values[i]) for i in indexes])
+                stats["rows"] += 1
+
+            for f, writer, indexes in handles.values():
+                stats["bytes"] += f.tell()
+                stats["files"] += 1
+                f.close()
+        logger.info("%s: wrote %s for %d divisions" % (abbrev, table_number.upper(), len(divisions)))
+    return metadata, stats
+
+
+def write_metadata(census_dir, abbrev, metadata_filename, metadata):
+    """
+    Write a metadata workbook laid out like the ABS Metadata_2011_*_DataPack.xlsx
+    files: a table list on the first sheet and the cell descriptors on the second.
+    """
+    wb = openpyxl.Workbook()
+    tables = wb.active
+    tables.title = "Table number, name, population"
+    tables.append(["Metadata for %s DataPack (synthetic)" % (abbrev)])
+    tables.append(["Table number", "Table name", "Table population"])
+    for table_number, columns in metadata:
+        tables.append([table_number.upper(), "Synthetic %s table %s" % (abbrev, table_number.upper()), "Persons"])
+
+    descriptors = wb.create_sheet("Cell descriptors information")
+    descriptors.append(["Metadata for %s DataPack (synthetic)" % (abbrev)])
+    descriptors.append(["Cell descriptors information"])
+    descriptors.append(["Sequential", "Short", "Long", "DataPack file", "Profile table", "Column heading description in profile"])
+    for table_number, columns in metadata:
+        for column in columns:
+            descriptors.append([column["name"], column["short"], column["long"], column["datapack"], table_number.upper(), column["heading"]])
+
+    metadata_dir = os.path.join(census_dir, "Metadata")
+    os.makedirs(metadata_dir, exist_ok=True)
+    wb.save(os.path.join(metadata_dir, metadata_filename))
+
+
+def generate_census(census_dir, scale=0.01, packages=None, divisions=None, seed=2011):
+    """
+    Write a synthetic census tree to census_dir.
+
+    scale: 1.0 approximates the real 2011 census region counts (~55k SA1s)
+    packages: package abbreviations to generate (default: all)
+    divisions: census divisions to write datapack CSVs for (default: all)
+
+    Returns a summary of the regions, rows and bytes written, which is
+    also saved alongside the tree as synthetic.json.
+    """
+    rng = random.Random(seed)
+    packages = [p.upper() for p in packages] if packages else [p[1] for p in PACKAGES]
+    divisions = divisions or sorted(SHAPE_LINKAGE)
+
+    regions = build_regions(scale)
+    write_shapes(census_dir, regions)
+
+    summary = {
+        "scale": scale,
+        "regions": {division: len(regions[division]) for division in regions},
+        "packages": {},
+    }
+    for package_name, abbrev, metadata_filename, _ in PACKAGES:
+        if abbrev not in packages:
+            continue
+        metadata, stats = write_datapacks(census_dir, regions, abbrev, SYNTHETIC_TABLES[abbrev], divisions, rng)
+        write_metadata(census_dir, abbrev, metadata_filename, metadata)
+        summary["packages"][abbrev] = stats
+
+    with open(os.path.join(census_dir, SUMMARY_FILENAME), "w") as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic 2011 Census DataPack tree")
+    parser.add_argument("census_dir")
+    parser.add_argument("--scale", type=float, default=0.01)
+    parser.add_argument("--packages", nargs="*")
+    parser.add_argument("--divisions", nargs="*")
+    parser.add_argument("--seed", type=int, default=2011)
+    args = parser.parse_args()
+    summary = generate_census(args.census_dir, args.scale, args.packages, args.divisions, args.seed)
+    logger.info("generated %s" % (summary))
+
+
+if __name__ == '__main__':
+    main()
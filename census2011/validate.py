@@ -0,0 +1,241 @@
+#
+# EAlGIS loader: Australian Census 2011; internal consistency checks
+#
+# Most census tables are built from sums: Males + Females = Persons, and
+# a "Total" row (type) or column (kind) holds the sum of the others. The
+# identities are found from the parsed column metadata, so every table is
+# checked without a hand-written rule per table - and a mislabelled column
+# (see attrs_repair.py) shows up as an identity that doesn't hold.
+#
+# For each table number and census division (joining the tables of a
+# table that was split by series) the identities are written as a
+# coefficient matrix, +1 per component and -1 for the total, so checking
+# every identity for every region is one matrix product. Published figures
+# are perturbed by the ABS, so identities are only expected to hold within
+# the roll-up tolerance (see rollup.py).
+#
+# Identities, within the columns sharing the other two labels:
+#   sex: Persons = Males + Females, by kind or by series (e.g. P16, B04)
+#   total row: type "Total" = the sum of the other types
+#   total kind: kind "Total" = the sum of the other kinds
+# Total identities are skipped where there are subtotals (other labels
+# starting with "Total"), as the components then overlap. Medians,
+# averages and means (e.g. B02, I04) aren't sums, so columns labelled as
+# such are left out of every identity.
+#
+
+import re
+import json
+import numpy
+import sqlalchemy
+from functools import reduce
+from collections import OrderedDict
+
+from ealgis_common.util import make_logger
+from .rollup import ABSOLUTE_TOLERANCE, RELATIVE_TOLERANCE, ROLLUP_TABLE_RE, is_non_additive, fetch_matrix
+from .instrument import stage
+from .selection import ALL
+
+logger = make_logger(__name__)
+
+NUMERIC_TYPES = ("smallint", "integer", "bigint", "numeric", "real", "double precision")
+
+SEXES = {"male": "males", "males": "males", "female": "females", "females": "females", "person": "persons", "persons": "persons"}
+
+
+def _label(value):
+    return " ".join(str(value or "").lower().split())
+
+
+def _sex(value):
+    return SEXES.get(_label(value))
+
+
+def find_identities(columns):
+    """
+    Find the additive identities between columns.
+
+    columns: [(series, type, kind)] labels of each column
+
+    Returns -
+    [(total column index, [component column indexes], description)]
+    """
+    labels = [(_label(series), _label(type_), _label(kind)) for series, type_, kind in columns]
+    index = {}
+    for i, key in enumerate(labels):
+        if not is_non_additive(*key):
+            index.setdefault(key, i)
+
+    identities = []
+
+    def sex_identities(position, name):
+        # Persons = Males + Females, varying the label at position
+        groups = OrderedDict()
+        for key, i in index.items():
+            sex = _sex(key[position])
+            if sex is not None:
+                groups.setdefault(key[:position] + key[position + 1:], {})[sex] = i
+        for rest, sexes in groups.items():
+            if len(sexes) == 3:
+                identities.append((sexes["persons"], [sexes["males"], sexes["females"]], "{}: persons = males + females ({})".format(name, ", ".join(filter(None, rest)))))
+
+    def total_identities(position, name):
+        # "Total" = the sum of the other labels at position
+        groups = OrderedDict()
+        for key, i in index.items():
+            groups.setdefault(key[:position] + key[position + 1:], []).append((key[position], i))
+        for rest, members in groups.items():
+            totals = [i for label, i in members if label == "total"]
+            components = [i for label, i in members if label != "total"]
+            subtotals = [label for label, _ in members if label.startswith("total") and label != "total"]
+            if len(totals) == 1 and len(components) >= 2 and not subtotals:
+                identities.append((totals[0], components, "{}: total = sum of {} ({})".format(name, len(components), ", ".join(filter(None, rest)))))
+
+    sex_identities(2, "kind")
+    sex_identities(0, "series")
+    total_identities(1, "type")
+    total_identities(2, "kind")
+    return identities
+
+
+def identity_matrix(identities, n_columns):
+    """ The (identities, columns) coefficient matrix: +1 per component, -1 for the total. """
+    coefficients = numpy.zeros((len(identities), n_columns))
+    for row, (total, components, _) in enumerate(identities):
+        coefficients[row, components] = 1.0
+        coefficients[row, total] = -1.0
+    return coefficients
+
+
+def check_identities(values, identities, absolute_tolerance=ABSOLUTE_TOLERANCE, relative_tolerance=RELATIVE_TOLERANCE):
+    """
+    Check identities against every region (row) of values, a float matrix
+    with NaN for not applicable cells. Not applicable components count as
+    zero; an identity isn't checked where its total is not applicable.
+
+    Returns the violation summary.
+    """
+    totals = [total for total, _, _ in identities]
+    residual = numpy.nan_to_num(values) @ identity_matrix(identities, values.shape[1]).T
+    total_values = values[:, totals]
+    with numpy.errstate(invalid="ignore"):
+        diff = numpy.abs(residual)
+        tolerance = numpy.maximum(absolute_tolerance, relative_tolerance * numpy.abs(total_values))
+        comparable = ~numpy.isnan(total_values)
+        violations = comparable & (diff > tolerance)
+
+    per_identity = violations.sum(axis=0)
+    worst = numpy.argsort(-per_identity)[:10]
+    return OrderedDict([
+        ("regions", int(values.shape[0])),
+        ("identities", len(identities)),
+        ("checks", int(comparable.sum())),
+        ("violations", int(violations.sum())),
+        ("max_abs_diff", float(diff[comparable].max()) if comparable.any() else 0.0),
+        ("worst_identities", [
+            OrderedDict([("identity", identities[i][2]), ("violating_regions", int(per_identity[i]))])
+            for i in worst if per_identity[i] > 0
+        ]),
+    ])
+
+
+def group_tables(data_tables):
+    """
+    Group the tables of each table number and division, e.g.
+    ("b04", "aust", "sa1") -> [b04s1_aust_sa1, b04s2_aust_sa1, b04s3_aust_sa1]
+    """
+    groups = OrderedDict()
+    for table_name in data_tables:
+        m = ROLLUP_TABLE_RE.match(table_name)
+        if m is None:
+            continue
+        table_number = re.match('^([a-z]+[0-9]+)', m.group("table")).group(1)
+        groups.setdefault((table_number, m.group("geo"), m.group("division")), []).append(table_name)
+    return groups
+
+
+def get_numeric_columns(conn, schema, table_name):
+    rows = conn.execute(sqlalchemy.text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :table AND data_type = ANY(:types)"""),
+        schema=schema, table=table_name, types=list(NUMERIC_TYPES))
+    return set(r[0] for r in rows if r[0] != "gid")
+
+
+def fetch_group(conn, schema, table_names, registered):
+    """
+    Fetch the registered numeric columns of a group of tables, joined on
+    gid (only regions present in every table).
+
+    Returns (values, [(series, type, kind)]) for the columns of values.
+    """
+    parts = []
+    for table_name in table_names:
+        meta, columns = registered[table_name]
+        numeric = get_numeric_columns(conn, schema, table_name)
+        columns = [(name, column_meta) for name, column_meta in columns if name in numeric]
+        if not columns:
+            continue
+        names = [name for name, _ in columns]
+        gids, values = fetch_matrix(conn, 'SELECT gid, {} FROM "{}"."{}" ORDER BY gid'.format(
+            ", ".join('"{}"'.format(name) for name in names), schema, table_name), names)
+        labels = [(meta.get("series"), column_meta.get("type"), column_meta.get("kind")) for _, column_meta in columns]
+        parts.append((gids, values, labels))
+    if not parts:
+        return numpy.zeros((0, 0)), []
+
+    common = reduce(numpy.intersect1d, [gids for gids, _, _ in parts])
+    values = numpy.hstack([values[numpy.searchsorted(gids, common)] for gids, values, _ in parts])
+    return values, [label for _, _, labels in parts for label in labels]
+
+
+def validate_tables(engine, schema, data_tables, registered, absolute_tolerance=ABSOLUTE_TOLERANCE, relative_tolerance=RELATIVE_TOLERANCE):
+    """
+    Check the additive identities of every table in data_tables (with the
+    metadata load_metadata registered for them).
+
+    Returns a violation summary per table number and division.
+    """
+    report = []
+    with engine.connect() as conn:
+        for (table_number, geo, division), table_names in group_tables([t for t in data_tables if t in registered]).items():
+            with stage("validate", table="{}_{}_{}".format(table_number, geo, division)) as timer:
+                values, labels = fetch_group(conn, schema, table_names, registered)
+                identities = find_identities(labels)
+                if not identities:
+                    continue
+                result = check_identities(values, identities, absolute_tolerance, relative_tolerance)
+                timer.add(rows=result["regions"])
+            result["table"] = table_number
+            result["division"] = division
+            result["tables"] = table_names
+            if result["violations"] > 0:
+                logger.warning("%s %s: %d of %d identity checks fail beyond tolerance (max %.0f), e.g. %s" % (
+                    table_number, division, result["violations"], result["checks"], result["max_abs_diff"],
+                    result["worst_identities"][0]["identity"]))
+            report.append(result)
+    return report
+
+
+def validate_schema(engine, schema, selection=ALL, absolute_tolerance=ABSOLUTE_TOLERANCE, relative_tolerance=RELATIVE_TOLERANCE):
+    """
+    Check the additive identities of the (selected) tables already loaded
+    into a package schema, with the metadata registered for them.
+
+    Returns a violation summary per table number and division.
+    """
+    registered = OrderedDict()
+    with engine.connect() as conn:
+        rows = conn.execute("""
+            SELECT t.name, t.metadata_json, c.name, c.metadata_json
+            FROM "{schema}".table_info t
+            JOIN "{schema}".column_info c ON c.tableinfo_id = t.id
+            ORDER BY t.name, c.id""".format(schema=schema))
+        for table_name, table_json, column_name, column_json in rows:
+            m = ROLLUP_TABLE_RE.match(table_name)
+            if m is None or not selection.table(re.match('^([a-z]+[0-9]+)', m.group("table")).group(1)) or not selection.division(m.group("division")):
+                continue
+            if table_name not in registered:
+                registered[table_name] = (json.loads(table_json) if table_json else {}, [])
+            registered[table_name][1].append((column_name, json.loads(column_json) if column_json else {}))
+    return validate_tables(engine, schema, list(registered), registered, absolute_tolerance, relative_tolerance)
@@ -0,0 +1,79 @@
+#
+# Offline point-in-polygon lookups against the census boundaries.
+#
+# Build the index from the digital boundary zips (no database needed):
+#   python geocode.py build /app/point_index/
+#
+# Then resolve a CSV of points to the region of every census division:
+#   python geocode.py lookup /app/point_index/ points.csv regions.csv --divisions sa1,sa2,lga,poa
+#
+
+import csv
+import argparse
+from census2011.pointindex import LOOKUP_WORKERS, build_point_index, lookup_points
+from census2011.selection import LoadSelection, parse_list
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Resolve longitude/latitude points to census regions without a database")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build = subparsers.add_parser("build", help="Build the point index from the digital boundary zips")
+    build.add_argument(
+        "index_dir",
+        help="Where to write the index")
+    build.add_argument(
+        "--census-dir", default='/data/2011 Datapacks BCP_IP_TSP_PEP_ECP_WPP_ERP_Release 3',
+        help="The extracted census")
+    build.add_argument(
+        "--divisions", type=parse_list, metavar="DIVISION,...",
+        help="Index only these census divisions (e.g. sa1,sa2,lga,poa)")
+
+    lookup = subparsers.add_parser("lookup", help="Add the region codes of each point of a CSV")
+    lookup.add_argument(
+        "index_dir",
+        help="The index built by build")
+    lookup.add_argument(
+        "points",
+        help="CSV of points")
+    lookup.add_argument(
+        "output",
+        help="Where to write the CSV of points and their region codes (one column per division)")
+    lookup.add_argument(
+        "--lon-column", default="longitude",
+        help="The longitude column of the points CSV")
+    lookup.add_argument(
+        "--lat-column", default="latitude",
+        help="The latitude column of the points CSV")
+    lookup.add_argument(
+        "--divisions", type=parse_list, metavar="DIVISION,...",
+        help="Resolve only these census divisions (default: every division indexed)")
+    lookup.add_argument(
+        "--workers", type=int, default=LOOKUP_WORKERS,
+        help="Worker processes")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "build":
+        build_point_index(args.census_dir, args.index_dir, selection=LoadSelection(divisions=args.divisions))
+        return
+
+    with open(args.points, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    longitudes = [float(row[args.lon_column] or "nan") for row in rows]
+    latitudes = [float(row[args.lat_column] or "nan") for row in rows]
+    regions = lookup_points(args.index_dir, longitudes, latitudes, divisions=args.divisions, workers=args.workers)
+    with open(args.output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(fieldnames + ["{}_code".format(division) for division in regions])
+        for i, row in enumerate(rows):
+            writer.writerow([row[name] for name in fieldnames] + [codes[i] for codes in regions.values()])
+
+
+if __name__ == '__main__':
+    main()
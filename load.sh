@@ -32,17 +32,13 @@ mkdir -p "/app/archive/" "/app/dump/"
 
 echo "$CENSUSDIR"
 
-if [ ! -d "$CENSUSDIR" ]; then
-
-    if [ ! -f "$CENSUS7Z" ]; then
-        echo "Downloading the Australian Census 2011..."
-        wget -c -t 1 -O "$CENSUS7Z" 'https://www.dropbox.com/s/yo6rnms4lwgc8zj/2011%20Datapacks%20BCP_IP_TSP_PEP_ECP_WPP_ERP_Release%203.7z?dl=1'
-    fi
-
-    echo "Extracting the Australian Census 2011..."
-    cd /data && 7zr x "$CENSUS7Z"
+if [ ! -d "$CENSUSDIR" ] && [ ! -f "$CENSUS7Z" ]; then
+    echo "Downloading the Australian Census 2011..."
+    wget -c -t 1 -O "$CENSUS7Z" 'https://www.dropbox.com/s/yo6rnms4lwgc8zj/2011%20Datapacks%20BCP_IP_TSP_PEP_ECP_WPP_ERP_Release%203.7z?dl=1'
 fi
 
 echo "loading the 2011 Australian Census"
 
-python /app/recipe.py
+# If the census hasn't been extracted, the members the load needs are
+# extracted from the archive as the load runs (and removed once loaded)
+python /app/recipe.py --archive "$CENSUS7Z" "$@"
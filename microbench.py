@@ -0,0 +1,355 @@
+#
+# Micro-benchmarks of the loader's hot functions.
+#
+# Each benchmark times one of the functions a load spends its CPU time in,
+# on realistic fixtures: column metadata built from the row labels of the
+# shipped *_metadata_mapping.json files, and synthetic DataPack CSV files
+# with as many rows as there are SA1s. Like pytest-benchmark, each is run
+# for at least MIN_ROUNDS rounds (and MAX_TIME seconds) after a warmup
+# round, and summarised by its min, max, mean, stddev, median and IQR.
+#
+# Save a baseline, then compare a later run against it:
+#   python microbench.py run --save baseline.json
+#   python microbench.py run --save current.json --filter split,merge
+#   python microbench.py compare baseline.json current.json --threshold 0.1
+#
+# compare exits with status 1 if any benchmark's median regressed by more
+# than the threshold.
+#
+
+import os
+import re
+import csv
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+from collections import OrderedDict
+
+import numpy
+from census2011.attrs import parseColumnMetadata, handleNotApplicableCells, make_gid_matcher, split_datapack_csv_by_series
+from census2011.attrs_repair import repair_census_metadata
+from census2011.csvscan import scan_csv, write_merged_csv
+from census2011.mappings import get_metadata_mapping
+from census2011.synthetic import KINDS, SERIES, SERIES_KINDS
+from ealgis_common.loaders import RewrittenCSV
+from ealgis_common.util import make_logger
+
+logger = make_logger(__name__)
+
+# Statistical Area Level 1 regions in the 2011 ASGS
+SA1_ROWS = 54805
+# The columns of each synthetic DataPack CSV file, and the files a table is
+# split over (like X01, in three datapacks with a series each)
+CSV_COLUMNS = 200
+CSV_PARTS = 3
+# The share of synthetic cells that are 0 and ".."
+ZERO_SHARE = 0.6
+NOT_APPLICABLE_SHARE = 0.05
+
+MIN_ROUNDS = 5
+MAX_TIME = 2.0
+# Default regression threshold of compare, as a fraction of the baseline
+THRESHOLD = 0.1
+STATS = ("min", "max", "mean", "stddev", "median", "iqr")
+
+ROW_LABEL_RE = re.compile(r'<span class="rowLabel">(.*?)</span>')
+
+
+def metadata_fixtures():
+    """
+    Column metadata as it's read from the DataPack metadata workbooks, for
+    every table in the shipped metadata mappings: a column per row label
+    (from the table's notes) and kind, the rows of every third table in a
+    series each (with the synthetic census' kinds, see synthetic.py).
+
+    Returns [(table_number, column_name, {"type": long name, "kind": column heading})]
+    """
+    fixtures = []
+    for i, (table_number, table) in enumerate(sorted(get_metadata_mapping().items())):
+        labels = [" ".join(re.sub(r"[^A-Za-z0-9 ]", " ", label).split()) for label in ROW_LABEL_RE.findall(table.get("notes") or "")]
+        labels = list(OrderedDict.fromkeys(label for label in labels + ["Total"] if label))
+        series = SERIES if i % 3 == 0 else [None]
+        for series_name in series:
+            for label in labels:
+                for kind in (SERIES_KINDS if series_name else KINDS):
+                    long_name = "_".join(([series_name] if series_name else []) + label.split() + [kind])
+                    heading = kind if series_name is None else "{}|{}".format(kind, series_name)
+                    column_name = "{}{}".format(table_number[0].lower(), len(fixtures) + 1)
+                    fixtures.append((table_number.lower(), column_name, {"type": long_name, "kind": heading}))
+    return fixtures
+
+
+def parseable(fixtures):
+    """ The fixtures that parseColumnMetadata parses without an error. """
+    ok = []
+    for table_number, column_name, metadata in fixtures:
+        try:
+            parseColumnMetadata(table_number, column_name, dict(metadata))
+        except Exception:
+            continue
+        ok.append((table_number, column_name, metadata))
+    return ok
+
+
+def write_datapack_csvs(tmpdir, rows, columns=CSV_COLUMNS, parts=CSV_PARTS, seed=2011):
+    """
+    Write a synthetic SA1 DataPack table split over parts CSV files (e.g.
+    2011Census_X01A_AUST_SA1_sequential.csv), mostly small counts with
+    ZERO_SHARE zeros and NOT_APPLICABLE_SHARE "..".
+
+    Returns (csv paths, region ids, column names).
+    """
+    rng = numpy.random.RandomState(seed)
+    region_ids = [str(1000000 + i * 7) for i in range(rows)]
+    column_names = ["X{}".format(i + 1) for i in range(columns)]
+    values = rng.geometric(0.05, size=(rows, columns)).astype(str).astype(object)
+    draw = rng.random_sample((rows, columns))
+    values[draw < ZERO_SHARE] = "0"
+    values[draw > 1 - NOT_APPLICABLE_SHARE] = ".."
+
+    per_part = -(-columns // parts)
+    paths = []
+    for part in range(parts):
+        lo, hi = part * per_part, min(columns, (part + 1) * per_part)
+        path = os.path.join(tmpdir, "2011Census_X01{}_AUST_SA1_sequential.csv".format(chr(ord("A") + part)))
+        with open(path, "w") as f:
+            f.write(",".join(["region_id"] + column_names[lo:hi]) + "\n")
+            for region_id, row in zip(region_ids, values[:, lo:hi]):
+                f.write(region_id + "," + ",".join(row) + "\n")
+        paths.append(path)
+    return paths, region_ids, column_names
+
+
+def build_fixtures(tmpdir, rows=SA1_ROWS):
+    metadata = metadata_fixtures()
+    paths, region_ids, column_names = write_datapack_csvs(tmpdir, rows)
+    merged_path = os.path.join(tmpdir, "2011Census_X01_AUST_SA1_sequential.tmp.csv")
+    scans = [scan_csv(path) for path in paths]
+    write_merged_csv(scans, merged_path)
+    for scan in scans:
+        scan.close()
+    with open(merged_path, "r") as f:
+        lines = list(csv.reader(f))
+    per_series = -(-len(column_names) // len(SERIES))
+    return {
+        "tmpdir": tmpdir,
+        "metadata": metadata,
+        "parseable": parseable(metadata),
+        "paths": paths,
+        "merged_path": merged_path,
+        "lines": lines,
+        "cells": [cell for line in lines[1:] for cell in line[1:]],
+        "col_mapping": {("x01", name.lower()): name for name in column_names},
+        "lookup": {region_id: gid for gid, region_id in enumerate(region_ids, 1)},
+        "columns_by_series": {"x01": OrderedDict(
+            (series_name, {"columns": column_names[i * per_series:(i + 1) * per_series]}) for i, series_name in enumerate(SERIES))},
+    }
+
+
+def bench_parse_column_metadata(fixtures):
+    for table_number, column_name, metadata in fixtures["parseable"]:
+        parseColumnMetadata(table_number, column_name, dict(metadata))
+
+
+def bench_repair_census_metadata(fixtures):
+    for table_number, column_name, metadata in fixtures["metadata"]:
+        repair_census_metadata(table_number, column_name, dict(metadata))
+
+
+def bench_handle_not_applicable_cells(fixtures):
+    for value in fixtures["cells"]:
+        handleNotApplicableCells(value)
+
+
+def bench_gid_matcher(fixtures):
+    matcher = make_gid_matcher(fixtures["col_mapping"], "x01", "sa1", fixtures["lookup"])
+    for line, row in enumerate(fixtures["lines"]):
+        matcher(line, row)
+
+
+def bench_rewrite(fixtures):
+    matcher = make_gid_matcher(fixtures["col_mapping"], "x01", "sa1", fixtures["lookup"])
+    with RewrittenCSV(fixtures["tmpdir"], fixtures["merged_path"], matcher) as norm:
+        norm.get()
+
+
+def bench_merge(fixtures):
+    scans = [scan_csv(path) for path in fixtures["paths"]]
+    try:
+        write_merged_csv(scans, os.path.join(fixtures["tmpdir"], "merged.tmp.csv"))
+    finally:
+        for scan in scans:
+            scan.close()
+
+
+def bench_split(fixtures):
+    for path in split_datapack_csv_by_series(fixtures["columns_by_series"], "x01", fixtures["merged_path"], "XCP"):
+        os.remove(path)
+
+
+# (name, group, benchmark, the number of items it processes per round)
+BENCHMARKS = [
+    ("parse_column_metadata", "metadata", bench_parse_column_metadata, lambda f: len(f["parseable"])),
+    ("repair_census_metadata", "metadata", bench_repair_census_metadata, lambda f: len(f["metadata"])),
+    ("handle_not_applicable_cells", "rewrite", bench_handle_not_applicable_cells, lambda f: len(f["cells"])),
+    ("gid_matcher", "rewrite", bench_gid_matcher, lambda f: len(f["lines"])),
+    ("rewrite", "rewrite", bench_rewrite, lambda f: len(f["lines"])),
+    ("merge", "csv", bench_merge, lambda f: len(f["lines"])),
+    ("split", "csv", bench_split, lambda f: len(f["lines"])),
+]
+
+
+def summarise(timings):
+    timings = sorted(timings)
+    quartiles = statistics.quantiles(timings, n=4) if len(timings) > 1 else [timings[0]] * 3
+    return OrderedDict([
+        ("min", timings[0]),
+        ("max", timings[-1]),
+        ("mean", statistics.mean(timings)),
+        ("stddev", statistics.stdev(timings) if len(timings) > 1 else 0.0),
+        ("median", statistics.median(timings)),
+        ("iqr", quartiles[2] - quartiles[0]),
+        ("rounds", len(timings)),
+        ("ops", 1 / statistics.mean(timings)),
+    ])
+
+
+def run_benchmark(fn, fixtures, min_rounds=MIN_ROUNDS, max_time=MAX_TIME):
+    """ Time fn(fixtures) after a warmup round, for min_rounds rounds or max_time seconds, whichever is longer. """
+    fn(fixtures)
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_rounds or time.perf_counter() - started < max_time:
+        start = time.perf_counter()
+        fn(fixtures)
+        timings.append(time.perf_counter() - start)
+    return summarise(timings)
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return OrderedDict([
+        ("node", platform.node()),
+        ("machine", platform.machine()),
+        ("python_version", platform.python_version()),
+        ("numpy_version", numpy.__version__),
+        ("cpu_count", os.cpu_count()),
+        ("commit", commit or None),
+    ])
+
+
+def run(args):
+    selected = [b for b in BENCHMARKS if not args.filter or any(name in b[0] for name in args.filter)]
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        logger.info("building fixtures (%d rows)" % (args.rows))
+        fixtures = build_fixtures(tmpdir, args.rows)
+        for name, group, fn, items in selected:
+            stats = run_benchmark(fn, fixtures, args.min_rounds, args.max_time)
+            stats["items_per_sec"] = items(fixtures) / stats["mean"]
+            logger.info("%s: median %.4fs over %d rounds (%.0f items/sec)" % (name, stats["median"], stats["rounds"], stats["items_per_sec"]))
+            results.append(OrderedDict([("name", name), ("group", group), ("params", {"rows": args.rows}), ("stats", stats)]))
+
+    output = OrderedDict([
+        ("machine_info", machine_info()),
+        ("datetime", datetime.utcnow().isoformat()),
+        ("benchmarks", results),
+    ])
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+def compare_results(baseline, current, threshold=THRESHOLD, stat="median"):
+    """
+    Compare the benchmarks of two saved runs.
+
+    Returns [(name, baseline value, current value, change, regressed)],
+    change being the fraction by which stat grew (negative if faster).
+    """
+    baseline_stats = {b["name"]: b["stats"] for b in baseline["benchmarks"]}
+    rows = []
+    for benchmark in current["benchmarks"]:
+        name = benchmark["name"]
+        if name not in baseline_stats:
+            continue
+        before, after = baseline_stats[name][stat], benchmark["stats"][stat]
+        change = after / before - 1 if before > 0 else 0.0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def compare(args):
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    with open(args.current, "r") as f:
+        current = json.load(f)
+    rows = compare_results(baseline, current, args.threshold, args.stat)
+    print("{:<30} {:>12} {:>12} {:>9}".format("benchmark", "baseline", "current", "change"))
+    for name, before, after, change, regressed in rows:
+        print("{:<30} {:>11.4f}s {:>11.4f}s {:>+8.1%}{}".format(name, before, after, change, "  REGRESSED" if regressed else ""))
+    if any(regressed for _, _, _, _, regressed in rows):
+        sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Micro-benchmark the loader's hot functions")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "--save", metavar="JSON",
+        help="Write the results to this file (default: stdout)")
+    run_parser.add_argument(
+        "--filter", type=lambda s: [name.strip() for name in s.split(",") if name.strip()], metavar="NAME,...",
+        help="Only the benchmarks whose names contain one of these")
+    run_parser.add_argument(
+        "--rows", type=int, default=SA1_ROWS,
+        help="Rows of the synthetic DataPack CSV files")
+    run_parser.add_argument(
+        "--min-rounds", type=int, default=MIN_ROUNDS,
+        help="Rounds of each benchmark, at least")
+    run_parser.add_argument(
+        "--max-time", type=float, default=MAX_TIME,
+        help="Seconds to run each benchmark for, at least")
+    run_parser.add_argument(
+        "--tmpdir", default="/tmp",
+        help="Where to write the fixtures")
+    run_parser.set_defaults(run=run)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare a run against a baseline")
+    compare_parser.add_argument(
+        "baseline",
+        help="The baseline results")
+    compare_parser.add_argument(
+        "current",
+        help="The results to check")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=THRESHOLD,
+        help="Flag benchmarks slower than the baseline by more than this fraction")
+    compare_parser.add_argument(
+        "--stat", choices=STATS, default="median",
+        help="The statistic compared")
+    compare_parser.set_defaults(run=compare)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
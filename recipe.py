@@ -1,5 +1,19 @@
+import os
+import re
+import argparse
 from census2011 import load_shapes
 from census2011 import load_attrs
+from census2011.analysis_views import ANALYSIS_VIEWS, parse_analysis_view
+from census2011.archive import open_census
+from census2011.attrs import PACKAGES, package_dirname, package_schema_name
+from census2011.concordance import CENSUS2016_SCHEMA
+from census2011.correspondence import CORRESPONDENCES, build_correspondences, parse_correspondence
+from census2011.dump import DUMP_JOBS, dump_schemas
+from census2011.export import export_parquet
+from census2011.instrument import report, stage, dir_size
+from census2011.selection import LoadSelection, parse_list
+from census2011.shapes import SHAPE_SCHEMA, SHAPE_ZIPS
+from census2011.sparse import DENSITY_THRESHOLD
 from ealgis_common.db import DataLoaderFactory
 from ealgis_common.util import make_logger
 
@@ -7,14 +21,133 @@ from ealgis_common.util import make_logger
 logger = make_logger(__name__)
 
 
+def census_members(census_dir, selection):
+    """ The members of the census release the (selected) load needs. """
+    packages = [p for p in PACKAGES if selection.package(p[1])]
+    files = set(
+        [os.path.join(census_dir, "Digital Boundaries", fname) for division, fname in SHAPE_ZIPS if selection.division(division)] +
+        [os.path.join(census_dir, "Metadata", metadata_filename) for _, _, metadata_filename, _ in packages])
+    csv_dirs = tuple(
+        os.path.join(census_dir, package_dirname(package_name), "Sequential Number Descriptor") + "/" for package_name, _, _, _ in packages)
+
+    def wanted(path):
+        if path in files:
+            return True
+        if not path.startswith(csv_dirs):
+            return False
+        # e.g. 2011Census_B04A_AUST_SA2_sequential.csv
+        m = re.match(r'^2011Census_([A-Za-z]+[0-9]+)[A-Za-z]*_[A-Za-z]+_([A-Za-z0-9]+)_sequential\.csv$', os.path.basename(path))
+        return m is not None and selection.table(m.group(1)) and selection.division(m.group(2))
+    return wanted
+
+
+def census_members_first(census_dir):
+    """ The members every load needs before it starts: the metadata workbooks and boundary zips. """
+    dirs = tuple(os.path.join(census_dir, dirname) + "/" for dirname in ("Metadata", "Digital Boundaries"))
+
+    def first(path):
+        return path.startswith(dirs)
+    return first
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load the 2011 Australian Census into EAlGIS")
+    parser.add_argument(
+        "--analysis-views", action="store_true",
+        help="Build materialised analysis views for the most commonly queried tables")
+    parser.add_argument(
+        "--analysis-view", action="append", type=parse_analysis_view, metavar="TABLE:DIVISION",
+        help="Build a materialised analysis view for this table and division (e.g. b01:sa2), may be repeated")
+    parser.add_argument(
+        "--rollup", action="store_true",
+        help="Roll count tables up the ASGS main structure, check them against the published tables and fill in unpublished divisions")
+    parser.add_argument(
+        "--validate", action="store_true",
+        help="Check every table's additive identities (e.g. Males + Females = Persons) and add the violations to the run report")
+    parser.add_argument(
+        "--correspondences", action="store_true",
+        help="Precompute the weights for re-aggregating between the most commonly asked for divisions (e.g. sa1 to poa)")
+    parser.add_argument(
+        "--correspondence", action="append", type=parse_correspondence, metavar="SOURCE:TARGET",
+        help="Precompute the weights for re-aggregating from this division to that (e.g. ssc:lga), may be repeated")
+    parser.add_argument(
+        "--concordance", nargs="?", const=CENSUS2016_SCHEMA, metavar="SCHEMA",
+        help="Match every column with the 2016 census loaded in this schema (default %s) and store the concordance" % CENSUS2016_SCHEMA)
+    parser.add_argument(
+        "--partition-by-state", action="store_true",
+        help="Store the sa1, sa2 and ssc attribute tables as partitions by state")
+    parser.add_argument(
+        "--sparse", nargs="?", type=float, const=DENSITY_THRESHOLD, metavar="DENSITY",
+        help="Pack the tables with a smaller share of non-zero cells than this (default %s) and drop the columns without any values, behind views" % DENSITY_THRESHOLD)
+    parser.add_argument(
+        "--packages", type=parse_list, metavar="ABBREV,...",
+        help="Load only these packages (e.g. BCP,XCP)")
+    parser.add_argument(
+        "--tables", type=parse_list, metavar="TABLE,...",
+        help="Load only these table numbers (e.g. b01,b04)")
+    parser.add_argument(
+        "--divisions", type=parse_list, metavar="DIVISION,...",
+        help="Load only these census divisions, shapes included (e.g. sa2,lga)")
+    parser.add_argument(
+        "--archive", metavar="7Z",
+        help="If the census hasn't been extracted, extract the members the load needs from this release archive as the load runs")
+    parser.add_argument(
+        "--ingest-backend", choices=["sync", "async"], default="sync",
+        help="sync: load one DataPack CSV at a time; async: overlap CSV parsing with COPYs over a connection pool (requires asyncpg)")
+    parser.add_argument(
+        "--dump-format", choices=["directory", "archive"], default="directory",
+        help="directory: one parallel directory-format dump per schema (see restore.py); archive: a single archive per schema")
+    parser.add_argument(
+        "--dump-jobs", type=int, default=DUMP_JOBS,
+        help="Parallel pg_dump jobs per schema (directory format only)")
+    parser.add_argument(
+        "--parquet", metavar="DIR",
+        help="Also export every shape and attribute table as Parquet to this directory (requires pyarrow)")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     tmpdir = "/tmp"
     census_dir = '/data/2011 Datapacks BCP_IP_TSP_PEP_ECP_WPP_ERP_Release 3'
-    factory = DataLoaderFactory(db_name="scratch_census_2011", clean=False)
-    shape_result = load_shapes(factory, census_dir, tmpdir)
-    attrs_results = load_attrs(factory, census_dir, tmpdir)
-    for result in [shape_result] + attrs_results:
-        result.dump("/app/dump/")
+    dump_dir = "/app/dump/"
+    analysis_views = args.analysis_view or (ANALYSIS_VIEWS if args.analysis_views else None)
+    correspondences = args.correspondence or (CORRESPONDENCES if args.correspondences else None)
+    selection = LoadSelection(packages=args.packages, tables=args.tables, divisions=args.divisions)
+    db_name = "scratch_census_2011"
+    factory = DataLoaderFactory(db_name=db_name, clean=False)
+    report.info["census_dir"] = census_dir
+    report.info["selection"] = repr(selection)
+    if os.environ.get("PROFILE_MEMORY"):
+        report.profile_memory()
+    source = open_census(census_dir, args.archive, census_members(census_dir, selection), tmpdir=tmpdir, first=census_members_first(census_dir))
+    try:
+        with stage("shapes"):
+            shape_result = load_shapes(factory, census_dir, tmpdir, source=source, selection=selection)
+        with stage("attrs"):
+            attrs_results = load_attrs(factory, census_dir, tmpdir, analysis_views=analysis_views, rollup=args.rollup, validate=args.validate, backend=args.ingest_backend, source=source, selection=selection, partition_by_state=args.partition_by_state, concordance=args.concordance, sparse_threshold=args.sparse)
+    finally:
+        source.close()
+    if correspondences:
+        correspondences = [(s, t) for s, t in correspondences if selection.division(s) and selection.division(t)]
+        with stage("correspondences"), factory.make_schema_access(SHAPE_SCHEMA) as shape_access:
+            build_correspondences(shape_access.session.get_bind(), correspondences)
+    if args.dump_format == "directory":
+        schemas = [SHAPE_SCHEMA] + [package_schema_name(abbrev) for _, abbrev, _, _ in PACKAGES if selection.package(abbrev)]
+        dump_schemas(db_name, dump_dir, schemas, jobs=args.dump_jobs)
+    else:
+        for result in [shape_result] + attrs_results:
+            before = dir_size(dump_dir)
+            with stage("dump") as timer:
+                result.dump(dump_dir)
+                timer.add(bytes=dir_size(dump_dir) - before)
+    if args.parquet:
+        with stage("parquet"), factory.make_schema_access(SHAPE_SCHEMA) as shape_access:
+            export_parquet(shape_access.session.get_bind(), args.parquet, selection=selection)
+    logger.info("wrote run report: %s" % (report.write(dump_dir + "run_report.json")))
+    if report.memory_profiler is not None:
+        for entry in report.memory_ranking():
+            logger.info("memory: %(peak_traced_kb)10d KB traced, %(peak_rss_kb)10d KB RSS  %(stage)s [%(table)s]" % entry)
 
 
 if __name__ == '__main__':
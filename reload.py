@@ -0,0 +1,80 @@
+import os
+import json
+import argparse
+from census2011.attrs import find_package, package_schema_name
+from census2011.dump import make_engine
+from census2011.instrument import report
+from census2011.reload import reload_table, rollback_reload, drop_old_tables, get_reload_history
+from census2011.selection import parse_list
+from ealgis_common.db import DataLoaderFactory
+from ealgis_common.util import make_logger
+
+
+logger = make_logger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reload a census table into a live EAlGIS database without taking it offline")
+    parser.add_argument(
+        "package",
+        help="The package abbreviation (e.g. BCP)")
+    parser.add_argument(
+        "table", nargs="?",
+        help="The table number to reload (e.g. b04)")
+    parser.add_argument(
+        "--divisions", type=parse_list, metavar="DIVISION,...",
+        help="Reload only these census divisions (e.g. sa2,lga)")
+    parser.add_argument(
+        "--census-dir", default='/data/2011 Datapacks BCP_IP_TSP_PEP_ECP_WPP_ERP_Release 3',
+        help="The extracted census")
+    parser.add_argument(
+        "--db-name", default=os.environ.get("DB_NAME", "postgres"),
+        help="The database to reload into")
+    parser.add_argument(
+        "--ingest-backend", choices=["sync", "async"], default="sync",
+        help="How DataPack CSV files are loaded (see recipe.py)")
+    parser.add_argument(
+        "--partition-by-state", action="store_true",
+        help="The table was loaded with recipe.py --partition-by-state")
+    parser.add_argument(
+        "--rollback", metavar="STAMP",
+        help="Instead of reloading, roll back the reload with this stamp")
+    parser.add_argument(
+        "--history", action="store_true",
+        help="Instead of reloading, list the package's reloads that can be rolled back")
+    parser.add_argument(
+        "--drop-old", type=int, metavar="KEEP",
+        help="Instead of reloading, drop the old tables of all but the KEEP most recent reloads of each table")
+    parser.add_argument(
+        "--report",
+        help="Write the run report (JSON) here")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    schema = package_schema_name(find_package(args.package)[1])
+    engine = make_engine(args.db_name)
+    if args.history:
+        for stamp, table_name, old_name, reloaded_at in get_reload_history(engine, schema):
+            print("{}  {}  {} -> {}".format(stamp, reloaded_at, table_name, old_name))
+        return
+    if args.rollback:
+        result = {"rolled_back": rollback_reload(engine, schema, args.rollback), "stamp": args.rollback}
+    elif args.drop_old is not None:
+        result = {"dropped": drop_old_tables(engine, schema, keep=args.drop_old)}
+    else:
+        if args.table is None:
+            raise SystemExit("a table number is required to reload")
+        factory = DataLoaderFactory(db_name=args.db_name, clean=False)
+        report.info["census_dir"] = args.census_dir
+        report.info["db_name"] = args.db_name
+        stamp, tables = reload_table(factory, args.census_dir, "/tmp", args.package, args.table, divisions=args.divisions, backend=args.ingest_backend, partition_by_state=args.partition_by_state)
+        result = {"reloaded": tables, "stamp": stamp}
+    if args.report:
+        report.write(args.report)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import os
+import json
+import argparse
+from census2011.attrs import PACKAGES, package_schema_name
+from census2011.dump import DUMP_JOBS, ANALYZE_WORKERS, restore_schemas
+from census2011.instrument import report
+from census2011.shapes import SHAPE_SCHEMA
+from ealgis_common.util import make_logger
+
+
+logger = make_logger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Restore the directory-format dumps written by recipe.py into an EAlGIS database")
+    parser.add_argument(
+        "dump_dir", nargs="?", default="/app/dump/",
+        help="The directory holding one directory-format dump per schema")
+    parser.add_argument(
+        "--db-name", default=os.environ.get("DB_NAME", "postgres"),
+        help="The database to restore into")
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=DUMP_JOBS,
+        help="Parallel pg_restore jobs for the data and index sections")
+    parser.add_argument(
+        "--analyze-workers", type=int, default=ANALYZE_WORKERS,
+        help="Tables analyzed at a time after the restore")
+    parser.add_argument(
+        "--schema", action="append",
+        help="Restore only this schema, may be repeated (default: the shapes and every package)")
+    parser.add_argument(
+        "--clean", action="store_true",
+        help="Drop existing objects before restoring them")
+    parser.add_argument(
+        "--report",
+        help="Write the run report (JSON) here")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    schemas = args.schema or [SHAPE_SCHEMA] + [package_schema_name(abbrev) for _, abbrev, _, _ in PACKAGES]
+    report.info["dump_dir"] = args.dump_dir
+    report.info["db_name"] = args.db_name
+    seconds = restore_schemas(args.db_name, args.dump_dir, schemas, jobs=args.jobs, analyze_workers=args.analyze_workers, clean=args.clean)
+    if args.report:
+        report.write(args.report)
+    print(json.dumps({"schemas": schemas, "jobs": args.jobs, "seconds": round(seconds, 1)}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#
+# The CSV scanner (census2011/csvscan.py) checked against the csv module
+# and float(), on the edge cases of the DataPack CSV files.
+#
+
+import csv
+import io
+import math
+
+import numpy
+import pytest
+
+from census2011.csvscan import MAX_FIELD_WIDTH, parse_fields, scan_csv, write_merged_csv
+
+
+def reference_value(field):
+    """ What the scanner should parse a field as: float(), NaN if it isn't a number. """
+    try:
+        value = float(field)
+    except ValueError:
+        return math.nan
+    return value if math.isfinite(value) and field.strip() == field else math.nan
+
+
+def reference_rows(text):
+    return [row for row in csv.reader(io.StringIO(text, newline="")) if row]
+
+
+def write(tmp_path, text, name="table.csv"):
+    path = tmp_path / name
+    path.write_bytes(text.encode("utf-8"))
+    return str(path)
+
+
+def assert_matches_reference(path, text):
+    rows = reference_rows(text)
+    with scan_csv(path) as scan:
+        assert scan.header == rows[0]
+        assert scan.rows == len(rows) - 1
+        assert scan.columns == len(rows[0])
+        assert scan.region_ids == [row[0] for row in rows[1:]]
+        for line, row in enumerate(rows):
+            assert [scan.field(line, column) for column in range(scan.columns)] == row
+
+        expected = numpy.array([[reference_value(v) for v in row[1:]] for row in rows[1:]], dtype=numpy.float64).reshape(scan.rows, scan.columns - 1)
+        numpy.testing.assert_array_equal(scan.values, expected)
+        numpy.testing.assert_array_equal(scan.na, numpy.array([[v == ".." for v in row[1:]] for row in rows[1:]], dtype=bool).reshape(expected.shape))
+
+
+FIELDS = [
+    "0", "7", "-7", "-0", "1234", "0012", "1.5", "-1.5", "0.25", ".5", "-.5", "5.", "1.05",
+    "..", "", "-", ".", "1.2.3", "1-2", "12a", "abc", " 1",
+    # As wide as the vectorised parse goes, and wider
+    "9" * MAX_FIELD_WIDTH, "-" + "9" * (MAX_FIELD_WIDTH - 1), "1" * MAX_FIELD_WIDTH + "2",
+    "123456789.123456789", "0." + "1" * MAX_FIELD_WIDTH, "x" * (MAX_FIELD_WIDTH + 5),
+    "9007199254740993", "12345678901234567", "1234567890.1234567", "0.1000000000000001",
+]
+
+
+def test_parse_fields_matches_float():
+    data = numpy.frombuffer(",".join(FIELDS).encode("ascii"), dtype=numpy.uint8)
+    lengths = numpy.array([len(field) for field in FIELDS], dtype=numpy.int64)
+    starts = numpy.cumsum(lengths + 1) - (lengths + 1)
+    values, na, fractional, invalid = parse_fields(data, starts, starts + lengths)
+    for i, field in enumerate(FIELDS):
+        expected = reference_value(field)
+        if math.isnan(expected):
+            assert math.isnan(values[i]), field
+        else:
+            assert values[i] == expected, field
+        assert na[i] == (field == ".."), field
+        assert fractional[i] == (not math.isnan(expected) and "." in field), field
+        assert invalid[i] == (math.isnan(expected) and field not in ("", "..")), field
+
+
+def test_parse_fields_matches_float_random():
+    # Up to 17 digits with the point anywhere, including the decimals too
+    # precise to be scaled exactly
+    rng = numpy.random.default_rng(2011)
+    fields = []
+    for _ in range(20000):
+        digits = "".join(map(str, rng.integers(0, 10, rng.integers(1, 18))))
+        point = int(rng.integers(0, len(digits) + 1))
+        field = digits[:point] + "." + digits[point:] if point < len(digits) else digits
+        fields.append("-" + field if rng.random() < 0.3 and len(field) < MAX_FIELD_WIDTH else field)
+    data = numpy.frombuffer(",".join(fields).encode("ascii"), dtype=numpy.uint8)
+    lengths = numpy.array([len(field) for field in fields], dtype=numpy.int64)
+    starts = numpy.cumsum(lengths + 1) - (lengths + 1)
+    values, _, fractional, invalid = parse_fields(data, starts, starts + lengths)
+    numpy.testing.assert_array_equal(values, [float(field) for field in fields])
+    assert list(fractional) == ["." in field for field in fields]
+    assert not invalid.any()
+
+
+def test_parse_fields_across_chunks(monkeypatch):
+    monkeypatch.setattr("census2011.csvscan.CHUNK_FIELDS", 3)
+    fields = ["1", "-2.5", "..", "", "33", "4.25", "x", "6"]
+    data = numpy.frombuffer(",".join(fields).encode("ascii"), dtype=numpy.uint8)
+    lengths = numpy.array([len(field) for field in fields], dtype=numpy.int64)
+    starts = numpy.cumsum(lengths + 1) - (lengths + 1)
+    values, na, _, invalid = parse_fields(data, starts, starts + lengths)
+    numpy.testing.assert_array_equal(values, [reference_value(field) for field in fields])
+    assert list(na) == [field == ".." for field in fields]
+    assert list(invalid) == [field == "x" for field in fields]
+
+
+@pytest.mark.parametrize("text", [
+    "region_id,A,B\n1,2,3\n4,5,6\n",
+    # CRLF line endings, with and without a final newline
+    "region_id,A,B\r\n1,2,3\r\n4,5,6\r\n",
+    "region_id,A,B\r\n1,2,3\r\n4,5,6",
+    # No trailing newline
+    "region_id,A,B\n1,2,3\n4,5,6",
+    # Negatives, decimals, not applicable and empty cells
+    "region_id,A,B,C\n101,-1,2.5,..\n102,,-0.75,\n103,..,..,..\n",
+    # A wide region id and wide fields
+    "region_id,A,B\n1234567890123456789012,12345678901234567890,-0.0000000000000000001\n",
+    # Blank lines are skipped
+    "region_id,A\n\n1,2\r\n\r\n3,4\n\n",
+])
+def test_scan_matches_csv_module(tmp_path, text):
+    assert_matches_reference(write(tmp_path, text), text)
+
+
+def test_single_column(tmp_path):
+    text = "region_id\n101\n102\n"
+    path = write(tmp_path, text)
+    assert_matches_reference(path, text)
+    with scan_csv(path) as scan:
+        assert scan.values.shape == (2, 0)
+        assert scan.not_applicable_columns() == []
+        assert scan.column_types() == []
+        out = io.BytesIO()
+        scan.write_columns(out, [0])
+        assert out.getvalue() == b"region_id\n101\n102\n"
+
+
+def test_header_only(tmp_path):
+    with scan_csv(write(tmp_path, "region_id,A,B\n")) as scan:
+        assert scan.rows == 0
+        assert scan.values.shape == (0, 2)
+        assert scan.not_applicable_columns() == []
+
+
+def test_rejects_ragged_and_quoted(tmp_path):
+    with pytest.raises(ValueError):
+        scan_csv(write(tmp_path, "region_id,A\n1,2,3\n", "ragged.csv"))
+    with pytest.raises(ValueError):
+        scan_csv(write(tmp_path, 'region_id,A\n"1",2\n', "quoted.csv"))
+
+
+def test_column_types_and_not_applicable(tmp_path):
+    text = "region_id,Whole,Decimal,Text,NA,Empty\n1,1,1.5,x,..,\n2,-2,2,3,..,\n"
+    with scan_csv(write(tmp_path, text)) as scan:
+        assert scan.column_types() == ["bigint", "double precision", "text", "bigint", "bigint"]
+        assert scan.not_applicable_columns() == ["NA"]
+        assert scan.invalid_cells() == [("1", "Text", "x")]
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_write_columns(tmp_path, newline, monkeypatch):
+    # A chunk smaller than a line's fields, so lines are gathered across chunks
+    monkeypatch.setattr("census2011.csvscan.CHUNK_FIELDS", 2)
+    text = newline.join(["region_id,A,B,C", "101,1,..,-3.5", "102,,22,4", "103,333,,"])
+    with scan_csv(write(tmp_path, text)) as scan:
+        out = io.BytesIO()
+        scan.write_columns(out, [0, 3, None, 1], header=["region_id", "c", "missing", "a"])
+    assert out.getvalue().decode("utf-8") == "region_id,c,missing,a\n101,-3.5,,1\n102,4,,\n103,,,333\n"
+
+    rows = reference_rows(text)
+    with scan_csv(write(tmp_path, text)) as scan:
+        out = io.BytesIO()
+        scan.write_columns(out, [2, 0])
+    assert reference_rows(out.getvalue().decode("utf-8")) == [[row[2], row[0]] for row in rows]
+
+
+def test_write_merged_csv(tmp_path):
+    first = write(tmp_path, "region_id,A,B\r\n1,10,11\r\n2,20,21\r\n", "first.csv")
+    second = write(tmp_path, "region_id,C\n2,..\n1,-1.5\n3,30", "second.csv")
+    merged = str(tmp_path / "merged.csv")
+    scans = [scan_csv(first), scan_csv(second)]
+    try:
+        assert write_merged_csv(scans, merged) == 4
+    finally:
+        for scan in scans:
+            scan.close()
+    with open(merged) as f:
+        assert reference_rows(f.read()) == [
+            ["region_id", "A", "B", "C"],
+            ["1", "10", "11", "-1.5"],
+            ["2", "20", "21", ".."],
+            ["3", "", "", "30"],
+        ]